@@ -0,0 +1,118 @@
+"""Throughput benchmark for ``BillingApi`` against a local billing server.
+
+Serves the billing API's ``Root`` resource over TCP on localhost and
+creates transactions through ``BillingApi`` with a fixed number of requests
+in flight, once with a non-persistent connection pool (a new connection
+per request) and once with the default persistent pool, and reports
+requests per second at steady state for each.
+
+The resource is given an in-memory stand-in for the txpostgres connection
+pool that answers the cost and transaction queries with fixed rows, so that
+the numbers reflect the HTTP client and server rather than PostgreSQL. The
+billing API imports Django, so ``DJANGO_SETTINGS_MODULE`` must name usable
+settings (it defaults to ``go.settings``). Run with::
+
+    python benchmarks/bench_billing_api.py [requests] [concurrency]
+"""
+
+import os
+import sys
+import time
+from decimal import Decimal
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "go.settings")
+
+from twisted.internet import task
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, succeed)
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+from go.billing import api
+from go.vumitools.billing_worker import BillingApi
+
+
+COST = {
+    "account_number": "12345",
+    "tag_pool_name": "pool1",
+    "message_direction": "Inbound",
+    "message_cost": Decimal("0.5"),
+    "session_cost": Decimal("0.1"),
+    "markup_percent": Decimal("10.0"),
+}
+
+ROW = dict(COST, **{
+    "id": 1,
+    "message_id": "msg-id",
+    "tag_name": "1234",
+    "session_created": False,
+    "credit_factor": Decimal("10.0"),
+    "credit_amount": Decimal("-5.5"),
+    "status": "Completed",
+    "credit_balance": Decimal("1000.0"),
+    "alert_credit_balance": Decimal("0.0"),
+})
+
+
+class InMemoryCursor(object):
+    def execute(self, query, params=None):
+        return succeed(self)
+
+    def fetchone(self):
+        return succeed(dict(ROW))
+
+
+class InMemoryConnectionPool(object):
+    def runQuery(self, query, params=None):
+        return succeed([dict(COST)])
+
+    def runInteraction(self, interaction, *args, **kw):
+        return interaction(InMemoryCursor(), *args, **kw)
+
+
+@inlineCallbacks
+def run(reactor, url, pool, count, concurrency):
+    billing_api = BillingApi(url, pool=pool)
+    pending = iter(xrange(count))
+
+    @inlineCallbacks
+    def worker():
+        for i in pending:
+            yield billing_api.create_transaction(
+                account_number="12345", message_id="msg-%d" % (i,),
+                tag_pool_name="pool1", tag_name="1234",
+                message_direction="Inbound", session_created=False)
+
+    # Warm up so that the persistent pool has its connections open.
+    yield gatherResults([worker() for _ in range(concurrency)])
+    pending = iter(xrange(count))
+    start = time.time()
+    yield gatherResults([worker() for _ in range(concurrency)])
+    elapsed = time.time() - start
+    yield billing_api.close()
+    returnValue(elapsed)
+
+
+@inlineCallbacks
+def main(reactor, count=2000, concurrency=10):
+    count, concurrency = int(count), int(concurrency)
+    site = Site(api.Root(InMemoryConnectionPool()))
+    site.noisy = False
+    port = reactor.listenTCP(0, site, interface="127.0.0.1")
+    url = "http://127.0.0.1:%d/" % (port.getHost().port,)
+    results = {}
+    try:
+        for name, persistent in [("new conn", False), ("keep-alive", True)]:
+            pool = HTTPConnectionPool(reactor, persistent=persistent)
+            pool.maxPersistentPerHost = concurrency
+            elapsed = yield run(reactor, url, pool, count, concurrency)
+            results[name] = elapsed
+            print "%-10s %8.1f requests/s  (%d requests in %.2fs)" % (
+                name, count / elapsed, count, elapsed)
+    finally:
+        yield port.stopListening()
+    print "speedup    %8.1fx" % (results["new conn"] / results["keep-alive"])
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
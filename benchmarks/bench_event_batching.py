@@ -0,0 +1,123 @@
+"""Throughput benchmark for event routing in the routing table dispatcher.
+
+Routes a burst of acks for stored outbound messages through an
+``AccountRoutingTableDispatcher`` twice, once routing events one at a time
+and once with ``event_batch_size`` set, and reports events per second for
+each. The outbound hop cache is disabled so that every event needs its
+outbound message from the message store, as it would for events arriving
+after the cache window.
+
+This uses the same persistence and fake AMQP helpers as the test suite, so
+it needs the Riak and Redis servers the tests use. Run with::
+
+    python benchmarks/bench_event_batching.py [events] [batch_size]
+"""
+
+import sys
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+
+from vumi.tests.helpers import MessageHelper
+
+from go.vumitools.routing import AccountRoutingTableDispatcher, RoutingMetadata
+from go.vumitools.routing_table import RoutingTable
+from go.vumitools.tests.helpers import VumiApiHelper
+from go.vumitools.utils import MessageMetadataHelper
+
+
+ROUTING_TABLE = {
+    "TRANSPORT_TAG:pool1:1234": {
+        "default": ["CONVERSATION:app1:conv1", "default"]},
+    "CONVERSATION:app1:conv1": {
+        "default": ["TRANSPORT_TAG:pool1:1234", "default"]},
+}
+
+
+def dispatcher_config(vumi_helper, event_batch_size):
+    return vumi_helper.mk_config({
+        "receive_inbound_connectors": ["sphex"],
+        "receive_outbound_connectors": ["app1", "optout"],
+        "metrics_prefix": "bench",
+        "application_connector_mapping": {"app1": "app1"},
+        "router_inbound_connector_mapping": {},
+        "router_outbound_connector_mapping": {},
+        "opt_out_connector": "optout",
+        "outbound_hop_cache_ttl": 0,
+        "event_batch_size": event_batch_size,
+        "amqp_prefetch_count": max(20, event_batch_size),
+    })
+
+
+@inlineCallbacks
+def make_acks(vumi_helper, user_account_key, count):
+    vumi_api = vumi_helper.get_vumi_api()
+    msg_helper = MessageHelper()
+    acks = []
+    for i in range(count):
+        msg = msg_helper.make_outbound("msg %d" % (i,))
+        msg_mdh = MessageMetadataHelper(vumi_api, msg)
+        msg_mdh.set_user_account(user_account_key)
+        msg_mdh.set_tag(("pool1", "1234"))
+        RoutingMetadata(msg).push_hop(
+            ["CONVERSATION:app1:conv1", "default"],
+            ["TRANSPORT_TAG:pool1:1234", "default"])
+        yield vumi_api.mdb.add_outbound_message(msg)
+        acks.append(msg_helper.make_ack(msg))
+    returnValue(acks)
+
+
+@inlineCallbacks
+def run(event_batch_size, count):
+    vumi_helper = VumiApiHelper()
+    yield vumi_helper.setup()
+    try:
+        user_helper = yield vumi_helper.make_user(u"bench")
+        user_account = yield user_helper.get_user_account()
+        user_account.routing_table = RoutingTable(ROUTING_TABLE)
+        yield user_account.save()
+        [tag] = yield vumi_helper.setup_tagpool(
+            u"pool1", [u"1234"], metadata={"transport_name": "sphex"})
+        yield user_helper.add_tagpool_permission(u"pool1")
+        yield user_helper.user_api.acquire_specific_tag(tag)
+
+        dispatcher = yield vumi_helper.get_worker_helper().get_worker(
+            AccountRoutingTableDispatcher,
+            dispatcher_config(vumi_helper, event_batch_size))
+        acks = yield make_acks(vumi_helper, user_helper.account_key, count)
+
+        worker_helper = vumi_helper.get_worker_helper("sphex")
+        start = time.time()
+        yield gatherResults([worker_helper.dispatch_event(ack)
+                             for ack in acks])
+        if dispatcher.event_batcher is not None:
+            # Events are acknowledged before their batch is routed.
+            yield dispatcher.event_batcher.flush()
+            yield dispatcher.event_batcher.wait()
+            yield worker_helper.kick_delivery()
+        elapsed = time.time() - start
+
+        routed = vumi_helper.get_worker_helper("app1").get_dispatched_events()
+        assert len(routed) == count, "Only %d of %d events routed." % (
+            len(routed), count)
+        returnValue(elapsed)
+    finally:
+        yield vumi_helper.cleanup()
+
+
+@inlineCallbacks
+def main(reactor, count=2000, batch_size=20):
+    count, batch_size = int(count), int(batch_size)
+    results = {}
+    for name, event_batch_size in [("per-event", 0),
+                                   ("batched", batch_size)]:
+        elapsed = yield run(event_batch_size, count)
+        results[name] = elapsed
+        print "%-10s %8.1f events/s  (%d events in %.2fs)" % (
+            name, count / elapsed, count, elapsed)
+    print "speedup    %8.1fx" % (results["per-event"] / results["batched"])
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
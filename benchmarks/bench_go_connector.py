@@ -0,0 +1,81 @@
+"""Micro-benchmark for parsing and formatting routing table connectors.
+
+Compares parsing connector strings from scratch with the cached
+``GoConnector.parse``, using a mix of connectors similar to what the
+routing table dispatcher sees: a few busy conversations and channels that
+carry most of the traffic, and a long tail of quieter ones.
+
+Run with::
+
+    python benchmarks/bench_go_connector.py
+"""
+
+import random
+import timeit
+
+from go.vumitools.routing_table import GoConnector
+
+
+def make_connectors(count=500):
+    connectors = ["OPT_OUT", "BILLING:INBOUND", "BILLING:OUTBOUND"]
+    for i in range(count):
+        connectors.extend([
+            "CONVERSATION:bulk_message:conv%05d" % i,
+            "TRANSPORT_TAG:longcode:+2771%07d" % i,
+            "ROUTER:keyword:router%05d:INBOUND" % i,
+            "ROUTER:keyword:router%05d:OUTBOUND" % i,
+        ])
+    return connectors
+
+
+def make_traffic(connectors, messages=100000, seed=42):
+    rnd = random.Random(seed)
+    # Roughly Zipfian: low indexes are picked far more often.
+    weights = [1.0 / (i + 1) for i in range(len(connectors))]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+
+    def pick():
+        r = rnd.random()
+        lo, hi = 0, len(cumulative) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        return connectors[lo]
+
+    return [pick() for _ in range(messages)]
+
+
+def round_trip(parse, traffic):
+    for s in traffic:
+        conn = parse(s)
+        str(conn)
+        conn.direction
+
+
+def main(repeat=5):
+    traffic = make_traffic(make_connectors())
+    cases = [
+        ("uncached parse", GoConnector._parse),
+        ("cached parse", GoConnector.parse),
+    ]
+    results = {}
+    for name, parse in cases:
+        timer = timeit.Timer(lambda: round_trip(parse, traffic))
+        best = min(timer.repeat(repeat=repeat, number=1))
+        results[name] = best
+        print "%-16s %8.1f ms  (%d round trips)" % (
+            name, best * 1000, len(traffic))
+    print "speedup          %8.1fx" % (
+        results["uncached parse"] / results["cached parse"])
+
+
+if __name__ == '__main__':
+    main()
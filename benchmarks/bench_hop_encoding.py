@@ -0,0 +1,79 @@
+"""Benchmark of message size and serialization time for routing hops.
+
+Builds an event for an outbound message that passed through a chain of
+routers and compares the JSON size of the event, and the time taken to
+serialize and deserialize it, with the routing hops in the plain list form
+and in the compact form (``RoutingMetadata(msg, compact=True)``).
+
+Run with::
+
+    python benchmarks/bench_hop_encoding.py [routers]
+"""
+
+import sys
+import timeit
+import uuid
+
+from vumi.message import TransportEvent, TransportUserMessage
+
+from go.vumitools.routing import RoutingMetadata
+from go.vumitools.routing_table import GoConnector
+
+
+def outbound_hops(routers):
+    """Return the hops for a message sent from a conversation to a
+    transport through a chain of `routers` keyword routers.
+    """
+    conv = GoConnector.for_conversation("jsbox", uuid.uuid4().hex)
+    connectors = [conv]
+    for _ in range(routers):
+        router_key = uuid.uuid4().hex
+        connectors.append(GoConnector.for_router(
+            "keyword", router_key, GoConnector.INBOUND))
+        connectors.append(GoConnector.for_router(
+            "keyword", router_key, GoConnector.OUTBOUND))
+    connectors.append(
+        GoConnector.for_transport_tag("longcode", "default10001"))
+    hops = []
+    for src, dst in zip(connectors[::2], connectors[1::2]):
+        hops.append([[str(src), "default"], [str(dst), "default"]])
+    return hops
+
+
+def make_event(hops, compact):
+    msg = TransportUserMessage(
+        to_addr="+27831234567", from_addr="10001", transport_name="sphex",
+        transport_type="sms", content="hello world")
+    RoutingMetadata(msg, compact=compact).set_hops(hops)
+    event = TransportEvent(
+        event_type="ack", user_message_id=msg["message_id"],
+        sent_message_id=msg["message_id"], transport_name="sphex")
+    rmeta = RoutingMetadata(event, compact=compact)
+    rmeta.set_outbound_hops(RoutingMetadata(msg).get_hops())
+    # The event has passed back through all but the last hop.
+    for [src, dst] in reversed(hops[1:]):
+        rmeta.push_hop(dst, src)
+    return event
+
+
+def main(routers=2, number=5000):
+    routers = int(routers)
+    hops = outbound_hops(routers)
+    print "event for a message routed through %d router(s):" % (routers,)
+    results = {}
+    for name, compact in [("plain", False), ("compact", True)]:
+        event = make_event(hops, compact)
+        data = event.to_json()
+        serialize = timeit.Timer(event.to_json).timeit(number) / number
+        deserialize = timeit.Timer(
+            lambda: TransportEvent.from_json(data)).timeit(number) / number
+        results[name] = (len(data), serialize, deserialize)
+        print "%-8s %6d bytes  to_json %6.1fus  from_json %6.1fus" % (
+            name, len(data), serialize * 1e6, deserialize * 1e6)
+    for i, label in enumerate(["size", "to_json", "from_json"]):
+        print "%-9s %5.1f%% of plain" % (
+            label, 100.0 * results["compact"][i] / results["plain"][i])
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -228,7 +228,9 @@ class GoApiServer(JSONRPC, GoApiSubHandler):
 
         def save_routing_table(user_account, routing_table):
             user_account.routing_table = routing_table
-            return user_account.save()
+            d = user_account.save()
+            d.addCallback(lambda _: user_api.routing_table_updated())
+            return d
 
         def swallow_result(result):
             return None
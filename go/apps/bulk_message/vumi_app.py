@@ -78,10 +78,10 @@ class BulkMessageApplication(GoApplicationWorker):
             return
 
         to_addresses = []
-        for contacts_batch in (
-                yield conv.get_opted_in_contact_bunches(delivery_class)):
-            for contact in (yield contacts_batch):
-                to_addresses.append(contact.addr_for(delivery_class))
+        for addrs_batch in (
+                yield conv.get_opted_in_addr_bunches(delivery_class)):
+            for contact_key, to_addr in (yield addrs_batch):
+                to_addresses.append(to_addr)
         if dedupe:
             to_addresses = set(to_addresses)
 
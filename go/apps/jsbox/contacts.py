@@ -393,7 +393,7 @@ class ContactsResource(SandboxResource):
             contact_store = self._contact_store_for_api(api)
 
             # raise an exception if the contact does not exist
-            yield contact_store.get_contact_by_key(key)
+            old_contact = yield contact_store.get_contact_by_key(key)
 
             contact = contact_store.contacts(
                 key,
@@ -406,6 +406,8 @@ class ContactsResource(SandboxResource):
                 contact.add_to_group(group)
 
             yield contact.save()
+            yield contact_store.update_group_counts(
+                old_contact.groups.keys(), contact.groups.keys())
         except (SandboxError, ContactError) as e:
             returnValue(self.reply(command, success=False, reason=unicode(e)))
 
@@ -832,7 +834,8 @@ class GroupsResource(SandboxResource):
         except (SandboxError,) as e:
             returnValue(self.reply(command, success=False, reason=unicode(e)))
 
-        member_count = yield contact_store.count_contacts_for_group(group)
+        member_count = yield contact_store.count_contacts_for_group(
+            group, max_age=contact_store.SMART_GROUP_SNAPSHOT_MAX_AGE)
         returnValue(self.reply(
             command, success=True, count=member_count, group=group.get_data()))
 
@@ -164,9 +164,8 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
                 conversation_key, user_account_key))
             return
 
-        for contacts in (yield conv.get_opted_in_contact_bunches(
+        for addrs in (yield conv.get_opted_in_addr_bunches(
                 delivery_class)):
-            for contact in (yield contacts):
-                to_addr = contact.addr_for(delivery_class)
+            for contact_key, to_addr in (yield addrs):
                 yield self.send_inbound_push_trigger(
                     to_addr, conv)
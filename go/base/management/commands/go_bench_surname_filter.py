@@ -0,0 +1,124 @@
+import time
+from optparse import make_option
+from string import ascii_lowercase
+
+from django.core.management.base import CommandError
+
+from go.base.command_utils import BaseGoAccountCommand
+from go.vumitools.contact import Contact
+
+
+# The map-reduce over the whole contacts bucket that the surname filter used
+# before the ``surname_initial`` index existed, kept here as the baseline to
+# compare the index lookup against.
+SURNAME_MAP_JS = """function(value, keyData, arg){
+    for (i in value.values) {
+        var val = value.values[i]
+        if (!val.metadata['X-Riak-Deleted']) {
+            var data = JSON.parse(val.data);
+            if (data.surname) {
+                if (data.surname.toLowerCase()[0] === arg) {
+                    return [[value.key, val]];
+                }
+            }
+        }
+    }
+    return [];
+}"""
+
+
+def filter_contacts_on_surname_mr(contact_store, letter):
+    manager = contact_store.manager
+    mr = manager.riak_map_reduce()
+    mr.add_bucket(manager.bucket_name(Contact))
+    mr.map(SURNAME_MAP_JS, {'arg': letter.lower()})
+    return manager.run_map_reduce(
+        mr, lambda manager, result: Contact.load(
+            manager, result[0], result[1]))
+
+
+def make_surname(i):
+    """Return a surname for the ``i``th benchmark contact, spreading the
+    contacts evenly over the letters of the alphabet.
+    """
+    return u'%sbench' % (ascii_lowercase[i % len(ascii_lowercase)].upper(),)
+
+
+class Command(BaseGoAccountCommand):
+    help = (
+        "Creates contacts in a Vumi Go account and times filtering them on"
+        " the first letter of their surnames, through the surname_initial"
+        " index and through the map-reduce over the whole contacts bucket"
+        " it replaced. The contacts created are deleted afterwards.")
+
+    option_list = BaseGoAccountCommand.option_list + (
+        make_option(
+            '--contacts', type='int', dest='contacts', default=100000,
+            help="Number of contacts to create. Defaults to 100000."),
+        make_option(
+            '--letter', dest='letter', default='m',
+            help="Surname letter to filter on. Defaults to 'm'."),
+        make_option(
+            '--page-size', type='int', dest='page_size', default=50,
+            help="Number of contacts on a page. Defaults to 50."),
+        make_option(
+            '--repeat', type='int', dest='repeat', default=3,
+            help="Number of times to time each filter. Defaults to 3."),
+        make_option(
+            '--skip-map-reduce', action='store_true', dest='skip_mr',
+            default=False, help="Don't time the map-reduce."),
+        make_option(
+            '--keep', action='store_true', dest='keep', default=False,
+            help="Keep the contacts created."),
+    )
+
+    def handle_no_command(self, *args, **options):
+        letter = options['letter']
+        if len(letter) != 1:
+            raise CommandError("--letter must be a single letter.")
+
+        contact_store = self.user_api.contact_store
+        self.stdout.write("Creating %d contacts...\n" % (options['contacts'],))
+        contact_keys = []
+        try:
+            for i in xrange(options['contacts']):
+                contact = contact_store.new_contact(
+                    name=u'Bench', surname=make_surname(i),
+                    msisdn=u'+%d' % (i,))
+                contact_keys.append(contact.key)
+
+            def index_all():
+                return contact_store.filter_contacts_on_surname(letter)
+
+            def index_page():
+                return contact_store.filter_contacts_on_surname(
+                    letter, limit=options['page_size'])
+
+            self.time_filter("index, all", index_all, options['repeat'])
+            self.time_filter(
+                "index, page of %d" % (options['page_size'],),
+                index_page, options['repeat'])
+            if not options['skip_mr']:
+                self.time_filter(
+                    "map-reduce, all",
+                    lambda: filter_contacts_on_surname_mr(
+                        contact_store, letter),
+                    options['repeat'])
+        finally:
+            if not options['keep']:
+                self.stdout.write(
+                    "Deleting %d contacts...\n" % (len(contact_keys),))
+                for key in contact_keys:
+                    contact_store.delete_contact(
+                        contact_store.get_contact_by_key(key))
+
+    def time_filter(self, name, filter_func, repeat):
+        timings = []
+        for _ in xrange(repeat):
+            start = time.time()
+            contacts = filter_func()
+            timings.append(time.time() - start)
+        self.stdout.write(
+            "%s: %d contacts, best %.1fms, worst %.1fms\n" % (
+                name, len(contacts), min(timings) * 1000,
+                max(timings) * 1000))
@@ -132,8 +132,8 @@ class Command(BaseCommand):
         # sit in memory is ugly.
         for contact_key in group.backlinks.contacts():
             contact = user_api.contact_store.get_contact_by_key(contact_key)
-            contact.groups.remove(group)
-            contact.save()
+            user_api.contact_store.remove_contact_from_group(contact, group)
             self.stdout.write('.')
         self.stdout.write('\nDone.\n')
+        user_api.contact_store.clear_group_caches(group)
         group.delete()
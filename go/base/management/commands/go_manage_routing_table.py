@@ -76,6 +76,7 @@ class Command(BaseCommand):
         account = user_api.get_user_account()
         account.routing_table = RoutingTable()
         account.save()
+        user_api.routing_table_updated()
         self.stdout.write("Routing table cleared.\n")
 
     def handle_add(self, user_api, options):
@@ -88,6 +89,7 @@ class Command(BaseCommand):
         except Exception as e:
             raise CommandError(e)
         account.save()
+        user_api.routing_table_updated()
         self.stdout.write("Routing table entry added.\n")
 
     def handle_remove(self, user_api, options):
@@ -109,6 +111,7 @@ class Command(BaseCommand):
         except Exception as e:
             raise CommandError(e)
         account.save()
+        user_api.routing_table_updated()
         self.stdout.write("Routing table entry removed.\n")
 
     def print_routing_table(self, routing_table):
@@ -121,7 +124,7 @@ class Command(BaseCommand):
             return
 
         self.stdout.write("Routing table:\n")
-        for source, values in routing_table._routing_table.iteritems():
+        for source, values in routing_table.as_dict().iteritems():
             self.stdout.write("  %s\n" % (source,))
             for endpoint, dest in values.iteritems():
                 self.stdout.write("      %s  ->  %s - %s\n" % (
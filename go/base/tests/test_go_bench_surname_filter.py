@@ -0,0 +1,47 @@
+from go.base.management.commands import go_bench_surname_filter
+from go.base.tests.helpers import GoCommandTestCase
+
+
+class TestGoBenchSurnameFilter(GoCommandTestCase):
+
+    def setUp(self):
+        self.setup_command(go_bench_surname_filter.Command)
+
+    def call_bench(self, **options):
+        defaults = {
+            'email_address': self.user_email,
+            'contacts': 52,
+            'letter': 'b',
+            'page_size': 1,
+            'repeat': 1,
+            'skip_mr': False,
+            'keep': False,
+        }
+        defaults.update(options)
+        self.call_command(**defaults)
+        return self.command.stdout.getvalue().splitlines()
+
+    def test_make_surname(self):
+        self.assertEqual(go_bench_surname_filter.make_surname(0), u'Abench')
+        self.assertEqual(go_bench_surname_filter.make_surname(27), u'Bbench')
+
+    def test_bench(self):
+        lines = self.call_bench()
+        self.assertEqual(lines[0], "Creating 52 contacts...")
+        self.assertTrue(lines[1].startswith("index, all: 2 contacts,"))
+        self.assertTrue(lines[2].startswith("index, page of 1: 1 contacts,"))
+        self.assertTrue(lines[3].startswith("map-reduce, all: 2 contacts,"))
+        self.assertEqual(lines[4], "Deleting 52 contacts...")
+        contact_store = self.user_helper.user_api.contact_store
+        self.assertEqual(contact_store.list_contacts(), [])
+
+    def test_bench_keep(self):
+        lines = self.call_bench(skip_mr=True, keep=True)
+        self.assertEqual(len(lines), 3)
+        contact_store = self.user_helper.user_api.contact_store
+        self.assertEqual(len(contact_store.list_contacts()), 52)
+
+    def test_bench_bad_letter(self):
+        self.assert_command_error(
+            "--letter must be a single letter", email_address=self.user_email,
+            letter='ab')
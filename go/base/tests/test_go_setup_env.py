@@ -563,9 +563,14 @@ class TestGoSetupEnv(GoDjangoTestCase):
         account_info = self.read_yaml(self.account_1_file)
         user = self.command.setup_account(account_info['account'])
 
+        user_api = vumi_api_for_user(user)
+        versions = user_api.api.routing_table_versions
+        self.assertEqual(versions.get_version(user_api.user_account_key), 0)
+
         self.command.setup_routing(user, account_info)
 
-        routing_table = vumi_api_for_user(user).get_routing_table()
+        self.assertEqual(versions.get_version(user_api.user_account_key), 1)
+        routing_table = user_api.get_routing_table()
         self.assertEqual(routing_table, RoutingTable({
             u'TRANSPORT_TAG:pool1:default0': {
                 u'default': [u'CONVERSATION:survey:conv1', u'default'],
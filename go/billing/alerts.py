@@ -0,0 +1,67 @@
+# -*- test-case-name: go.billing.tests.test_alerts -*-
+
+"""Low credit alerts raised by the billing API."""
+
+import json
+
+from twisted.internet import defer
+
+from vumi.persist.redis_base import Manager
+
+
+def crossed_alert_balance(old_balance, new_balance, alert_credit_balance):
+    """Return ``True`` if a credit balance went below
+    ``alert_credit_balance`` when it changed from ``old_balance`` to
+    ``new_balance``.
+
+    Only the change that takes the balance below the alert balance counts,
+    so an account gets one alert each time its balance drops past it.
+
+    """
+    return old_balance >= alert_credit_balance > new_balance
+
+
+class LowCreditAlerts(object):
+    """Low credit alerts waiting to be handled, stored in a Redis list.
+
+    Each alert is a dict with the account number, the credit balance after
+    the change that took it below the alert balance, the alert balance and
+    the time the alert was raised.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    :param clock:
+        Object with a `seconds()` method that returns the current time.
+    """
+
+    QUEUE_KEY = "low_credit"
+
+    def __init__(self, redis, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.manager = redis
+        self.clock = clock
+
+    @Manager.calls_manager
+    def push(self, account_number, credit_balance, alert_credit_balance):
+        """Raise a low credit alert for ``account_number``."""
+        yield self.manager.rpush(self.QUEUE_KEY, json.dumps({
+            "account_number": account_number,
+            "credit_balance": str(credit_balance),
+            "alert_credit_balance": str(alert_credit_balance),
+            "raised_at": self.clock.seconds(),
+        }))
+
+    @Manager.calls_manager
+    def pop(self):
+        """Remove and return the oldest alert, or ``None`` if there are no
+        alerts waiting.
+        """
+        alert = yield self.manager.lpop(self.QUEUE_KEY)
+        defer.returnValue(json.loads(alert) if alert is not None else None)
+
+    def depth(self):
+        """Return the number of alerts waiting."""
+        return self.manager.llen(self.QUEUE_KEY)
@@ -1,17 +1,92 @@
 import json
 
+from psycopg2 import IntegrityError
+from psycopg2.errorcodes import UNIQUE_VIOLATION
+from iso8601 import parse_date, ParseError
+
 from twisted.python import log
 from twisted.internet import defer
+from twisted.internet.task import LoopingCall
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from django.contrib.auth.hashers import make_password
 
 from go.billing import settings as app_settings
+from go.billing.alerts import crossed_alert_balance
 from go.billing.models import MessageCost
 from go.billing.utils import JSONEncoder, JSONDecoder, BillingError
 
 
+class MessageCostCache(object):
+    """In-process cache of message costs.
+
+    Costs are keyed by account number, tag pool name and message direction
+    and are kept for ``ttl`` seconds. Lookups that find no cost are cached
+    too. The whole cache should be cleared whenever a cost is created or
+    changed, since a single cost can apply to many keys.
+
+    The numbers of cache hits and misses can be logged periodically by
+    calling :meth:`start_logging`.
+
+    """
+
+    def __init__(self, ttl, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.ttl = ttl
+        self.clock = clock
+        self._costs = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._looper = None
+
+    def start_logging(self, interval):
+        """Log the cache hits and misses every ``interval`` seconds."""
+        self._looper = LoopingCall(self.log_stats)
+        self._looper.clock = self.clock
+        self._looper.start(interval, now=False)
+
+    def stop_logging(self):
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        self._looper = None
+
+    def log_stats(self):
+        """Log the cache hits and misses since they were last logged."""
+        log.msg("Message cost cache: %d hits, %d misses."
+                % (self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Remove all cached costs."""
+        self._costs = {}
+        self._generation += 1
+
+    @defer.inlineCallbacks
+    def get(self, key, fetch_cost):
+        """Return a copy of the cost for ``key``.
+
+        If the cost isn't cached, it is fetched by calling ``fetch_cost``
+        with the parts of ``key`` as arguments.
+
+        """
+        now = self.clock.seconds()
+        expires, cost = self._costs.get(key, (None, None))
+        if expires is not None and now < expires:
+            self.hits += 1
+        else:
+            self.misses += 1
+            generation = self._generation
+            cost = yield fetch_cost(*key)
+            if self.ttl > 0 and generation == self._generation:
+                self._costs[key] = (now + self.ttl, cost)
+        defer.returnValue(dict(cost) if cost is not None else None)
+
+
 class BaseResource(Resource):
     """Base class for the APIs ``Resource``s"""
 
@@ -29,6 +104,18 @@ class BaseResource(Resource):
         request.write(error.getErrorMessage())
         request.finish()
 
+    def _handle_billing_error(self, error, request, *args, **kwargs):
+        """Log the error and return an HTTP 400 response if it is a
+        ``BillingError``, since the same request would fail again, or an
+        HTTP 500 response otherwise.
+        """
+        if error.check(BillingError) is None:
+            return self._handle_error(error, request, *args, **kwargs)
+        log.err(error)
+        request.setResponseCode(400)  # Bad Request
+        request.write(error.getErrorMessage())
+        request.finish()
+
     def _handle_bad_request(self, request, *args, **kwargs):
         """Handle a bad request"""
         request.setResponseCode(400)  # Bad Request
@@ -169,6 +256,23 @@ class AccountResource(BaseResource):
 
     isLeaf = True
 
+    def __init__(self, connection_pool, balances=None):
+        BaseResource.__init__(self, connection_pool)
+        self._balances = balances
+
+    @defer.inlineCallbacks
+    def _add_pending_balances(self, accounts):
+        """Add any changes to the credit balances of ``accounts`` that are
+        still pending in the running balances.
+        """
+        if self._balances is not None and accounts:
+            deltas = yield self._balances.get_deltas(
+                account['account_number'] for account in accounts)
+            for account in accounts:
+                account['credit_balance'] += deltas.get(
+                    account['account_number'], 0)
+        defer.returnValue(accounts)
+
     def render_GET(self, request):
         """Handle an HTTP GET request"""
         params = filter(None, request.postpath)
@@ -198,6 +302,7 @@ class AccountResource(BaseResource):
 
         params = {'account_number': account_number}
         result = yield self._connection_pool.runQuery(query, params)
+        yield self._add_pending_balances(result)
         if len(result) > 0:
             defer.returnValue(result[0])
         else:
@@ -215,6 +320,7 @@ class AccountResource(BaseResource):
         """ % self._auth_user_table
 
         result = yield self._connection_pool.runQuery(query)
+        yield self._add_pending_balances(result)
         defer.returnValue(result)
 
     def render_POST(self, request):
@@ -310,10 +416,10 @@ class AccountResource(BaseResource):
         # Create a new transaction
         query = """INSERT INTO billing_transaction
                        (account_number, tag_pool_name, tag_name,
-                        message_direction, credit_amount, status,
-                        created, last_modified)
+                        message_direction, credit_amount, balance_applied,
+                        status, created, last_modified)
                    VALUES (%(account_number)s, '', '', '', %(credit_amount)s,
-                          'Completed', now(), now())"""
+                          TRUE, 'Completed', now(), now())"""
 
         params = {
             'account_number': account_number,
@@ -322,12 +428,20 @@ class AccountResource(BaseResource):
 
         cursor = yield cursor.execute(query, params)
 
-        # Update the account's credit balance
+        # Update the account's credit balance. The alert credit balance
+        # is worked out from the credit balance including any changes that
+        # are still pending in the running balances, since that is what the
+        # reconciler compares it to.
         query = """
             UPDATE billing_account
             SET credit_balance = credit_balance + %(credit_amount)s,
-                alert_credit_balance = (credit_balance + %(credit_amount)s)
-                                       * alert_threshold / 100.0
+                alert_credit_balance = (
+                    credit_balance + %(credit_amount)s + COALESCE(
+                        (SELECT SUM(t.credit_amount)
+                         FROM billing_transaction t
+                         WHERE t.account_number = %(account_number)s
+                         AND NOT t.balance_applied), 0)
+                ) * alert_threshold / 100.0
             WHERE account_number = %(account_number)s
         """
 
@@ -355,6 +469,8 @@ class AccountResource(BaseResource):
         result = yield self._connection_pool.runInteraction(
             self.load_credits_interaction, account_number, credit_amount)
 
+        if result is not None:
+            yield self._add_pending_balances([result])
         defer.returnValue(result)
 
 
@@ -363,6 +479,10 @@ class CostResource(BaseResource):
 
     isLeaf = True
 
+    def __init__(self, connection_pool, cost_cache):
+        BaseResource.__init__(self, connection_pool)
+        self._cost_cache = cost_cache
+
     def render_GET(self, request):
         """Handle an HTTP GET request"""
         account_number = request.args.get('account_number', [None])
@@ -552,6 +672,7 @@ class CostResource(BaseResource):
             tag_pool_name, message_direction, message_cost, session_cost,
             markup_percent)
 
+        self._cost_cache.clear()
         defer.returnValue(result)
 
 
@@ -560,14 +681,30 @@ class TransactionResource(BaseResource):
 
     isLeaf = True
 
+    def __init__(self, connection_pool, cost_cache, balances=None,
+                 alerts=None):
+        BaseResource.__init__(self, connection_pool)
+        self._cost_cache = cost_cache
+        self._balances = balances
+        self._alerts = alerts
+
     def render_GET(self, request):
         """Handle an HTTP GET request"""
         account_number = request.args.get('account_number', [])
-        page_number = request.args.get('page_number', [0])
+        last_created = request.args.get('last_created', [None])
+        last_id = request.args.get('last_id', [None])
         items_per_page = request.args.get('items_per_page', [20])
+        if last_created[0] is not None:
+            try:
+                last_created = [
+                    parse_date(last_created[0], default_timezone=None)]
+            except ParseError:
+                self._handle_bad_request(request)
+                return NOT_DONE_YET
         if len(account_number) > 0:
             d = self.get_transaction_list(
-                account_number[0], page_number[0], items_per_page[0])
+                account_number[0], last_created[0], last_id[0],
+                items_per_page[0])
 
             d.addCallbacks(self._render_to_json, self._handle_error,
                            callbackArgs=[request], errbackArgs=[request])
@@ -576,8 +713,25 @@ class TransactionResource(BaseResource):
             self._handle_bad_request(request)
         return NOT_DONE_YET
 
+    TRANSACTION_FIELDS = (
+        'account_number', 'message_id', 'tag_pool_name', 'tag_name',
+        'message_direction', 'session_created')
+
+    def _valid_transaction_data(self, data):
+        """Return ``True`` if ``data`` has all the fields needed to create a
+        transaction.
+        """
+        if not isinstance(data, dict):
+            return False
+        return all((data.get('account_number'), data.get('message_id'),
+                    data.get('tag_pool_name'), data.get('tag_name'),
+                    data.get('message_direction'),
+                    data.get('session_created') is not None))
+
     def render_POST(self, request):
         """Handle an HTTP POST request"""
+        if filter(None, request.postpath) == ['batch']:
+            return self.render_POST_batch(request)
         data = self._parse_json(request)
         if data:
             account_number = data.get('account_number', None)
@@ -592,7 +746,8 @@ class TransactionResource(BaseResource):
                     account_number, message_id, tag_pool_name, tag_name,
                     message_direction, session_created)
 
-                d.addCallbacks(self._render_to_json, self._handle_error,
+                d.addCallbacks(self._render_to_json,
+                               self._handle_billing_error,
                                callbackArgs=[request], errbackArgs=[request])
             else:
                 self._handle_bad_request(request)
@@ -600,10 +755,46 @@ class TransactionResource(BaseResource):
             self._handle_bad_request(request)
         return NOT_DONE_YET
 
+    def render_POST_batch(self, request):
+        """Handle an HTTP POST request to create a batch of transactions.
+
+        The request data should be a dict with a ``transactions`` key
+        containing a list of transactions, each with the same fields as a
+        request to create a single transaction.
+
+        """
+        data = self._parse_json(request)
+        transactions = data.get('transactions') if data else None
+        if (transactions
+                and all(self._valid_transaction_data(transaction)
+                        for transaction in transactions)):
+            d = self.create_transaction_batch(transactions)
+            d.addCallbacks(self._render_to_json, self._handle_billing_error,
+                           callbackArgs=[request], errbackArgs=[request])
+        else:
+            self._handle_bad_request(request)
+        return NOT_DONE_YET
+
     @defer.inlineCallbacks
     def get_cost(self, account_number, tag_pool_name, message_direction,
                  session_created):
         """Return the message cost"""
+        message_cost = yield self._cost_cache.get(
+            (account_number, tag_pool_name, message_direction),
+            self.fetch_cost)
+
+        if message_cost is not None:
+            message_cost['credit_amount'] = MessageCost.calculate_credit_cost(
+                message_cost['message_cost'],
+                message_cost['markup_percent'],
+                message_cost['session_cost'],
+                session_created=session_created)
+
+        defer.returnValue(message_cost)
+
+    @defer.inlineCallbacks
+    def fetch_cost(self, account_number, tag_pool_name, message_direction):
+        """Fetch the message cost from the database"""
         query = """
             SELECT t.account_number, t.tag_pool_name, t.message_direction,
                    t.message_cost, t.session_cost, t.markup_percent
@@ -646,21 +837,21 @@ class TransactionResource(BaseResource):
 
         result = yield self._connection_pool.runQuery(query, params)
         if len(result) > 0:
-            message_cost = result[0]
-            message_cost['credit_amount'] = MessageCost.calculate_credit_cost(
-                message_cost['message_cost'],
-                message_cost['markup_percent'],
-                message_cost['session_cost'],
-                session_created=session_created)
-
-            defer.returnValue(message_cost)
+            defer.returnValue(result[0])
         else:
             defer.returnValue(None)
 
     @defer.inlineCallbacks
-    def get_transaction_list(self, account_number, page_number,
+    def get_transaction_list(self, account_number, last_created, last_id,
                              items_per_page):
-        """Return a paginated list of transactions"""
+        """Return a paginated list of transactions, newest first.
+
+        The first page is returned if ``last_created`` or ``last_id`` is
+        ``None``. Otherwise they should be the ``created`` datetime and
+        ``id`` of the last transaction on the previous page, and the page of
+        transactions after it is returned.
+
+        """
         query = """
             SELECT id, account_number, message_id,
                    tag_pool_name, tag_name,
@@ -669,27 +860,37 @@ class TransactionResource(BaseResource):
                    markup_percent, credit_factor, credit_amount,
                    status, created, last_modified
             FROM billing_transaction
-            WHERE account_number = %(account_number)s
-            ORDER BY created DESC
-            OFFSET %(offset)s
-            LIMIT %(limit)s
+            WHERE account_number = %%(account_number)s
+            %s
+            ORDER BY created DESC, id DESC
+            LIMIT %%(limit)s
         """
 
         try:
-            offset = int(page_number) * int(items_per_page)
+            last_id = int(last_id)
         except ValueError:
-            offset = 0
+            last_id = None
         except TypeError:
-            offset = 0
+            last_id = None
         try:
             limit = int(items_per_page)
         except ValueError:
             limit = 20
         except TypeError:
             limit = 20
+
+        if last_created is not None and last_id is not None:
+            query = query % ("""
+                AND (created, id) < (%(last_created)s::timestamptz,
+                                     %(last_id)s)
+            """,)
+        else:
+            query = query % ("",)
+
         params = {
             'account_number': account_number,
-            'offset': offset,
+            'last_created': last_created,
+            'last_id': last_id,
             'limit': limit
         }
 
@@ -699,6 +900,90 @@ class TransactionResource(BaseResource):
         else:
             defer.returnValue(None)
 
+    def _transaction_key(self, transaction):
+        return (transaction['account_number'], transaction['message_id'],
+                transaction['message_direction'])
+
+    @defer.inlineCallbacks
+    def get_existing_transaction(self, account_number, message_id,
+                                 message_direction):
+        """Fetch the transaction already created for a message, if any"""
+        query = """
+            SELECT id, account_number, message_id,
+                   tag_pool_name, tag_name,
+                   message_direction, message_cost,
+                   session_cost, session_created,
+                   markup_percent, credit_factor, credit_amount, status,
+                   created, last_modified
+            FROM billing_transaction
+            WHERE account_number = %(account_number)s
+            AND message_id = %(message_id)s
+            AND message_direction = %(message_direction)s
+        """
+
+        params = {
+            'account_number': account_number,
+            'message_id': message_id,
+            'message_direction': message_direction,
+        }
+
+        result = yield self._connection_pool.runQuery(query, params)
+        if len(result) > 0:
+            defer.returnValue(result[0])
+        else:
+            defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def get_existing_transactions(self, cursor, transactions):
+        """Return a dict mapping the account number, message ID and message
+        direction of each of ``transactions`` that has already been created
+        to the existing transaction.
+
+        The message IDs are locked until the database transaction ends, so
+        a transaction can't be created for the same message in the
+        meantime. This lets clients resend batches of transactions that
+        they don't know were created without billing the messages twice.
+        Single transactions rely on the unique index on these fields
+        instead, see :meth:`create_transaction`.
+
+        """
+        message_ids = sorted(set(
+            transaction['message_id'] for transaction in transactions))
+
+        # The locks are taken in order to avoid deadlocks between batches
+        query = """
+            SELECT pg_advisory_xact_lock(lock_key)
+            FROM (SELECT DISTINCT hashtext(message_id) AS lock_key
+                  FROM unnest(%(message_ids)s::text[]) AS message_id
+                  ORDER BY lock_key) AS lock_keys
+        """
+
+        params = {'message_ids': message_ids}
+        cursor = yield cursor.execute(query, params)
+
+        query = """
+            SELECT id, account_number, message_id,
+                   tag_pool_name, tag_name,
+                   message_direction, message_cost,
+                   session_cost, session_created,
+                   markup_percent, credit_factor, credit_amount, status,
+                   created, last_modified
+            FROM billing_transaction
+            WHERE message_id = ANY(%(message_ids)s)
+        """
+
+        cursor = yield cursor.execute(query, params)
+        result = yield cursor.fetchall()
+
+        keys = set(self._transaction_key(transaction)
+                   for transaction in transactions)
+        existing = {}
+        for transaction in result:
+            key = self._transaction_key(transaction)
+            if key in keys:
+                existing[key] = transaction
+        defer.returnValue(existing)
+
     @defer.inlineCallbacks
     def create_transaction_interaction(self, cursor, account_number,
                                        message_id, tag_pool_name, tag_name,
@@ -727,14 +1012,15 @@ class TransactionResource(BaseResource):
                  message_direction, message_cost,
                  session_created, session_cost,
                  markup_percent, credit_factor,
-                 credit_amount, status, created, last_modified)
+                 credit_amount, balance_applied, status, created,
+                 last_modified)
             VALUES
                 (%(account_number)s, %(message_id)s,
                  %(tag_pool_name)s, %(tag_name)s,
                  %(message_direction)s, %(message_cost)s,
                  %(session_created)s, %(session_cost)s,
                  %(markup_percent)s, %(credit_factor)s,
-                 %(credit_amount)s, 'Completed', now(),
+                 %(credit_amount)s, %(balance_applied)s, 'Completed', now(),
                  now())
             RETURNING id, account_number, message_id,
                       tag_pool_name, tag_name,
@@ -755,17 +1041,33 @@ class TransactionResource(BaseResource):
             'session_cost': session_cost,
             'markup_percent': markup_percent,
             'credit_factor': app_settings.CREDIT_CONVERSION_FACTOR,
-            'credit_amount': -credit_amount
+            'credit_amount': -credit_amount,
+            'balance_applied': self._balances is None,
         }
 
         cursor = yield cursor.execute(query, params)
         transaction = yield cursor.fetchone()
 
-        # Update the account's credit balance
+        # With running balances, the transaction was inserted unapplied and
+        # the reconciler updates the balance and checks for low credit
+        # instead, so we only need to check that the account exists.
+        if self._balances is not None:
+            exists = yield self._balances.account_exists_interaction(
+                cursor, account_number)
+            if not exists:
+                raise BillingError(
+                    "Unable to find billing account %s while checking"
+                    " credit balance. Message was %s to/from tag pool %s." % (
+                        account_number, message_direction, tag_pool_name))
+            defer.returnValue((transaction, None))
+
+        # Update the account's credit balance and fetch the new balance in
+        # the same statement
         query = """
             UPDATE billing_account
             SET credit_balance = credit_balance - %(credit_amount)s
             WHERE account_number = %(account_number)s
+            RETURNING credit_balance, alert_credit_balance
         """
 
         params = {
@@ -774,51 +1076,244 @@ class TransactionResource(BaseResource):
         }
 
         cursor = yield cursor.execute(query, params)
+        account = yield cursor.fetchone()
 
-        # Check the account's credit balance and raise an
-        # alert if it has gone below the credit balance threshold
-        query = """SELECT credit_balance, alert_credit_balance
-                   FROM billing_account
-                   WHERE account_number = %(account_number)s"""
-
-        params = {'account_number': account_number}
-        cursor = yield cursor.execute(query, params)
-        result = yield cursor.fetchone()
-
-        if result is None:
+        if account is None:
             raise BillingError(
                 "Unable to find billing account %s while checking"
                 " credit balance. Message was %s to/from tag pool %s." % (
                     account_number, message_direction, tag_pool_name))
 
-        credit_balance = result.get('credit_balance')
-        alert_credit_balance = result.get('alert_credit_balance')
-        if (credit_balance < alert_credit_balance and
-                credit_balance + credit_amount > alert_credit_balance):
-            pass  # TODO: Raise a Low Credits alert; somehow
+        # Raise an alert if the credit balance has gone below the alert
+        # credit balance
+        alert = None
+        credit_balance = account.get('credit_balance')
+        if crossed_alert_balance(
+                credit_balance + credit_amount, credit_balance,
+                account.get('alert_credit_balance')):
+            alert = account
 
-        defer.returnValue(transaction)
+        defer.returnValue((transaction, alert))
 
     @defer.inlineCallbacks
     def create_transaction(self, account_number, message_id, tag_pool_name,
                            tag_name, message_direction, session_created):
-        """Create a new transaction for the given ``account_number``"""
-        result = yield self._connection_pool.runInteraction(
-            self.create_transaction_interaction, account_number, message_id,
-            tag_pool_name, tag_name, message_direction, session_created)
+        """Create a new transaction for the given ``account_number``.
+
+        If a transaction has already been created for the message, the
+        INSERT violates the unique index on the account number, message ID
+        and message direction and the existing transaction is returned
+        instead. Transactions are only archived months after they were
+        created, long after a client would resend them, so archived
+        transactions aren't checked.
 
+        """
+        try:
+            result, alert = yield self._connection_pool.runInteraction(
+                self.create_transaction_interaction, account_number,
+                message_id, tag_pool_name, tag_name, message_direction,
+                session_created)
+        except IntegrityError as e:
+            if e.pgcode != UNIQUE_VIOLATION:
+                raise
+            result = yield self.get_existing_transaction(
+                account_number, message_id, message_direction)
+            if result is None:
+                raise
+            alert = None
+
+        if alert is not None:
+            yield self._raise_low_credit_alert(account_number, alert)
+        defer.returnValue(result)
+
+    def _raise_low_credit_alert(self, account_number, account):
+        """Raise a low credit alert for ``account_number``.
+
+        The transactions that took the balance below the alert credit
+        balance have already been created by this point, so errors are
+        logged rather than returned to the client.
+
+        """
+        if self._alerts is None:
+            return defer.succeed(None)
+        d = self._alerts.push(account_number, account['credit_balance'],
+                              account['alert_credit_balance'])
+        d.addErrback(log.err, "Error raising low credit alert for account"
+                     " %s." % (account_number,))
+        return d
+
+    @defer.inlineCallbacks
+    def create_transaction_batch_interaction(self, cursor, transactions):
+        """Create transactions for a list of messages.
+
+        Message costs are looked up once for each distinct account, tag pool
+        and message direction. The transactions are created with a single
+        INSERT and each account's credit balance is updated once with the
+        total cost of its messages.
+
+        Transactions for messages that have already been billed aren't
+        created again. The existing transactions are returned in their
+        place.
+
+        """
+        existing = yield self.get_existing_transactions(cursor, transactions)
+        all_transactions = transactions
+        transactions = []
+        keys = set(existing)
+        for transaction in all_transactions:
+            key = self._transaction_key(transaction)
+            if key not in keys:
+                keys.add(key)
+                transactions.append(transaction)
+        if not transactions:
+            defer.returnValue(([
+                existing[self._transaction_key(transaction)]
+                for transaction in all_transactions], {}))
+
+        # Get the message costs
+        costs = {}
+        for transaction in transactions:
+            key = (transaction['account_number'],
+                   transaction['tag_pool_name'],
+                   transaction['message_direction'])
+            if key in costs:
+                continue
+            result = yield self.get_cost(*key, session_created=False)
+            if result is None:
+                raise BillingError(
+                    "Unable to determine %s message cost for account %s"
+                    " and tag pool %s" % (key[2], key[0], key[1]))
+            costs[key] = result
+
+        # Create the transactions
+        values = []
+        params = {
+            'credit_factor': app_settings.CREDIT_CONVERSION_FACTOR,
+            'balance_applied': self._balances is None,
+        }
+        credit_amounts = {}
+        for i, transaction in enumerate(transactions):
+            account_number = transaction['account_number']
+            cost = costs[(account_number,
+                          transaction['tag_pool_name'],
+                          transaction['message_direction'])]
+            credit_amount = MessageCost.calculate_credit_cost(
+                cost['message_cost'], cost['markup_percent'],
+                cost['session_cost'],
+                session_created=transaction['session_created'])
+            credit_amounts[account_number] = (
+                credit_amounts.get(account_number, 0) + credit_amount)
+
+            values.append("""
+                (%%(account_number_%(i)d)s, %%(message_id_%(i)d)s,
+                 %%(tag_pool_name_%(i)d)s, %%(tag_name_%(i)d)s,
+                 %%(message_direction_%(i)d)s, %%(message_cost_%(i)d)s,
+                 %%(session_created_%(i)d)s, %%(session_cost_%(i)d)s,
+                 %%(markup_percent_%(i)d)s, %%(credit_factor)s,
+                 %%(credit_amount_%(i)d)s, %%(balance_applied)s,
+                 'Completed', now(), now())
+            """ % {'i': i})
+            for field in self.TRANSACTION_FIELDS:
+                params['%s_%d' % (field, i)] = transaction[field]
+            params['message_cost_%d' % (i,)] = cost['message_cost']
+            params['session_cost_%d' % (i,)] = cost['session_cost']
+            params['markup_percent_%d' % (i,)] = cost['markup_percent']
+            params['credit_amount_%d' % (i,)] = -credit_amount
+
+        query = """
+            INSERT INTO billing_transaction
+                (account_number, message_id,
+                 tag_pool_name, tag_name,
+                 message_direction, message_cost,
+                 session_created, session_cost,
+                 markup_percent, credit_factor,
+                 credit_amount, balance_applied, status, created,
+                 last_modified)
+            VALUES %s
+            RETURNING id, account_number, message_id,
+                      tag_pool_name, tag_name,
+                      message_direction, message_cost,
+                      session_cost, session_created,
+                      markup_percent, credit_factor, credit_amount, status,
+                      created, last_modified
+        """ % (",".join(values),)
+
+        cursor = yield cursor.execute(query, params)
+        result = yield cursor.fetchall()
+
+        # Update the credit balance of each account, unless the
+        # transactions were inserted unapplied for the running balances
+        query = """
+            UPDATE billing_account
+            SET credit_balance = credit_balance - %(credit_amount)s
+            WHERE account_number = %(account_number)s
+            RETURNING credit_balance, alert_credit_balance
+        """
+
+        alerts = {}
+        for account_number in sorted(credit_amounts):
+            if self._balances is not None:
+                exists = yield self._balances.account_exists_interaction(
+                    cursor, account_number)
+                if not exists:
+                    raise BillingError(
+                        "Unable to find billing account %s while updating"
+                        " credit balance." % (account_number,))
+                continue
+            credit_amount = credit_amounts[account_number]
+            params = {
+                'credit_amount': credit_amount,
+                'account_number': account_number,
+            }
+            cursor = yield cursor.execute(query, params)
+            account = yield cursor.fetchone()
+            if account is None:
+                raise BillingError(
+                    "Unable to find billing account %s while updating"
+                    " credit balance." % (account_number,))
+            credit_balance = account['credit_balance']
+            if crossed_alert_balance(
+                    credit_balance + credit_amount, credit_balance,
+                    account['alert_credit_balance']):
+                alerts[account_number] = account
+
+        created = dict(existing)
+        for transaction in result:
+            created[self._transaction_key(transaction)] = transaction
+        defer.returnValue(([
+            created[self._transaction_key(transaction)]
+            for transaction in all_transactions], alerts))
+
+    @defer.inlineCallbacks
+    def create_transaction_batch(self, transactions):
+        """Create transactions for a list of messages in a single database
+        transaction.
+        """
+        result, alerts = yield self._connection_pool.runInteraction(
+            self.create_transaction_batch_interaction, transactions)
+
+        for account_number in sorted(alerts):
+            yield self._raise_low_credit_alert(
+                account_number, alerts[account_number])
         defer.returnValue(result)
 
 
 class Root(BaseResource):
     """The root resource"""
 
-    def __init__(self, connection_pool):
+    def __init__(self, connection_pool, cost_cache=None, balances=None,
+                 alerts=None):
         BaseResource.__init__(self, connection_pool)
+        if cost_cache is None:
+            cost_cache = MessageCostCache(app_settings.COST_CACHE_TTL)
+        self.cost_cache = cost_cache
+        self.balances = balances
+        self.alerts = alerts
         self.putChild('users', UserResource(connection_pool))
-        self.putChild('accounts', AccountResource(connection_pool))
-        self.putChild('costs', CostResource(connection_pool))
-        self.putChild('transactions', TransactionResource(connection_pool))
+        self.putChild('accounts', AccountResource(connection_pool, balances))
+        self.putChild('costs', CostResource(connection_pool, cost_cache))
+        self.putChild('transactions', TransactionResource(
+            connection_pool, cost_cache, balances, alerts))
 
     def getChild(self, name, request):
         if name == '':
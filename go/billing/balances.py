@@ -0,0 +1,229 @@
+# -*- test-case-name: go.billing.tests.test_balances -*-
+
+"""Running account credit balances kept as unapplied transactions."""
+
+from decimal import Decimal
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+
+from go.billing.alerts import crossed_alert_balance
+
+
+class RunningBalances(object):
+    """Changes to account credit balances that haven't been applied to the
+    ``billing_account`` table yet.
+
+    With running balances, transactions are inserted with
+    ``balance_applied`` set to false instead of updating the account's
+    credit balance, so transactions for the same account never wait on its
+    row lock. An account's pending change is the total of its unapplied
+    transactions. Since it is stored with the transactions themselves, it
+    is committed or rolled back with them.
+
+    :param connection_pool:
+        Database connection pool.
+    """
+
+    def __init__(self, connection_pool):
+        self._connection_pool = connection_pool
+        self._known_accounts = set()
+
+    @defer.inlineCallbacks
+    def account_exists_interaction(self, cursor, account_number):
+        """Return whether there is a billing account for ``account_number``.
+
+        Accounts that exist are remembered, so only the first transaction
+        for each account reads the ``billing_account`` table. An account
+        that is deleted while the billing server is running is still taken
+        to exist, and its transactions are left unapplied by the
+        reconciler.
+
+        """
+        if account_number in self._known_accounts:
+            defer.returnValue(True)
+        query = """
+            SELECT 1 FROM billing_account
+            WHERE account_number = %(account_number)s
+        """
+        cursor = yield cursor.execute(
+            query, {'account_number': account_number})
+        result = yield cursor.fetchone()
+        if result is None:
+            defer.returnValue(False)
+        self._known_accounts.add(account_number)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def get_deltas(self, account_numbers=None):
+        """Return a dict mapping account numbers to their pending changes.
+
+        Only accounts with pending changes are included. If
+        ``account_numbers`` is given, only those accounts are looked up.
+
+        """
+        query = """
+            SELECT account_number, SUM(credit_amount) AS credit_amount
+            FROM billing_transaction
+            WHERE NOT balance_applied
+        """
+
+        params = {}
+        if account_numbers is not None:
+            query += " AND account_number = ANY(%(account_numbers)s)"
+            params['account_numbers'] = list(account_numbers)
+        query += " GROUP BY account_number"
+
+        result = yield self._connection_pool.runQuery(query, params)
+        defer.returnValue(dict(
+            (row['account_number'], row['credit_amount'])
+            for row in result))
+
+    @defer.inlineCallbacks
+    def get_delta(self, account_number):
+        """Return the pending change for ``account_number``."""
+        deltas = yield self.get_deltas([account_number])
+        defer.returnValue(deltas.get(account_number, Decimal('0.0')))
+
+
+class BalanceReconciler(object):
+    """Folds the pending changes in a :class:`RunningBalances` into the
+    credit balances in the ``billing_account`` table.
+
+    Each run marks the unapplied transactions as applied and adds their
+    totals to the accounts' credit balances in a single statement, so a
+    transaction is applied exactly once even if the reconciler stops part
+    way through a run. Transactions created during a run are left for the
+    next one.
+
+    Since this is where the running balances reach the accounts, it is also
+    where low credit alerts are raised for them.
+
+    Only one reconciler needs to be run. Runs take a Postgres advisory lock
+    and are skipped while another reconciler holds it.
+
+    :param connection_pool:
+        Database connection pool.
+    :param RunningBalances balances:
+        Running balances to reconcile.
+    :type alerts: :class:`go.billing.alerts.LowCreditAlerts`
+    :param alerts:
+        Queue to raise low credit alerts on, if any.
+    :param clock:
+        Object with a `callLater()` method for scheduling runs.
+    """
+
+    # Key of the advisory lock held while reconciling
+    LOCK_ID = 0x62616c61
+
+    def __init__(self, connection_pool, balances, alerts=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._connection_pool = connection_pool
+        self.balances = balances
+        self.alerts = alerts
+        self.clock = clock
+        self._looper = None
+
+    def start(self, interval):
+        """Reconcile the balances every ``interval`` seconds."""
+        self._looper = LoopingCall(self._reconcile_and_log)
+        self._looper.clock = self.clock
+        self._looper.start(interval, now=False)
+
+    def stop(self):
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        self._looper = None
+
+    def _reconcile_and_log(self):
+        d = self.reconcile()
+        d.addErrback(log.err, "Error reconciling credit balances.")
+        return d
+
+    @defer.inlineCallbacks
+    def reconcile(self):
+        """Apply all the pending changes to the accounts' credit balances.
+
+        Returns the number of accounts updated.
+
+        """
+        accounts = yield self._connection_pool.runInteraction(
+            self.reconcile_interaction)
+        if accounts is None:
+            log.msg("Credit balances are being reconciled elsewhere,"
+                    " skipping this run.")
+            defer.returnValue(0)
+
+        for account in accounts:
+            credit_balance = account['credit_balance']
+            alert_credit_balance = account['alert_credit_balance']
+            if self.alerts is not None and crossed_alert_balance(
+                    credit_balance - account['credit_amount'],
+                    credit_balance, alert_credit_balance):
+                yield self._raise_low_credit_alert(
+                    account['account_number'], credit_balance,
+                    alert_credit_balance)
+        defer.returnValue(len(accounts))
+
+    def _raise_low_credit_alert(self, account_number, credit_balance,
+                                alert_credit_balance):
+        """Raise a low credit alert for ``account_number``.
+
+        The changes have already been applied by this point, so errors are
+        logged rather than stopping the alerts for the other accounts.
+
+        """
+        d = self.alerts.push(
+            account_number, credit_balance, alert_credit_balance)
+        d.addErrback(log.err, "Error raising low credit alert for account"
+                     " %s." % (account_number,))
+        return d
+
+    @defer.inlineCallbacks
+    def reconcile_interaction(self, cursor):
+        """Apply the pending changes and return the new credit balance,
+        alert credit balance and applied change of each account updated.
+
+        Returns ``None`` without applying anything if another reconciler
+        holds the lock.
+
+        """
+        query = "SELECT pg_try_advisory_xact_lock(%(lock_id)s) AS locked"
+        cursor = yield cursor.execute(query, {'lock_id': self.LOCK_ID})
+        result = yield cursor.fetchone()
+        if not result['locked']:
+            defer.returnValue(None)
+
+        # Transactions for accounts that no longer exist are left
+        # unapplied so that they don't disappear from the balances.
+        query = """
+            WITH applied AS (
+                UPDATE billing_transaction
+                SET balance_applied = TRUE
+                WHERE NOT balance_applied
+                  AND account_number IN (
+                      SELECT account_number FROM billing_account)
+                RETURNING account_number, credit_amount
+            ), deltas AS (
+                SELECT account_number, SUM(credit_amount) AS credit_amount
+                FROM applied
+                GROUP BY account_number
+            )
+            UPDATE billing_account
+            SET credit_balance = billing_account.credit_balance
+                                 + deltas.credit_amount
+            FROM deltas
+            WHERE billing_account.account_number = deltas.account_number
+            RETURNING billing_account.account_number,
+                      billing_account.credit_balance,
+                      billing_account.alert_credit_balance,
+                      deltas.credit_amount
+        """
+
+        cursor = yield cursor.execute(query)
+        result = yield cursor.fetchall()
+        defer.returnValue(sorted(
+            result, key=lambda account: account['account_number']))
@@ -0,0 +1,315 @@
+import math
+import random
+import time
+from decimal import Decimal
+from optparse import make_option
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults)
+from twisted.internet.task import LoopingCall
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from go.billing import settings as app_settings
+from go.billing.models import (
+    Account, TagPool, MessageCost, Transaction, ArchivedTransaction,
+    TransactionRollup)
+from go.billing.utils import DictRowConnectionPool, BillingError
+from go.billing.management.commands.runbillingserver import make_root
+from go.vumitools.billing_worker import BillingApi
+
+
+def percentile(values, percent):
+    """Return the ``percent`` percentile of the sorted list ``values``
+    using the nearest-rank method, or ``None`` if there are no values.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def make_transactions(count, account_numbers, tag_pool_names, session_ratio,
+                      message_id_prefix, rng):
+    """Return ``count`` transactions spread randomly over the given accounts,
+    tag pools and message directions, with a ``session_ratio`` fraction of
+    them creating sessions.
+    """
+    directions = [
+        MessageCost.DIRECTION_INBOUND, MessageCost.DIRECTION_OUTBOUND]
+    return [{
+        'account_number': rng.choice(account_numbers),
+        'message_id': "%s%d" % (message_id_prefix, i),
+        'tag_pool_name': rng.choice(tag_pool_names),
+        'tag_name': "loadtest",
+        'message_direction': rng.choice(directions),
+        'session_created': rng.random() < session_ratio,
+    } for i in xrange(count)]
+
+
+class LoadTestResults(object):
+    """Latencies and errors of the transactions created during a load test.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.lock_wait = 0.0
+
+    def add_latency(self, latency):
+        self.latencies.append(latency)
+
+    def add_error(self):
+        self.errors += 1
+
+    def report(self):
+        """Return the results as a list of lines of text."""
+        latencies = sorted(self.latencies)
+        lines = [
+            "Transactions:     %d (%d errors)" % (
+                len(latencies) + self.errors, self.errors),
+            "Elapsed:          %.2fs" % (self.elapsed,),
+        ]
+        if self.elapsed > 0:
+            lines.append("Transactions/sec: %.1f" % (
+                len(latencies) / self.elapsed,))
+        for percent in (50, 95, 99):
+            latency = percentile(latencies, percent)
+            if latency is not None:
+                lines.append("p%d latency:      %.1fms" % (
+                    percent, latency * 1000))
+        lines.append("Lock wait:        %.2fs" % (self.lock_wait,))
+        return lines
+
+
+class LockWaitSampler(object):
+    """Estimates the time spent waiting on locks in the billing database.
+
+    Every ``interval`` seconds the lock requests that haven't been granted
+    yet are counted, and each is taken to have been waiting since the
+    previous sample.
+    """
+
+    QUERY = "SELECT COUNT(*) AS waiting FROM pg_locks WHERE NOT granted"
+
+    def __init__(self, connection_pool, interval=0.1, clock=None):
+        if clock is None:
+            clock = reactor
+        self._connection_pool = connection_pool
+        self.interval = interval
+        self.clock = clock
+        self.lock_wait = 0.0
+        self._last_sample = None
+        self._looper = None
+
+    def start(self):
+        self._last_sample = self.clock.seconds()
+        self._looper = LoopingCall(self.sample)
+        self._looper.clock = self.clock
+        self._looper.start(self.interval, now=False)
+
+    def stop(self):
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        self._looper = None
+
+    @inlineCallbacks
+    def sample(self):
+        [row] = yield self._connection_pool.runQuery(self.QUERY)
+        now = self.clock.seconds()
+        self.lock_wait += row['waiting'] * (now - self._last_sample)
+        self._last_sample = now
+
+
+class Command(BaseCommand):
+    """Custom Django management command to load test the billing server"""
+
+    help = (
+        "Serves the billing API from this process against the configured"
+        " billing database, creates transactions through it and reports"
+        " latency percentiles, transactions per second and time spent waiting"
+        " on database locks. The transactions are created for billing"
+        " accounts and tag pools made for the load test, which are deleted"
+        " with their transactions afterwards. Low credit alerts are not"
+        " raised during the load test.")
+
+    # Prefix of the names of everything the load test creates
+    PREFIX = "loadtest-"
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--transactions', type='int', dest='transactions', default=10000,
+            help="Number of transactions to create. Defaults to 10000."),
+        make_option(
+            '--concurrency', type='int', dest='concurrency', default=20,
+            help="Number of requests in flight at once. Defaults to 20."),
+        make_option(
+            '--accounts', type='int', dest='accounts', default=10,
+            help=("Number of billing accounts to spread the transactions"
+                  " over. Defaults to 10.")),
+        make_option(
+            '--tagpools', type='int', dest='tagpools', default=2,
+            help=("Number of tag pools to spread the transactions over."
+                  " Defaults to 2.")),
+        make_option(
+            '--session-ratio', type='float', dest='session_ratio',
+            default=0.1,
+            help=("Fraction of transactions that create a session."
+                  " Defaults to 0.1.")),
+        make_option(
+            '--seed', type='int', dest='seed', default=None,
+            help="Seed for the random mix of transactions."),
+        make_option(
+            '--keep', action='store_true', dest='keep', default=False,
+            help=("Keep the accounts, tag pools and transactions created.")),
+        make_option(
+            '--cleanup', action='store_true', dest='cleanup', default=False,
+            help=("Delete the accounts, tag pools and transactions left"
+                  " behind by earlier load tests and exit.")),
+    )
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            self.remove_fixtures(self.PREFIX)
+            self.stdout.write("Removed the data left by earlier load tests.")
+            return
+
+        users = get_user_model().objects.order_by('id')[:1]
+        if not users:
+            raise CommandError(
+                "No user to own the load test's billing accounts.")
+
+        prefix = "%s%d-" % (self.PREFIX, time.time())
+        account_numbers, tag_pool_names = self.create_fixtures(
+            prefix, users[0], options['accounts'], options['tagpools'])
+
+        failures = []
+        try:
+            transactions = make_transactions(
+                options['transactions'], account_numbers, tag_pool_names,
+                options['session_ratio'], prefix,
+                random.Random(options['seed']))
+
+            def run():
+                d = self.run_load_test(transactions, options['concurrency'])
+                d.addErrback(failures.append)
+                d.addBoth(lambda _: reactor.stop())
+
+            reactor.callWhenRunning(run)
+            reactor.run()
+        finally:
+            if not options['keep']:
+                self.remove_fixtures(prefix)
+
+        if failures:
+            raise CommandError(failures[0].getTraceback())
+
+    def create_fixtures(self, prefix, user, accounts, tagpools):
+        """Create ``accounts`` billing accounts owned by ``user`` and
+        ``tagpools`` tag pools with message costs, all named with
+        ``prefix``. Return the account numbers and tag pool names.
+
+        The accounts have enough credit that the load test can't take them
+        below their alert credit balance.
+        """
+        account_numbers = []
+        for i in xrange(accounts):
+            account = Account.objects.create(
+                user=user, account_number="%saccount-%d" % (prefix, i),
+                description="Load test account",
+                credit_balance=Decimal('1000000000.0'))
+            account_numbers.append(account.account_number)
+
+        tag_pool_names = []
+        for i in xrange(tagpools):
+            tag_pool = TagPool.objects.create(
+                name="%spool-%d" % (prefix, i),
+                description="Load test tag pool")
+            for direction in (MessageCost.DIRECTION_INBOUND,
+                              MessageCost.DIRECTION_OUTBOUND):
+                MessageCost.objects.create(
+                    tag_pool=tag_pool, message_direction=direction,
+                    message_cost=Decimal('1.0'),
+                    session_cost=Decimal('0.5'),
+                    markup_percent=Decimal('10.0'))
+            tag_pool_names.append(tag_pool.name)
+
+        return account_numbers, tag_pool_names
+
+    def remove_fixtures(self, prefix):
+        """Delete the accounts, tag pools and message costs named with
+        ``prefix``, and the transactions and rollups for the accounts.
+        """
+        for model in (Transaction, ArchivedTransaction, TransactionRollup):
+            model.objects.filter(account_number__startswith=prefix).delete()
+        MessageCost.objects.filter(tag_pool__name__startswith=prefix).delete()
+        TagPool.objects.filter(name__startswith=prefix).delete()
+        Account.objects.filter(account_number__startswith=prefix).delete()
+
+    @inlineCallbacks
+    def run_load_test(self, transactions, concurrency):
+        connection_string = app_settings.get_connection_string()
+        connection_pool = DictRowConnectionPool(
+            None, connection_string, min=app_settings.API_MIN_CONNECTIONS)
+        sampler_pool = DictRowConnectionPool(None, connection_string, min=1)
+        yield connection_pool.start()
+        yield sampler_pool.start()
+
+        root, _reconciler = yield make_root(
+            connection_pool, low_credit_alerts=False)
+        site = Site(root)
+        site.noisy = False
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+
+        http_pool = HTTPConnectionPool(reactor, persistent=True)
+        http_pool.maxPersistentPerHost = concurrency
+        billing_api = BillingApi(
+            "http://127.0.0.1:%d/" % (port.getHost().port,), pool=http_pool)
+
+        sampler = LockWaitSampler(sampler_pool)
+        try:
+            self.stdout.write(
+                "Creating %d transactions with %d requests in flight..." % (
+                    len(transactions), concurrency))
+            sampler.start()
+            results = yield self.create_transactions(
+                billing_api, transactions, concurrency)
+        finally:
+            sampler.stop()
+            yield billing_api.close()
+            yield port.stopListening()
+            sampler_pool.close()
+            connection_pool.close()
+
+        results.lock_wait = sampler.lock_wait
+        for line in results.report():
+            self.stdout.write(line)
+
+    @inlineCallbacks
+    def create_transactions(self, billing_api, transactions, concurrency):
+        """Create ``transactions`` with ``concurrency`` requests in flight
+        and return the :class:`LoadTestResults`.
+        """
+        results = LoadTestResults()
+        pending = iter(transactions)
+
+        @inlineCallbacks
+        def worker():
+            for transaction in pending:
+                start = time.time()
+                try:
+                    yield billing_api.create_transaction(**transaction)
+                except BillingError:
+                    results.add_error()
+                else:
+                    results.add_latency(time.time() - start)
+
+        start = time.time()
+        yield gatherResults([worker() for _ in xrange(concurrency)])
+        results.elapsed = time.time() - start
+        returnValue(results)
@@ -0,0 +1,46 @@
+from datetime import date
+from optparse import make_option
+
+from dateutil.relativedelta import relativedelta
+from iso8601 import parse_date
+
+from go.billing.models import Transaction
+from go.billing.tasks import rollup_transactions
+from go.base.command_utils import BaseGoCommand
+
+
+class Command(BaseGoCommand):
+    help = (
+        "Create the daily transaction rollups that billing statements are"
+        " generated from for a range of days.")
+
+    option_list = BaseGoCommand.option_list + (
+        make_option(
+            '--from', dest='from_date',
+            help=("First day to roll up in iso8601 format. Defaults to the"
+                  " day of the earliest transaction.")),
+        make_option(
+            '--to', dest='to_date',
+            help=("Last day to roll up in iso8601 format. Defaults to"
+                  " yesterday.")))
+
+    def handle(self, *args, **opts):
+        if opts['from_date']:
+            from_date = parse_date(opts['from_date']).date()
+        else:
+            transactions = Transaction.objects.order_by('created')[:1]
+            if not transactions:
+                self.stdout.write("No transactions to roll up.")
+                return
+            from_date = transactions[0].created.date()
+
+        if opts['to_date']:
+            to_date = parse_date(opts['to_date']).date()
+        else:
+            to_date = date.today() - relativedelta(days=1)
+
+        day = from_date
+        while day <= to_date:
+            count = rollup_transactions(day)
+            self.stdout.write("%s: %d rollups" % (day, count))
+            day += relativedelta(days=1)
@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from django.core.management.base import CommandError
+from django.db.models import Sum
+
+from go.billing.models import Account, Transaction, ArchivedTransaction
+from go.base.command_utils import BaseGoCommand
+
+
+class Command(BaseGoCommand):
+    help = (
+        "Check that the credit balance of each billing account, including "
+        "any transactions not yet applied by the balance reconciler, "
+        "matches the total of the account's transactions, including "
+        "archived transactions.")
+
+    args = "[account_number ...]"
+
+    def handle(self, *args, **opts):
+        deltas = dict(
+            (totals['account_number'], totals['total'])
+            for totals in Transaction.objects.filter(
+                balance_applied=False).values('account_number').annotate(
+                    total=Sum('credit_amount')))
+
+        accounts = Account.objects.all().order_by('account_number')
+        if args:
+            accounts = accounts.filter(account_number__in=args)
+
+        mismatches = 0
+        for account in accounts:
+            pending = deltas.get(account.account_number, Decimal('0.0'))
+            total = Decimal('0.0')
+            for model in (Transaction, ArchivedTransaction):
+                total += model.objects.filter(
+                    account_number=account.account_number).aggregate(
+                        total=Sum('credit_amount'))['total'] or 0
+            balance = account.credit_balance + pending
+            if balance == total:
+                status = "OK"
+            else:
+                status = "MISMATCH"
+                mismatches += 1
+            self.stdout.write(
+                "%s: balance %s (pending %s), transactions %s [%s]" % (
+                    account.account_number, balance, pending, total, status))
+
+        if mismatches:
+            raise CommandError(
+                "%d account(s) have balances that don't match their"
+                " transactions." % (mismatches,))
@@ -1,27 +1,74 @@
 import sys
+from optparse import make_option
 
 from twisted.python import log
 from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.endpoints import serverFromString
 
+from vumi.persist.txredis_manager import TxRedisManager
+
 from django.core.management.base import BaseCommand
 
 from go.billing import settings as app_settings
 from go.billing.utils import DictRowConnectionPool
+from go.billing.alerts import LowCreditAlerts
+from go.billing.balances import RunningBalances, BalanceReconciler
 from go.billing import api
 
 
+@inlineCallbacks
+def make_root(connection_pool, low_credit_alerts=None):
+    """Return the billing API's root resource, with running balances and low
+    credit alerts set up as configured, and the reconciler for the running
+    balances, or ``None`` if they aren't used.
+
+    Low credit alerts are only raised if ``low_credit_alerts`` is true, or
+    if it is ``None`` and they are enabled in the settings.
+    """
+    if low_credit_alerts is None:
+        low_credit_alerts = app_settings.LOW_CREDIT_ALERTS
+    balances = None
+    alerts = None
+    reconciler = None
+    if low_credit_alerts:
+        redis = yield TxRedisManager.from_config(
+            app_settings.get_redis_config())
+        alerts = LowCreditAlerts(redis.sub_manager('billing_alerts'))
+    if app_settings.RUNNING_BALANCES:
+        balances = RunningBalances(connection_pool)
+        reconciler = BalanceReconciler(connection_pool, balances, alerts)
+
+    root = api.Root(connection_pool, balances=balances, alerts=alerts)
+    returnValue((root, reconciler))
+
+
 class Command(BaseCommand):
     """Custom Django management command to start the billing server"""
 
     help = "Starts the billing server"
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--reconcile-balances', action='store_true',
+            dest='reconcile_balances', default=False,
+            help="Also reconcile the running balances, if they are used."
+                 " Only one billing server needs to do this."),
+    )
+
     def handle(self, *args, **options):
         """Run the Billing server"""
 
+        @inlineCallbacks
         def connection_established(connection_pool):
             from twisted.web.server import Site
-            root = api.Root(connection_pool)
+            root, reconciler = yield make_root(connection_pool)
+            if reconciler is not None and options['reconcile_balances']:
+                reconciler.start(app_settings.RECONCILE_INTERVAL)
+            if app_settings.COST_CACHE_LOG_INTERVAL > 0:
+                root.cost_cache.start_logging(
+                    app_settings.COST_CACHE_LOG_INTERVAL)
+
             site = Site(root)
             endpoint = serverFromString(
                 reactor, app_settings.ENDPOINT_DESCRIPTION_STRING)
@@ -0,0 +1,126 @@
+import random
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from go.base.tests.helpers import (
+    GoDjangoTestCase, DjangoVumiApiHelper, CommandIO)
+from go.billing.models import Account, TagPool, MessageCost, Transaction
+from go.billing.tests.helpers import mk_transaction
+from go.billing.management.commands.benchbillingserver import (
+    percentile, make_transactions, LoadTestResults, LockWaitSampler,
+    Command)
+
+
+class FakeConnectionPool(object):
+    def __init__(self):
+        self.waiting = 0
+
+    def runQuery(self, query, params=None):
+        return succeed([{'waiting': self.waiting}])
+
+
+class TestBenchBillingServer(GoDjangoTestCase):
+
+    def run_command(self, **options):
+        cmd = CommandIO()
+        call_command(
+            'benchbillingserver',
+            stdout=cmd.stdout,
+            stderr=cmd.stderr,
+            **options)
+        return cmd
+
+    def test_no_user(self):
+        self.assertRaises(CommandError, self.run_command)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([], 50), None)
+
+    def test_make_transactions(self):
+        transactions = make_transactions(
+            100, ['acc1', 'acc2'], ['pool1'], 0.25, 'loadtest-1-',
+            random.Random(0))
+        self.assertEqual(len(transactions), 100)
+        self.assertEqual(transactions[0]['message_id'], 'loadtest-1-0')
+        self.assertEqual(
+            set(t['account_number'] for t in transactions),
+            set(['acc1', 'acc2']))
+        self.assertEqual(
+            set(t['tag_pool_name'] for t in transactions), set(['pool1']))
+        self.assertEqual(
+            set(t['message_direction'] for t in transactions),
+            set(['Inbound', 'Outbound']))
+        sessions = [t for t in transactions if t['session_created']]
+        self.assertTrue(0 < len(sessions) < 50)
+
+    def test_report(self):
+        results = LoadTestResults()
+        for i in range(1, 101):
+            results.add_latency(i / 1000.0)
+        results.add_error()
+        results.elapsed = 2.0
+        results.lock_wait = 0.5
+        self.assertEqual(results.report(), [
+            "Transactions:     101 (1 errors)",
+            "Elapsed:          2.00s",
+            "Transactions/sec: 50.0",
+            "p50 latency:      50.0ms",
+            "p95 latency:      95.0ms",
+            "p99 latency:      99.0ms",
+            "Lock wait:        0.50s",
+        ])
+
+    def test_lock_wait_sampler(self):
+        connection_pool = FakeConnectionPool()
+        clock = Clock()
+        sampler = LockWaitSampler(connection_pool, interval=0.5, clock=clock)
+        sampler.start()
+        clock.advance(0.5)
+        connection_pool.waiting = 2
+        clock.advance(0.5)
+        clock.advance(0.5)
+        sampler.stop()
+        self.assertEqual(sampler.lock_wait, 2.0)
+
+
+class TestBenchBillingServerFixtures(GoDjangoTestCase):
+
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+        self.user = self.user_helper.get_django_user()
+        self.account = Account.objects.get(user=self.user)
+
+    def test_create_and_remove_fixtures(self):
+        command = Command()
+        account_numbers, tag_pool_names = command.create_fixtures(
+            "loadtest-1-", self.user, 2, 1)
+        self.assertEqual(
+            account_numbers, ["loadtest-1-account-0", "loadtest-1-account-1"])
+        self.assertEqual(tag_pool_names, ["loadtest-1-pool-0"])
+        self.assertEqual(
+            MessageCost.objects.filter(
+                tag_pool__name="loadtest-1-pool-0").count(), 2)
+
+        account = Account.objects.get(account_number="loadtest-1-account-0")
+        mk_transaction(account)
+        mk_transaction(self.account)
+
+        command.remove_fixtures("loadtest-")
+        self.assertEqual(
+            [a.account_number for a in Account.objects.all()],
+            [self.account.account_number])
+        self.assertEqual(TagPool.objects.count(), 0)
+        self.assertEqual(MessageCost.objects.count(), 0)
+        [transaction] = Transaction.objects.all()
+        self.assertEqual(
+            transaction.account_number, self.account.account_number)
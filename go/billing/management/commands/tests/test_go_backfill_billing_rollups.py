@@ -0,0 +1,67 @@
+from datetime import date, datetime
+
+from dateutil.relativedelta import relativedelta
+
+from django.core.management import call_command
+
+from go.base.tests.helpers import (
+    GoDjangoTestCase, DjangoVumiApiHelper, CommandIO)
+from go.billing.models import Account, Transaction, TransactionRollup
+from go.billing.tests.helpers import mk_transaction
+
+
+class TestBackfillBillingRollups(GoDjangoTestCase):
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+
+        user = self.user_helper.get_django_user()
+        account_number = user.get_profile().user_account
+        self.account = Account.objects.get(account_number=account_number)
+
+    def run_command(self, **kw):
+        cmd = CommandIO()
+        call_command(
+            'go_backfill_billing_rollups',
+            stdout=cmd.stdout,
+            stderr=cmd.stderr,
+            **kw)
+        return cmd
+
+    def mk_transaction(self, days_ago):
+        transaction = mk_transaction(self.account)
+        created = datetime.now() - relativedelta(days=days_ago)
+        Transaction.objects.filter(id=transaction.id).update(created=created)
+
+    def test_backfill(self):
+        self.mk_transaction(days_ago=3)
+        self.mk_transaction(days_ago=1)
+        self.mk_transaction(days_ago=0)
+
+        cmd = self.run_command()
+        today = date.today()
+        self.assertEqual(cmd.stdout.getvalue().splitlines(), [
+            "%s: 1 rollups" % (today - relativedelta(days=3),),
+            "%s: 0 rollups" % (today - relativedelta(days=2),),
+            "%s: 1 rollups" % (today - relativedelta(days=1),),
+        ])
+        self.assertEqual(
+            sorted(rollup.day for rollup in TransactionRollup.objects.all()),
+            [today - relativedelta(days=3), today - relativedelta(days=1)])
+
+    def test_backfill_range(self):
+        self.mk_transaction(days_ago=3)
+        self.mk_transaction(days_ago=1)
+
+        day = date.today() - relativedelta(days=1)
+        cmd = self.run_command(from_date=day.isoformat(),
+                               to_date=day.isoformat())
+        self.assertEqual(cmd.stdout.getvalue().splitlines(), [
+            "%s: 1 rollups" % (day,),
+        ])
+
+    def test_backfill_no_transactions(self):
+        cmd = self.run_command()
+        self.assertEqual(
+            cmd.stdout.getvalue().splitlines(),
+            ["No transactions to roll up."])
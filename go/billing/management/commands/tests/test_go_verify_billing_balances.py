@@ -0,0 +1,52 @@
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from go.base.tests.helpers import (
+    GoDjangoTestCase, DjangoVumiApiHelper, CommandIO)
+from go.billing.models import Account
+from go.billing.tests.helpers import mk_transaction
+
+
+class TestVerifyBillingBalances(GoDjangoTestCase):
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+
+        user = self.user_helper.get_django_user()
+        account_number = user.get_profile().user_account
+        self.account = Account.objects.get(account_number=account_number)
+
+    def run_command(self, *args):
+        cmd = CommandIO()
+        call_command(
+            'go_verify_billing_balances', *args,
+            stdout=cmd.stdout,
+            stderr=cmd.stderr)
+        return cmd
+
+    def test_balances_match(self):
+        mk_transaction(self.account, credit_amount=Decimal('100.0'))
+        mk_transaction(self.account, credit_amount=Decimal('-5.5'))
+        mk_transaction(
+            self.account, credit_amount=Decimal('-1.5'),
+            balance_applied=False)
+        self.account.credit_balance = Decimal('94.5')
+        self.account.save()
+
+        cmd = self.run_command()
+        [line] = cmd.stdout.getvalue().splitlines()
+        self.assertTrue(line.startswith(self.account.account_number))
+        self.assertTrue(line.endswith("[OK]"))
+
+    def test_balances_mismatch(self):
+        mk_transaction(self.account, credit_amount=Decimal('100.0'))
+        self.account.credit_balance = Decimal('94.5')
+        self.account.save()
+
+        self.assertRaises(CommandError, self.run_command)
+
+    def test_unknown_account(self):
+        cmd = self.run_command('unknown')
+        self.assertEqual(cmd.stdout.getvalue(), "")
@@ -183,8 +183,15 @@ class MessageCost(models.Model):
         return u"%s (%s)" % (self.tag_pool, self.message_direction)
 
 
-class Transaction(models.Model):
-    """Represents a credit transaction"""
+class BaseTransaction(models.Model):
+    """Fields shared by credit transactions and archived transactions"""
+
+    class Meta:
+        abstract = True
+
+        index_together = [
+            ['account_number', 'created', 'id'],
+        ]
 
     STATUS_PENDING = 'Pending'
     STATUS_COMPLETED = 'Completed'
@@ -217,7 +224,7 @@ class Transaction(models.Model):
                     "there is no associated message)."))
 
     message_id = models.CharField(
-        max_length=64, null=True, blank=True,
+        max_length=64, null=True, blank=True, db_index=True,
         help_text=_("Vumi message identifier for the message being"
                     " billed (or null if there is no associated message)"))
 
@@ -252,13 +259,20 @@ class Transaction(models.Model):
         help_text=_("The number of credits this transaction adds or "
                     "subtracts."))
 
+    balance_applied = models.BooleanField(
+        default=True,
+        help_text=_("Whether credit_amount has been added to the account's"
+                    " credit balance. With running balances, this is done"
+                    " by the balance reconciler after the transaction is"
+                    " created."))
+
     status = models.CharField(
         max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING,
         help_text=_("The status of this transaction. One of pending, "
                     "completed, failed or reversed."))
 
     created = models.DateTimeField(
-        auto_now_add=True,
+        auto_now_add=True, db_index=True,
         help_text=_("When this transaction was created."))
 
     last_modified = models.DateTimeField(
@@ -269,6 +283,106 @@ class Transaction(models.Model):
         return unicode(self.pk)
 
 
+class Transaction(BaseTransaction):
+    """Represents a credit transaction"""
+
+    class Meta(BaseTransaction.Meta):
+        # A message is only billed once. Transactions without a message,
+        # such as credit loads, have a null message_id and aren't affected.
+        unique_together = [
+            ['account_number', 'message_id', 'message_direction'],
+        ]
+
+
+class ArchivedTransaction(BaseTransaction):
+    """A credit transaction that has been moved out of the transactions
+    table by the ``archive_transactions`` task.
+    """
+
+
+class TransactionRollup(models.Model):
+    """Totals of an account's transactions for a single day.
+
+    There is one rollup for each distinct tag pool, tag, message direction,
+    message cost, session cost and markup percentage in the account's
+    transactions for the day, so that statements can be built from the
+    rollups instead of the transactions themselves.
+
+    """
+
+    class Meta:
+        index_together = [
+            ['account_number', 'day'],
+        ]
+
+    account_number = models.CharField(
+        max_length=100,
+        help_text=_("Account number the transactions are associated with."))
+
+    day = models.DateField(
+        help_text=_("The day the transactions were created on."))
+
+    tag_pool_name = models.CharField(
+        max_length=100, blank=True,
+        help_text=_("The tag pool of the messages billed."))
+
+    tag_name = models.CharField(
+        max_length=100, blank=True,
+        help_text=_("The tag of the messages billed."))
+
+    message_direction = models.CharField(
+        max_length=20, blank=True,
+        help_text=_("The direction of the messages billed."))
+
+    message_cost = models.DecimalField(
+        null=True, max_digits=10, decimal_places=3,
+        help_text=_("The message cost (in cents) of each transaction."))
+
+    session_cost = models.DecimalField(
+        null=True, max_digits=10, decimal_places=3,
+        help_text=_("The session cost (in cents) of each transaction."))
+
+    markup_percent = models.DecimalField(
+        max_digits=10, decimal_places=2, blank=True, null=True,
+        help_text=_("The markup percentage of each transaction."))
+
+    message_count = models.IntegerField(
+        default=0,
+        help_text=_("Number of transactions."))
+
+    message_total_cost = models.DecimalField(
+        max_digits=20, decimal_places=6, blank=True, null=True,
+        help_text=_("Total message cost (in cents) of the transactions."))
+
+    session_count = models.IntegerField(
+        default=0,
+        help_text=_("Number of transactions that created sessions."))
+
+    session_total_cost = models.DecimalField(
+        max_digits=20, decimal_places=6, blank=True, null=True,
+        help_text=_("Total session cost (in cents) of the transactions that"
+                    " created sessions."))
+
+    def __unicode__(self):
+        return u"%s on %s" % (self.account_number, self.day)
+
+
+class TransactionRollupDay(models.Model):
+    """A day whose transactions have been rolled up for all accounts.
+
+    Rollups only exist for days with transactions, so this is what tells a
+    day without transactions apart from a day that hasn't been rolled up.
+
+    """
+
+    day = models.DateField(
+        unique=True,
+        help_text=_("The day the transactions were created on."))
+
+    def __unicode__(self):
+        return unicode(self.day)
+
+
 class Statement(models.Model):
     """Account statement for a period of time"""
 
@@ -24,10 +24,40 @@ if hasattr(settings, 'BILLING_QUANTIZATION_EXPONENT'):
 
 API_MIN_CONNECTIONS = getattr(settings, 'BILLING_API_MIN_CONNECTIONS', 10)
 
+# Number of seconds the billing API caches message costs for
+COST_CACHE_TTL = getattr(settings, 'BILLING_COST_CACHE_TTL', 60)
+
+# Number of seconds between logging the message cost cache's hits and
+# misses. Set to zero to not log them.
+COST_CACHE_LOG_INTERVAL = getattr(
+    settings, 'BILLING_COST_CACHE_LOG_INTERVAL', 300)
+
+# Leave transactions unapplied and have the balance reconciler add them to
+# the account credit balances, instead of updating the account for every
+# transaction
+RUNNING_BALANCES = getattr(settings, 'BILLING_RUNNING_BALANCES', False)
+
+# Number of seconds between folding the running balances into the accounts.
+# The reconciler runs in billing servers started with --reconcile-balances.
+RECONCILE_INTERVAL = getattr(settings, 'BILLING_RECONCILE_INTERVAL', 60)
+
+# Queue an alert in Redis when an account's credit balance goes below its
+# alert credit balance
+LOW_CREDIT_ALERTS = getattr(settings, 'BILLING_LOW_CREDIT_ALERTS', False)
+
 ENDPOINT_DESCRIPTION_STRING = getattr(
     settings, 'BILLING_ENDPOINT_DESCRIPTION_STRING',
     "tcp:9090:interface=127.0.0.1")
 
+# Number of whole months of transactions kept in the transactions table by
+# the archive_transactions task
+TRANSACTION_ARCHIVE_MONTHS = getattr(
+    settings, 'BILLING_TRANSACTION_ARCHIVE_MONTHS', 3)
+
+# Number of seconds a worker process reuses the tag pool metadata it loaded
+# for generating statements
+TAGPOOL_CACHE_TTL = getattr(settings, 'BILLING_TAGPOOL_CACHE_TTL', 600)
+
 MONTHLY_STATEMENT_TITLE = getattr(
     settings, 'BILLING_MONTHLY_STATEMENT_TITLE', "Monthly Statement")
 
@@ -52,6 +82,13 @@ def get_user_table():
    # return user_model._meta.db_table
 
 
+def get_redis_config():
+    """Return the config for the Redis manager used by the billing server"""
+    return getattr(
+        settings, 'BILLING_REDIS_MANAGER',
+        settings.VUMI_API_CONFIG.get('redis_manager', {}))
+
+
 def get_connection_string():
     """Return the database connection string"""
     db = settings.DATABASES['default']
@@ -1,58 +1,210 @@
-from datetime import date
+import time
+from datetime import date, datetime
 
 from dateutil.relativedelta import relativedelta
 
 from celery.task import task, group
 
+from django.db import connection
 from django.db.models import Sum, Count
+from django.db.transaction import commit_on_success
 
 from go.billing import settings
 from go.billing.models import (
-    Account, Transaction, MessageCost, Statement, LineItem)
+    Account, Transaction, ArchivedTransaction, TransactionRollup,
+    TransactionRollupDay, MessageCost, Statement, LineItem)
 from go.base.utils import vumi_api
+from go.vumitools.api import TagpoolSet
 
 
-def get_message_transactions(account, from_date, to_date):
-    transactions = Transaction.objects.filter(
+ROLLUP_FIELDS = (
+    'account_number',
+    'tag_pool_name',
+    'tag_name',
+    'message_direction',
+    'message_cost',
+    'session_cost',
+    'markup_percent')
+
+# The tag pools loaded by get_tagpools() and the time they were loaded at
+_tagpools_cache = {}
+
+
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def add_total(total, value):
+    if total is None:
+        return value
+    if value is None:
+        return total
+    return total + value
+
+
+def rollup_transactions(day, account_number=None):
+    """Replace the ``TransactionRollup``s for ``day`` with new ones
+       calculated from the transactions created on that day, for all
+       accounts or only for the account with the given ``account_number``.
+
+       Archived transactions are included, so a day can be rolled up again
+       after its transactions have been archived.
+
+       When all accounts are rolled up, the day is recorded as a
+       ``TransactionRollupDay``.
+    """
+    rollups = TransactionRollup.objects.filter(day=day)
+    if account_number is not None:
+        rollups = rollups.filter(account_number=account_number)
+
+    items = {}
+    for model in (Transaction, ArchivedTransaction):
+        transactions = model.objects.filter(
+            created__gte=day,
+            created__lt=(day + relativedelta(days=1)))
+
+        if account_number is not None:
+            transactions = transactions.filter(account_number=account_number)
+
+        messages = transactions.values(*ROLLUP_FIELDS).annotate(
+            count=Count('id'), total_cost=Sum('message_cost'))
+
+        sessions = transactions.filter(session_created=True)
+        sessions = sessions.values(*ROLLUP_FIELDS).annotate(
+            count=Count('id'), total_cost=Sum('session_cost'))
+
+        for totals in messages:
+            key = tuple(totals[field] for field in ROLLUP_FIELDS)
+            if key not in items:
+                items[key] = TransactionRollup(
+                    day=day, message_count=0,
+                    **dict(zip(ROLLUP_FIELDS, key)))
+            rollup = items[key]
+            rollup.message_count += totals['count']
+            rollup.message_total_cost = add_total(
+                rollup.message_total_cost, totals['total_cost'])
+
+        for totals in sessions:
+            key = tuple(totals[field] for field in ROLLUP_FIELDS)
+            rollup = items[key]
+            rollup.session_count += totals['count']
+            rollup.session_total_cost = add_total(
+                rollup.session_total_cost, totals['total_cost'])
+
+    with commit_on_success():
+        rollups.delete()
+        TransactionRollup.objects.bulk_create(items.values())
+        if account_number is None:
+            TransactionRollupDay.objects.get_or_create(day=day)
+
+    return len(items)
+
+
+def get_unrolled_days(from_date, to_date):
+    """Return the days between the given ``from_date`` and ``to_date``
+       that haven't been rolled up for all accounts.
+    """
+    rolled_up = set(TransactionRollupDay.objects.filter(
+        day__gte=from_date, day__lte=to_date).values_list('day', flat=True))
+
+    days = []
+    day = from_date
+    while day <= to_date:
+        if day not in rolled_up:
+            days.append(day)
+        day += relativedelta(days=1)
+    return days
+
+
+def rollup_period(from_date, to_date, account_number=None):
+    """Roll up the days between the given ``from_date`` and ``to_date``
+       that need it before a statement is built from their rollups.
+
+       Days that have ended are only rolled up if they haven't been rolled
+       up for all accounts. Today is always rolled up, since its
+       transactions are still being created.
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    today = date.today()
+    yesterday = today - relativedelta(days=1)
+    days = get_unrolled_days(from_date, min(to_date, yesterday))
+    if from_date <= today <= to_date:
+        days.append(today)
+
+    for day in days:
+        rollup_transactions(day, account_number)
+    return days
+
+
+def get_rollups(account, from_date, to_date):
+    """Return the ``TransactionRollup``s for the given ``account`` between
+       the given ``from_date`` and ``to_date``.
+
+       Rollups for days that have ended are created by the
+       ``rollup_daily_transactions`` task. Any days in the period that it
+       hasn't rolled up, for example because it failed, are rolled up for
+       the account here, along with today's transactions since they are
+       still being created.
+    """
+    rollup_period(from_date, to_date, account.account_number)
+
+    return TransactionRollup.objects.filter(
         account_number=account.account_number,
-        created__gte=from_date,
-        created__lt=(to_date + relativedelta(days=1)))
+        day__gte=as_date(from_date),
+        day__lte=as_date(to_date))
+
 
-    transactions = transactions.values(
+def get_message_transactions(rollups):
+    rollups = rollups.values(
         'tag_pool_name',
         'tag_name',
         'message_direction',
         'message_cost',
         'markup_percent')
 
-    transactions = transactions.annotate(
-        count=Count('id'), total_message_cost=Sum('message_cost'))
-
-    return transactions
-
+    return rollups.annotate(
+        count=Sum('message_count'),
+        total_message_cost=Sum('message_total_cost'))
 
-def get_session_transactions(account, from_date, to_date):
-    transactions = Transaction.objects.filter(
-        account_number=account.account_number,
-        created__gte=from_date,
-        created__lt=(to_date + relativedelta(days=1)))
 
-    transactions = transactions.filter(session_created=True)
+def get_session_transactions(rollups):
+    rollups = rollups.filter(session_count__gt=0)
 
-    transactions = transactions.values(
+    rollups = rollups.values(
         'tag_pool_name',
         'tag_name',
         'session_cost',
         'markup_percent')
 
-    transactions = transactions.annotate(
-        count=Count('id'), total_session_cost=Sum('session_cost'))
+    return rollups.annotate(
+        count=Sum('session_count'),
+        total_session_cost=Sum('session_total_cost'))
+
 
-    return transactions
+def get_tagpool_metadata():
+    """Return a dict mapping the names of all known tag pools to their
+       metadata.
+    """
+    api = vumi_api()
+    return dict(
+        (pool, api.tpm.get_metadata(pool)) for pool in api.tpm.list_pools())
 
 
-def get_tagpools(account):
-    return vumi_api().get_user_api(account.account_number).tagpools()
+def get_tagpools():
+    """Return a ``TagpoolSet`` for all known tag pools.
+
+       The tag pools are kept for ``settings.TAGPOOL_CACHE_TTL`` seconds, so
+       the statements generated by a worker process share a single load of
+       the tag pool metadata.
+    """
+    now = time.time()
+    loaded_at, tagpools = _tagpools_cache.get('tagpools', (None, None))
+    if loaded_at is None or now - loaded_at >= settings.TAGPOOL_CACHE_TTL:
+        tagpools = TagpoolSet(get_tagpool_metadata())
+        _tagpools_cache['tagpools'] = (now, tagpools)
+    return tagpools
 
 
 def get_provider_name(transaction, tagpools):
@@ -137,18 +289,16 @@ def make_session_item(statement, transaction, tagpools):
         description='Sessions')
 
 
-def make_message_items(account, statement, tagpools):
-    transactions = get_message_transactions(
-        account, statement.from_date, statement.to_date)
+def make_message_items(statement, rollups, tagpools):
+    transactions = get_message_transactions(rollups)
 
     return [
         make_message_item(statement, transaction, tagpools)
         for transaction in transactions]
 
 
-def make_session_items(account, statement, tagpools):
-    transactions = get_session_transactions(
-        account, statement.from_date, statement.to_date)
+def make_session_items(statement, rollups, tagpools):
+    transactions = get_session_transactions(rollups)
 
     return [
         make_session_item(statement, transaction, tagpools)
@@ -166,13 +316,59 @@ def make_account_fee_item(account, statement):
         description='Account Fee')
 
 
+@task()
+def rollup_daily_transactions(day=None):
+    """Roll up the transactions created on the given ``day`` (yesterday
+       by default) for all accounts.
+    """
+    if day is None:
+        day = date.today() - relativedelta(days=1)
+    return rollup_transactions(day)
+
+
+@task()
+def archive_transactions(before=None):
+    """Move the transactions created before the given ``before`` date to the
+       archive table. By default, the transactions before the start of the
+       month ``settings.TRANSACTION_ARCHIVE_MONTHS`` months ago are moved.
+
+       Statements are built from rollups, which include archived
+       transactions, so days can be rolled up before or after their
+       transactions are archived.
+    """
+    if before is None:
+        this_month = date.today().replace(day=1)
+        before = this_month - relativedelta(
+            months=settings.TRANSACTION_ARCHIVE_MONTHS)
+
+    columns = ", ".join(
+        connection.ops.quote_name(field.column)
+        for field in Transaction._meta.fields)
+
+    # Transactions that haven't been applied to the running balances yet
+    # are left for the balance reconciler to find.
+    with commit_on_success():
+        cursor = connection.cursor()
+        cursor.execute(
+            "INSERT INTO %s (%s) SELECT %s FROM %s"
+            " WHERE created < %%s AND balance_applied" % (
+                ArchivedTransaction._meta.db_table, columns, columns,
+                Transaction._meta.db_table),
+            [before])
+        cursor.execute(
+            "DELETE FROM %s WHERE created < %%s AND balance_applied" % (
+                Transaction._meta.db_table,),
+            [before])
+        return cursor.rowcount
+
+
 @task()
 def generate_monthly_statement(account_id, from_date, to_date):
     """Generate a new *Monthly* ``Statement`` for the given ``account``
        between the given ``from_date`` and ``to_date``.
     """
     account = Account.objects.get(id=account_id)
-    tagpools = get_tagpools(account)
+    tagpools = get_tagpools()
 
     statement = Statement(
         account=account,
@@ -183,9 +379,10 @@ def generate_monthly_statement(account_id, from_date, to_date):
 
     statement.save()
 
+    rollups = get_rollups(account, from_date, to_date)
     items = []
-    items.extend(make_message_items(account, statement, tagpools))
-    items.extend(make_session_items(account, statement, tagpools))
+    items.extend(make_message_items(statement, rollups, tagpools))
+    items.extend(make_session_items(statement, rollups, tagpools))
 
     statement.lineitem_set.bulk_create(items)
     return statement
@@ -200,6 +397,11 @@ def generate_monthly_account_statements():
     last_month = today - relativedelta(months=1)
     from_date = date(last_month.year, last_month.month, 1)
     to_date = date(today.year, today.month, 1) - relativedelta(days=1)
+
+    # The statements are built from daily rollups, so make sure every day
+    # of the month has been rolled up before they are generated.
+    rollup_period(from_date, to_date)
+
     account_list = Account.objects.exclude(
         statement__type=Statement.TYPE_MONTHLY,
         statement__from_date=from_date,
@@ -0,0 +1,59 @@
+from decimal import Decimal
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.billing.alerts import crossed_alert_balance, LowCreditAlerts
+
+
+class TestCrossedAlertBalance(VumiTestCase):
+
+    def test_crossed(self):
+        self.assertTrue(crossed_alert_balance(
+            Decimal('10.5'), Decimal('9.5'), Decimal('10.0')))
+        self.assertTrue(crossed_alert_balance(
+            Decimal('10.0'), Decimal('9.5'), Decimal('10.0')))
+
+    def test_not_crossed(self):
+        # Still above
+        self.assertFalse(crossed_alert_balance(
+            Decimal('11.0'), Decimal('10.0'), Decimal('10.0')))
+        # Already below
+        self.assertFalse(crossed_alert_balance(
+            Decimal('9.5'), Decimal('8.5'), Decimal('10.0')))
+        # Going up
+        self.assertFalse(crossed_alert_balance(
+            Decimal('9.5'), Decimal('10.5'), Decimal('10.0')))
+
+
+class TestLowCreditAlerts(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.alerts = LowCreditAlerts(self.redis, clock=self.clock)
+
+    @inlineCallbacks
+    def test_push_and_pop(self):
+        self.assertEqual((yield self.alerts.pop()), None)
+        yield self.alerts.push("12345", Decimal('9.5'), Decimal('10.0'))
+        self.clock.advance(5)
+        yield self.alerts.push("54321", Decimal('-0.5'), Decimal('0.0'))
+        self.assertEqual((yield self.alerts.depth()), 2)
+        self.assertEqual((yield self.alerts.pop()), {
+            "account_number": "12345",
+            "credit_balance": "9.5",
+            "alert_credit_balance": "10.0",
+            "raised_at": 0,
+        })
+        self.assertEqual((yield self.alerts.pop()), {
+            "account_number": "54321",
+            "credit_balance": "-0.5",
+            "alert_credit_balance": "0.0",
+            "raised_at": 5,
+        })
+        self.assertEqual((yield self.alerts.depth()), 0)
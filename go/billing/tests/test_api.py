@@ -3,12 +3,16 @@ import decimal
 
 import pytest
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.task import Clock
 
-from vumi.tests.helpers import VumiTestCase
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 
 from go.billing import settings as app_settings
 from go.billing import api
+from go.billing.alerts import LowCreditAlerts
+from go.billing.balances import RunningBalances, BalanceReconciler
 from go.billing.models import MessageCost
 from go.billing.utils import DummySite, DictRowConnectionPool, JSONDecoder
 
@@ -33,6 +37,112 @@ class ApiCallError(Exception):
         self.response = response
 
 
+class TestMessageCostCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.fetched = []
+
+    def fetch_cost(self, account_number, tag_pool_name, message_direction):
+        self.fetched.append(
+            (account_number, tag_pool_name, message_direction))
+        if tag_pool_name == 'unknown_pool':
+            return succeed(None)
+        return succeed({'message_cost': decimal.Decimal('0.5')})
+
+    def mk_cache(self, ttl=60):
+        return api.MessageCostCache(ttl, clock=self.clock)
+
+    @inlineCallbacks
+    def test_get(self):
+        cache = self.mk_cache()
+        key = ('12345', 'pool1', 'Inbound')
+        cost = yield cache.get(key, self.fetch_cost)
+        self.assertEqual(cost, {'message_cost': decimal.Decimal('0.5')})
+        cost['credit_amount'] = 5
+        cost = yield cache.get(key, self.fetch_cost)
+        self.assertEqual(cost, {'message_cost': decimal.Decimal('0.5')})
+        self.assertEqual(self.fetched, [key])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_log_stats(self):
+        cache = self.mk_cache()
+        key = ('12345', 'pool1', 'Inbound')
+        yield cache.get(key, self.fetch_cost)
+        yield cache.get(key, self.fetch_cost)
+        with LogCatcher() as lc:
+            cache.log_stats()
+        self.assertEqual(
+            lc.messages(), ["Message cost cache: 1 hits, 1 misses."])
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    @inlineCallbacks
+    def test_start_logging(self):
+        cache = self.mk_cache()
+        self.add_cleanup(cache.stop_logging)
+        yield cache.get(('12345', 'pool1', 'Inbound'), self.fetch_cost)
+        cache.start_logging(300)
+        with LogCatcher() as lc:
+            self.clock.advance(299)
+            self.assertEqual(lc.messages(), [])
+            self.clock.advance(1)
+            self.assertEqual(
+                lc.messages(), ["Message cost cache: 0 hits, 1 misses."])
+
+    @inlineCallbacks
+    def test_get_missing_cost(self):
+        cache = self.mk_cache()
+        key = ('12345', 'unknown_pool', 'Inbound')
+        self.assertEqual((yield cache.get(key, self.fetch_cost)), None)
+        self.assertEqual((yield cache.get(key, self.fetch_cost)), None)
+        self.assertEqual(self.fetched, [key])
+
+    @inlineCallbacks
+    def test_ttl(self):
+        cache = self.mk_cache(ttl=10)
+        key = ('12345', 'pool1', 'Inbound')
+        yield cache.get(key, self.fetch_cost)
+        self.clock.advance(9)
+        yield cache.get(key, self.fetch_cost)
+        self.assertEqual(self.fetched, [key])
+        self.clock.advance(1)
+        yield cache.get(key, self.fetch_cost)
+        self.assertEqual(self.fetched, [key, key])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    @inlineCallbacks
+    def test_zero_ttl(self):
+        cache = self.mk_cache(ttl=0)
+        key = ('12345', 'pool1', 'Inbound')
+        yield cache.get(key, self.fetch_cost)
+        yield cache.get(key, self.fetch_cost)
+        self.assertEqual(self.fetched, [key, key])
+
+    @inlineCallbacks
+    def test_clear(self):
+        cache = self.mk_cache()
+        key = ('12345', 'pool1', 'Inbound')
+        yield cache.get(key, self.fetch_cost)
+        cache.clear()
+        yield cache.get(key, self.fetch_cost)
+        self.assertEqual(self.fetched, [key, key])
+
+    @inlineCallbacks
+    def test_clear_during_fetch(self):
+        cache = self.mk_cache()
+        key = ('12345', 'pool1', 'Inbound')
+
+        def fetch_and_clear(*key):
+            d = self.fetch_cost(*key)
+            cache.clear()
+            return d
+
+        yield cache.get(key, fetch_and_clear)
+        yield cache.get(key, self.fetch_cost)
+        self.assertEqual(self.fetched, [key, key])
+
+
 @skipif_unsupported_db
 @pytest.mark.django_db
 class BillingApiTestCase(VumiTestCase):
@@ -53,6 +163,7 @@ class BillingApiTestCase(VumiTestCase):
             yield self.connection_pool.runOperation(
                 'DELETE FROM %s' % (table,))
         self.connection_pool.close()
+        yield super(BillingApiTestCase, self).tearDown()
 
     @inlineCallbacks
     def call_api(self, method, path, **kw):
@@ -164,13 +275,23 @@ class BillingApiTestCase(VumiTestCase):
         }
         return self.call_api('post', 'transactions', content=content)
 
-    def get_api_transaction_list(self, account_number):
+    def create_api_transaction_batch(self, transactions):
+        """
+        Create a batch of transaction records via the billing API.
+        """
+        content = {
+            'transactions': transactions,
+        }
+        return self.call_api('post', 'transactions/batch', content=content)
+
+    def get_api_transaction_list(self, account_number, **kw):
         """
         Retrieve the list of transactions for a given account number.
         """
         args = {
             'account_number': account_number,
         }
+        args.update(kw)
         return self.call_api('get', 'transactions', args=args)
 
 
@@ -520,7 +641,7 @@ class TestTransaction(BillingApiTestCase):
                 message_direction="Inbound",
                 session_created=False)
         except ApiCallError, e:
-            self.assertEqual(e.response.responseCode, 500)
+            self.assertEqual(e.response.responseCode, 400)
             self.assertEqual(
                 e.message,
                 "Unable to determine Inbound message cost for account"
@@ -544,7 +665,7 @@ class TestTransaction(BillingApiTestCase):
                 message_direction="Outbound",
                 session_created=False)
         except ApiCallError, e:
-            self.assertEqual(e.response.responseCode, 500)
+            self.assertEqual(e.response.responseCode, 400)
             self.assertEqual(
                 e.message,
                 "Unable to find billing account unknown-account while"
@@ -559,3 +680,314 @@ class TestTransaction(BillingApiTestCase):
             ("Unable to find billing account unknown-account while"
              " checking credit balance. Message was Outbound to/from"
              " tag pool some-random-pool.",))
+
+    @inlineCallbacks
+    def test_transaction_resent(self):
+        yield self.create_api_user(email="test10@example.com")
+        yield self.create_api_account(
+            email="test10@example.com", account_number="77777")
+        yield self.create_api_cost(
+            tag_pool_name="test_pool6", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+
+        transaction = {
+            'account_number': "77777", 'message_id': 'msg-id-1',
+            'tag_pool_name': "test_pool6", 'tag_name': "12345",
+            'message_direction': "Inbound", 'session_created': False,
+        }
+        created = yield self.create_api_transaction(**transaction)
+        resent = yield self.create_api_transaction(**transaction)
+        self.assertEqual(resent['id'], created['id'])
+        [batched] = yield self.create_api_transaction_batch([transaction])
+        self.assertEqual(batched['id'], created['id'])
+
+        account = yield self.get_api_account("77777")
+        self.assertEqual(account['credit_balance'], created['credit_amount'])
+        transactions = yield self.get_api_transaction_list("77777")
+        self.assertEqual(len(transactions), 1)
+
+    @inlineCallbacks
+    def test_transaction_batch(self):
+        yield self.create_api_user(email="test6@example.com")
+        account1 = yield self.create_api_account(
+            email="test6@example.com", account_number="22222")
+        account2 = yield self.create_api_account(
+            email="test6@example.com", account_number="33333")
+
+        yield self.create_api_cost(
+            tag_pool_name="test_pool3", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+        yield self.create_api_cost(
+            account_number="33333", tag_pool_name="test_pool3",
+            message_direction="Inbound",
+            message_cost=0.2, session_cost=0.1, markup_percent=10.0)
+
+        credit_amount1 = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+        credit_amount1_for_session = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=True)
+        credit_amount2 = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.2'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.1'), session_created=False)
+
+        def mk_transaction(account, message_id, session_created=False):
+            return {
+                'account_number': account['account_number'],
+                'message_id': message_id,
+                'tag_pool_name': 'test_pool3',
+                'tag_name': '12345',
+                'message_direction': 'Inbound',
+                'session_created': session_created,
+            }
+
+        transactions = yield self.create_api_transaction_batch([
+            mk_transaction(account1, 'msg-id-1'),
+            mk_transaction(account1, 'msg-id-2', session_created=True),
+            mk_transaction(account2, 'msg-id-3'),
+        ])
+        self.assertEqual(
+            [(t['message_id'], t['credit_amount']) for t in transactions], [
+                ('msg-id-1', -credit_amount1),
+                ('msg-id-2', -credit_amount1_for_session),
+                ('msg-id-3', -credit_amount2),
+            ])
+
+        account1 = yield self.get_api_account("22222")
+        self.assertEqual(account1['credit_balance'],
+                         -(credit_amount1 + credit_amount1_for_session))
+        account2 = yield self.get_api_account("33333")
+        self.assertEqual(account2['credit_balance'], -credit_amount2)
+
+        # Test that resent messages aren't billed again
+        resent = yield self.create_api_transaction_batch([
+            mk_transaction(account1, 'msg-id-1'),
+            mk_transaction(account2, 'msg-id-3'),
+            mk_transaction(account2, 'msg-id-3'),
+        ])
+        self.assertEqual(
+            [t['id'] for t in resent],
+            [transactions[0]['id'], transactions[2]['id'],
+             transactions[2]['id']])
+        account2 = yield self.get_api_account("33333")
+        self.assertEqual(account2['credit_balance'], -credit_amount2)
+
+        # Test that no transactions are created if any message cost is
+        # unknown
+        try:
+            yield self.create_api_transaction_batch([
+                mk_transaction(account1, 'msg-id-4'),
+                dict(mk_transaction(account1, 'msg-id-5'),
+                     message_direction='Outbound'),
+            ])
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 400)
+        else:
+            self.fail("Expected transaction creation to fail.")
+
+        [failure] = self.flushLoggedErrors('go.billing.utils.BillingError')
+        self.assertEqual(
+            failure.value.args,
+            ("Unable to determine Outbound message cost for account"
+             " 22222 and tag pool test_pool3",))
+        transactions = yield self.get_api_transaction_list("22222")
+        self.assertEqual(len(transactions), 2)
+
+        # Test that incomplete transactions are rejected
+        try:
+            yield self.create_api_transaction_batch([
+                {'account_number': '22222', 'message_id': 'msg-id-6'},
+            ])
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 400)
+        else:
+            self.fail("Expected transaction creation to fail.")
+
+
+class TestRunningBalances(BillingApiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestRunningBalances, self).setUp()
+        self.balances = RunningBalances(self.connection_pool)
+        self.reconciler = BalanceReconciler(
+            self.connection_pool, self.balances)
+        self.web = DummySite(
+            api.Root(self.connection_pool, balances=self.balances))
+
+    @inlineCallbacks
+    def get_db_credit_balance(self, account_number):
+        [result] = yield self.connection_pool.runQuery(
+            "SELECT credit_balance FROM billing_account"
+            " WHERE account_number = %(account_number)s",
+            {'account_number': account_number})
+        returnValue(result['credit_balance'])
+
+    @inlineCallbacks
+    def test_transaction(self):
+        yield self.create_api_user(email="test7@example.com")
+        yield self.create_api_account(
+            email="test7@example.com", account_number="44444")
+        yield self.load_api_account_credits("44444", 100)
+        yield self.create_api_cost(
+            tag_pool_name="test_pool4", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+
+        credit_amount = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+
+        yield self.create_api_transaction(
+            account_number="44444", message_id='msg-id-1',
+            tag_pool_name="test_pool4", tag_name="12345",
+            message_direction="Inbound", session_created=False)
+        yield self.create_api_transaction_batch([{
+            'account_number': "44444", 'message_id': 'msg-id-2',
+            'tag_pool_name': "test_pool4", 'tag_name': "12345",
+            'message_direction': "Inbound", 'session_created': False,
+        }])
+
+        # The account isn't updated until the balances are reconciled
+        self.assertEqual((yield self.balances.get_delta("44444")),
+                         -2 * credit_amount)
+        self.assertEqual((yield self.get_db_credit_balance("44444")), 100)
+        account = yield self.get_api_account("44444")
+        self.assertEqual(account['credit_balance'], 100 - 2 * credit_amount)
+
+        self.assertEqual((yield self.reconciler.reconcile()), 1)
+        self.assertEqual((yield self.balances.get_delta("44444")), 0)
+        self.assertEqual((yield self.get_db_credit_balance("44444")),
+                         100 - 2 * credit_amount)
+        account = yield self.get_api_account("44444")
+        self.assertEqual(account['credit_balance'], 100 - 2 * credit_amount)
+
+        # Transactions are only applied once
+        self.assertEqual((yield self.reconciler.reconcile()), 0)
+        self.assertEqual((yield self.get_db_credit_balance("44444")),
+                         100 - 2 * credit_amount)
+
+    @inlineCallbacks
+    def test_failed_transaction(self):
+        yield self.create_api_user(email="test7@example.com")
+        yield self.create_api_account(
+            email="test7@example.com", account_number="44444")
+        yield self.load_api_account_credits("44444", 100)
+
+        # A transaction that fails leaves no pending change behind
+        try:
+            yield self.create_api_transaction(
+                account_number="44444", message_id='msg-id-1',
+                tag_pool_name="unknown_pool", tag_name="12345",
+                message_direction="Inbound", session_created=False)
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 400)
+        else:
+            self.fail("Expected transaction creation to fail.")
+        self.flushLoggedErrors('go.billing.utils.BillingError')
+
+        self.assertEqual((yield self.balances.get_deltas()), {})
+        self.assertEqual((yield self.reconciler.reconcile()), 0)
+        self.assertEqual((yield self.get_db_credit_balance("44444")), 100)
+
+
+class TestLowCreditAlerts(BillingApiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestLowCreditAlerts, self).setUp()
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.alerts = LowCreditAlerts(redis)
+        self.web = DummySite(
+            api.Root(self.connection_pool, alerts=self.alerts))
+
+    @inlineCallbacks
+    def test_alert(self):
+        yield self.create_api_user(email="test8@example.com")
+        yield self.create_api_account(
+            email="test8@example.com", account_number="55555")
+        yield self.connection_pool.runOperation(
+            "UPDATE billing_account SET alert_threshold = 50.0"
+            " WHERE account_number = '55555'")
+        yield self.load_api_account_credits("55555", 10)
+        yield self.create_api_cost(
+            tag_pool_name="test_pool5", message_direction="Inbound",
+            message_cost=0.1, session_cost=0.0, markup_percent=0.0)
+
+        def mk_transaction(message_id):
+            return {
+                'account_number': "55555", 'message_id': message_id,
+                'tag_pool_name': "test_pool5", 'tag_name': "12345",
+                'message_direction': "Inbound", 'session_created': False,
+            }
+
+        # Each message costs 1 credit and the alert credit balance is 5
+        for i in range(4):
+            yield self.create_api_transaction(
+                **mk_transaction('msg-id-%d' % (i,)))
+        self.assertEqual((yield self.alerts.depth()), 0)
+
+        yield self.create_api_transaction_batch([
+            mk_transaction('msg-id-4'), mk_transaction('msg-id-5')])
+        alert = yield self.alerts.pop()
+        self.assertEqual(alert['account_number'], "55555")
+        self.assertEqual(decimal.Decimal(alert['credit_balance']), 4)
+        self.assertEqual(decimal.Decimal(alert['alert_credit_balance']), 5)
+
+        # Only the transactions that take the balance below the alert
+        # credit balance raise an alert
+        yield self.create_api_transaction(**mk_transaction('msg-id-6'))
+        self.assertEqual((yield self.alerts.depth()), 0)
+
+
+class TestTransactionList(BillingApiTestCase):
+
+    @inlineCallbacks
+    def test_pagination(self):
+        yield self.create_api_user(email="test9@example.com")
+        yield self.create_api_account(
+            email="test9@example.com", account_number="66666")
+        yield self.create_api_cost(
+            tag_pool_name="test_pool6", message_direction="Inbound",
+            message_cost=0.1, session_cost=0.0, markup_percent=0.0)
+
+        for i in range(5):
+            yield self.create_api_transaction(
+                account_number="66666", message_id='msg-id-%d' % (i,),
+                tag_pool_name="test_pool6", tag_name="12345",
+                message_direction="Inbound", session_created=False)
+
+        page1 = yield self.get_api_transaction_list(
+            "66666", items_per_page=2)
+        self.assertEqual(
+            [t['message_id'] for t in page1], ['msg-id-4', 'msg-id-3'])
+
+        page2 = yield self.get_api_transaction_list(
+            "66666", items_per_page=2, last_created=page1[-1]['created'],
+            last_id=page1[-1]['id'])
+        self.assertEqual(
+            [t['message_id'] for t in page2], ['msg-id-2', 'msg-id-1'])
+
+        page3 = yield self.get_api_transaction_list(
+            "66666", items_per_page=2, last_created=page2[-1]['created'],
+            last_id=page2[-1]['id'])
+        self.assertEqual([t['message_id'] for t in page3], ['msg-id-0'])
+
+        try:
+            yield self.get_api_transaction_list(
+                "66666", items_per_page=2, last_created=page3[-1]['created'],
+                last_id=page3[-1]['id'])
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 404)
+        else:
+            self.fail("Expected no more transactions.")
+
+        try:
+            yield self.get_api_transaction_list(
+                "66666", items_per_page=2, last_created="yesterday",
+                last_id=page3[-1]['id'])
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 400)
+        else:
+            self.fail("Expected an invalid last_created to be rejected.")
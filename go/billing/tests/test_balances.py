@@ -0,0 +1,140 @@
+from decimal import Decimal
+
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.billing.alerts import LowCreditAlerts
+from go.billing.balances import RunningBalances, BalanceReconciler
+
+
+class FakeConnectionPool(object):
+    """Connection pool that returns the given ``accounts`` from every
+    interaction, in place of the accounts updated by a reconciler run.
+    """
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.interactions = []
+
+    def runInteraction(self, interaction, *args, **kw):
+        self.interactions.append(interaction)
+        return succeed(self.accounts)
+
+
+class FakeCursor(object):
+    """Cursor that returns the given ``rows`` from ``fetchone()``."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        return succeed(self)
+
+    def fetchone(self):
+        return succeed(self.rows.pop(0))
+
+
+class TestRunningBalances(VumiTestCase):
+
+    @inlineCallbacks
+    def test_account_exists_interaction(self):
+        balances = RunningBalances(FakeConnectionPool([]))
+        cursor = FakeCursor([{'?column?': 1}])
+        exists = yield balances.account_exists_interaction(cursor, "12345")
+        self.assertTrue(exists)
+        exists = yield balances.account_exists_interaction(cursor, "12345")
+        self.assertTrue(exists)
+        self.assertEqual(len(cursor.queries), 1)
+
+    @inlineCallbacks
+    def test_account_exists_interaction_missing(self):
+        balances = RunningBalances(FakeConnectionPool([]))
+        cursor = FakeCursor([None, None])
+        exists = yield balances.account_exists_interaction(cursor, "12345")
+        self.assertFalse(exists)
+        exists = yield balances.account_exists_interaction(cursor, "12345")
+        self.assertFalse(exists)
+        self.assertEqual(len(cursor.queries), 2)
+
+
+class TestBalanceReconciler(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.connection_pool = FakeConnectionPool([{
+            "account_number": "12345",
+            "credit_balance": Decimal('94.5'),
+            "alert_credit_balance": Decimal('20.0'),
+            "credit_amount": Decimal('-5.5'),
+        }, {
+            "account_number": "54321",
+            "credit_balance": Decimal('19.75'),
+            "alert_credit_balance": Decimal('20.0'),
+            "credit_amount": Decimal('-0.5'),
+        }])
+        self.balances = RunningBalances(self.connection_pool)
+        self.clock = Clock()
+        self.alerts = LowCreditAlerts(
+            self.redis.sub_manager('alerts'), clock=self.clock)
+        self.reconciler = BalanceReconciler(
+            self.connection_pool, self.balances, self.alerts,
+            clock=self.clock)
+        self.add_cleanup(self.reconciler.stop)
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        updated = yield self.reconciler.reconcile()
+        self.assertEqual(updated, 2)
+        self.assertEqual(self.connection_pool.interactions,
+                         [self.reconciler.reconcile_interaction])
+
+        # Only the account that went below its alert credit balance is
+        # alerted
+        self.assertEqual((yield self.alerts.pop()), {
+            "account_number": "54321",
+            "credit_balance": "19.75",
+            "alert_credit_balance": "20.0",
+            "raised_at": 0,
+        })
+        self.assertEqual((yield self.alerts.pop()), None)
+
+    @inlineCallbacks
+    def test_reconcile_locked(self):
+        self.connection_pool.accounts = None
+        updated = yield self.reconciler.reconcile()
+        self.assertEqual(updated, 0)
+        self.assertEqual((yield self.alerts.pop()), None)
+
+    @inlineCallbacks
+    def test_reconcile_alert_error(self):
+        self.patch(self.alerts, 'push',
+                   lambda *args: fail(ValueError("Connection lost.")))
+        updated = yield self.reconciler.reconcile()
+        self.assertEqual(updated, 2)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Connection lost.")
+
+    def test_start(self):
+        runs = []
+        self.patch(self.reconciler, 'reconcile',
+                   lambda: succeed(runs.append(self.clock.seconds())))
+        self.reconciler.start(60)
+        self.clock.advance(30)
+        self.assertEqual(runs, [])
+        self.clock.advance(30)
+        self.clock.advance(60)
+        self.assertEqual(runs, [60, 120])
+
+    def test_start_logs_errors(self):
+        self.patch(self.reconciler, 'reconcile',
+                   lambda: fail(ValueError("Connection lost.")))
+        self.reconciler.start(60)
+        self.clock.advance(60)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Connection lost.")
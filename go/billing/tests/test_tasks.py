@@ -1,10 +1,12 @@
-from datetime import date
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
 import mock
 
 from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
-from go.billing.models import MessageCost, Account, Statement
+from go.billing.models import (
+    MessageCost, Account, Statement, Transaction, ArchivedTransaction,
+    TransactionRollup, TransactionRollupDay)
 from go.billing import tasks
 from go.billing.tests.helpers import (
     this_month, mk_transaction, get_message_credits, get_session_credits,
@@ -27,6 +29,8 @@ class TestMonthlyStatementTask(GoDjangoTestCase):
         self.account = Account.objects.get(
             user=self.user_helper.get_django_user())
 
+        self.monkey_patch(tasks, '_tagpools_cache', {})
+
     @mock.patch('go.billing.tasks.generate_monthly_statement.s',
                 new_callable=mock.MagicMock)
     def test_generate_monthly_statements(self, s):
@@ -47,8 +51,28 @@ class TestMonthlyStatementTask(GoDjangoTestCase):
 
         from_date = date(last_month.year, last_month.month, 1)
         to_date = date(today.year, today.month, 1) - relativedelta(days=1)
+        self.assertEqual(tasks.get_unrolled_days(from_date, to_date), [])
         s.assert_called_with(self.account.id, from_date, to_date)
 
+    def test_generate_monthly_statements_load_tagpools_once(self):
+        user_helper = self.vumi_helper.make_django_user(u'user2@domain.com')
+        account2 = Account.objects.get(user=user_helper.get_django_user())
+
+        with mock.patch('go.billing.tasks.vumi_api',
+                        wraps=tasks.vumi_api) as vumi_api:
+            tasks.generate_monthly_statement(self.account.id, *this_month())
+            tasks.generate_monthly_statement(account2.id, *this_month())
+            self.assertEqual(vumi_api.call_count, 1)
+
+    def test_generate_monthly_statements_reload_expired_tagpools(self):
+        self.monkey_patch(tasks.settings, 'TAGPOOL_CACHE_TTL', 0)
+
+        with mock.patch('go.billing.tasks.vumi_api',
+                        wraps=tasks.vumi_api) as vumi_api:
+            tasks.generate_monthly_statement(self.account.id, *this_month())
+            tasks.generate_monthly_statement(self.account.id, *this_month())
+            self.assertEqual(vumi_api.call_count, 2)
+
     def test_generate_monthly_statement(self):
         result = tasks.generate_monthly_statement(
             self.account.id, *this_month())
@@ -222,3 +246,182 @@ class TestMonthlyStatementTask(GoDjangoTestCase):
         self.assertEqual(item1.credits, get_session_credits(100, 10))
         self.assertEqual(item2.credits, get_session_credits(100, 20))
         self.assertEqual(item3.credits, get_session_credits(100, 30))
+
+
+class TestRollupTasks(GoDjangoTestCase):
+
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+
+        self.user_helper = self.vumi_helper.make_django_user()
+
+        self.vumi_helper.setup_tagpool(u'pool1', [u'tag1'], {
+            'delivery_class': 'ussd',
+            'display_name': 'Pool 1'
+        })
+        self.user_helper.add_tagpool_permission(u'pool1')
+
+        self.account = Account.objects.get(
+            user=self.user_helper.get_django_user())
+
+        self.monkey_patch(tasks, '_tagpools_cache', {})
+
+    def mk_transaction(self, days_ago=0, **kw):
+        transaction = mk_transaction(self.account, **kw)
+        created = datetime.now() - relativedelta(days=days_ago)
+        Transaction.objects.filter(id=transaction.id).update(created=created)
+        return transaction
+
+    def test_rollup_transactions(self):
+        self.mk_transaction(message_cost=100, markup_percent=10.0)
+        self.mk_transaction(
+            message_cost=100, markup_percent=10.0,
+            session_created=True, session_cost=50)
+        self.mk_transaction(message_cost=200, markup_percent=10.0)
+        self.mk_transaction(days_ago=1, message_cost=100, markup_percent=10.0)
+
+        self.assertEqual(tasks.rollup_transactions(date.today()), 3)
+        [rollup] = TransactionRollup.objects.filter(
+            day=date.today(), message_cost=100, session_cost=50)
+        self.assertEqual(rollup.account_number, self.account.account_number)
+        self.assertEqual(rollup.tag_pool_name, 'pool1')
+        self.assertEqual(rollup.tag_name, 'tag1')
+        self.assertEqual(rollup.message_direction,
+                         MessageCost.DIRECTION_INBOUND)
+        self.assertEqual(rollup.markup_percent, 10)
+        self.assertEqual(rollup.message_count, 1)
+        self.assertEqual(rollup.message_total_cost, 100)
+        self.assertEqual(rollup.session_count, 1)
+        self.assertEqual(rollup.session_total_cost, 50)
+
+        # Rolling up a day again replaces its rollups
+        self.mk_transaction(message_cost=200, markup_percent=10.0)
+        self.assertEqual(tasks.rollup_transactions(date.today()), 3)
+        [rollup] = TransactionRollup.objects.filter(
+            day=date.today(), message_cost=200)
+        self.assertEqual(rollup.message_count, 2)
+        self.assertEqual(rollup.message_total_cost, 400)
+        self.assertEqual(rollup.session_count, 0)
+
+    def test_rollup_transactions_archived(self):
+        self.mk_transaction(message_cost=100, markup_percent=10.0)
+        tasks.archive_transactions(date.today() + relativedelta(days=1))
+        self.mk_transaction(message_cost=100, markup_percent=10.0)
+
+        self.assertEqual(tasks.rollup_transactions(date.today()), 1)
+        [rollup] = TransactionRollup.objects.all()
+        self.assertEqual(rollup.message_count, 2)
+        self.assertEqual(rollup.message_total_cost, 200)
+
+    def test_rollup_transactions_records_day(self):
+        yesterday = date.today() - relativedelta(days=1)
+        tasks.rollup_transactions(yesterday, self.account.account_number)
+        self.assertEqual(tasks.get_unrolled_days(yesterday, yesterday),
+                         [yesterday])
+        tasks.rollup_transactions(yesterday)
+        self.assertEqual(tasks.get_unrolled_days(yesterday, yesterday), [])
+        self.assertEqual(
+            [d.day for d in TransactionRollupDay.objects.all()], [yesterday])
+
+    def test_rollup_period(self):
+        today = date.today()
+        days = [today - relativedelta(days=i) for i in (3, 2, 1)]
+        tasks.rollup_transactions(days[1])
+
+        self.assertEqual(
+            tasks.rollup_period(days[0], today + relativedelta(days=1)),
+            [days[0], days[2], today])
+        self.assertEqual(
+            tasks.rollup_period(days[0], today + relativedelta(days=1)),
+            [today])
+
+    def test_rollup_daily_transactions(self):
+        yesterday = date.today() - relativedelta(days=1)
+        self.mk_transaction(days_ago=1)
+        self.mk_transaction()
+
+        self.assertEqual(tasks.rollup_daily_transactions(), 1)
+        [rollup] = TransactionRollup.objects.all()
+        self.assertEqual(rollup.day, yesterday)
+
+    def test_generate_monthly_statement_from_rollups(self):
+        yesterday = date.today() - relativedelta(days=1)
+        self.mk_transaction(days_ago=1, message_cost=100, markup_percent=10.0)
+        self.mk_transaction(days_ago=1, message_cost=100, markup_percent=10.0)
+
+        # Days that haven't been rolled up yet are rolled up for the
+        # statement
+        statement = tasks.generate_monthly_statement(
+            self.account.id, yesterday, yesterday)
+        [item] = get_line_items(statement)
+        self.assertEqual(item.description, 'Messages received')
+        self.assertEqual(item.units, 2)
+        self.assertEqual(item.credits, get_message_credits(200, 10))
+        self.assertEqual(item.unit_cost, 100)
+        self.assertEqual(item.cost, 200)
+
+        # Days that have been rolled up for all accounts are built from
+        # their rollups
+        tasks.rollup_daily_transactions()
+        TransactionRollup.objects.update(message_count=3)
+        statement = tasks.generate_monthly_statement(
+            self.account.id, yesterday, yesterday)
+        [item] = get_line_items(statement)
+        self.assertEqual(item.units, 3)
+
+    def test_generate_monthly_statement_rolls_up_today_once(self):
+        today = date.today()
+        self.mk_transaction()
+        with mock.patch('go.billing.tasks.rollup_transactions',
+                        wraps=tasks.rollup_transactions) as rollup:
+            statement = tasks.generate_monthly_statement(
+                self.account.id, today, today)
+        rollup.assert_called_once_with(today, self.account.account_number)
+        [item] = get_line_items(statement)
+        self.assertEqual(item.units, 1)
+
+
+class TestArchiveTransactionsTask(GoDjangoTestCase):
+
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+        self.account = Account.objects.get(
+            user=self.user_helper.get_django_user())
+
+    def mk_transaction(self, created, **kwargs):
+        transaction = mk_transaction(self.account, **kwargs)
+        Transaction.objects.filter(id=transaction.id).update(created=created)
+        return transaction
+
+    def test_archive_transactions(self):
+        old = self.mk_transaction(datetime(2014, 1, 31, 23, 59))
+        new = self.mk_transaction(datetime(2014, 2, 1))
+
+        self.assertEqual(tasks.archive_transactions(date(2014, 2, 1)), 1)
+        self.assertEqual(
+            [t.id for t in Transaction.objects.all()], [new.id])
+        [archived] = ArchivedTransaction.objects.all()
+        self.assertEqual(archived.id, old.id)
+        self.assertEqual(archived.account_number, old.account_number)
+        self.assertEqual(archived.credit_amount, old.credit_amount)
+        self.assertEqual(archived.created, datetime(2014, 1, 31, 23, 59))
+
+    def test_archive_transactions_default(self):
+        this_month = date.today().replace(day=1)
+        before = this_month - relativedelta(months=3)
+        self.mk_transaction(before - relativedelta(days=1))
+        new = self.mk_transaction(before)
+
+        self.assertEqual(tasks.archive_transactions(), 1)
+        self.assertEqual(
+            [t.id for t in Transaction.objects.all()], [new.id])
+
+    def test_archive_transactions_unapplied(self):
+        unapplied = self.mk_transaction(
+            datetime(2014, 1, 31), balance_applied=False)
+
+        self.assertEqual(tasks.archive_transactions(date(2014, 2, 1)), 0)
+        self.assertEqual(
+            [t.id for t in Transaction.objects.all()], [unapplied.id])
+        self.assertEqual(ArchivedTransaction.objects.count(), 0)
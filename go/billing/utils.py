@@ -20,6 +20,11 @@ class BillingError(Exception):
     """Raised when an error occurs during billing."""
 
 
+class BillingRequestRejected(BillingError):
+    """Raised when the billing API rejects a request. Sending the same
+    request again would fail in the same way."""
+
+
 class JSONEncoder(json.JSONEncoder):
     """JSONEncoder to handle ``Decimal`` and ``datetime`` values"""
 
@@ -35,8 +35,8 @@ def delete_group(account_key, group_key):
     # memory is ugly.
     for contact_key in group.backlinks.contacts():
         contact = contact_store.get_contact_by_key(contact_key)
-        contact.groups.remove(group)
-        contact.save()
+        contact_store.remove_contact_from_group(contact, group)
+    contact_store.clear_group_caches(group)
     group.delete()
 
 
@@ -50,7 +50,23 @@ def delete_group_contacts(account_key, group_key):
     # and the boilerplate for fetching batches without having them all sit in
     # memory is ugly.
     for contact_key in contacts:
-        contact_store.get_contact_by_key(contact_key).delete()
+        contact_store.delete_contact(
+            contact_store.get_contact_by_key(contact_key))
+
+
+@task(ignore_result=True)
+def reconcile_group_member_counts(account_key):
+    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
+    api.contact_store.reconcile_group_counts()
+
+
+@task(ignore_result=True)
+def reconcile_all_group_member_counts():
+    """
+    Spawn a task to reconcile the group member counts of each account.
+    """
+    for profile in UserProfile.objects.all():
+        reconcile_group_member_counts.delay(profile.user_account)
 
 
 def zipped_file(filename, data):
@@ -289,7 +305,7 @@ def import_new_contacts_file(account_key, group_key, file_name, file_path,
         # Clean up if something went wrong, either everything is written
         # or nothing is written
         for contact in written_contacts:
-            contact.delete()
+            contact_store.delete_contact(contact)
 
         exc_type, exc_value, exc_traceback = sys.exc_info()
 
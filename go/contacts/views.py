@@ -164,8 +164,7 @@ def _static_group(request, contact_store, group):
             contacts = request.POST.getlist('contact')
             for person_key in contacts:
                 contact = contact_store.get_contact_by_key(person_key)
-                contact.groups.remove(group)
-                contact.save()
+                contact_store.remove_contact_from_group(contact, group)
             messages.info(
                 request,
                 '%d Contacts removed from group' % len(contacts))
@@ -317,7 +316,8 @@ def _smart_group(request, contact_store, group):
             'query': group.query,
         })
 
-    keys = contact_store.get_contacts_for_group(group)
+    keys = contact_store.get_contacts_for_group(
+        group, max_age=contact_store.SMART_GROUP_SNAPSHOT_MAX_AGE)
     limit = min(int(request.GET.get('limit', 100)), len(keys))
 
     if keys:
@@ -354,7 +354,7 @@ def _people(request):
             contacts = request.POST.getlist('contact')
             for person_key in contacts:
                 contact = contact_store.get_contact_by_key(person_key)
-                contact.delete()
+                contact_store.delete_contact(contact)
             messages.info(request, '%d Contacts deleted' % len(contacts))
         elif '_export' in request.POST:
             tasks.export_contacts.delay(
@@ -442,12 +442,13 @@ def person(request, person_key):
     groups = contact_store.list_groups()
     if request.method == 'POST':
         if '_delete' in request.POST:
-            contact.delete()
+            contact_store.delete_contact(contact)
             messages.info(request, 'Contact deleted')
             return redirect(reverse('contacts:people'))
         else:
             form = ContactForm(request.POST, groups=groups)
             if form.is_valid():
+                old_group_keys = contact.groups.keys()
                 for k, v in form.cleaned_data.items():
                     if k == 'groups':
                         contact.groups.clear()
@@ -456,6 +457,8 @@ def person(request, person_key):
                         continue
                     setattr(contact, k, v)
                 contact.save()
+                contact_store.update_group_counts(
+                    old_group_keys, contact.groups.keys())
                 messages.add_message(request, messages.INFO, 'Profile Updated')
                 return redirect(reverse('contacts:person', kwargs={
                     'person_key': contact.key}))
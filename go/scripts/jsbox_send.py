@@ -145,10 +145,9 @@ class JsBoxSendWorker(Worker):
     @inlineCallbacks
     def get_contact_addrs_for_conv(self, conv, delivery_class, excluded_addrs):
         addrs = []
-        for contacts in (yield conv.get_opted_in_contact_bunches(
+        for addr_bunch in (yield conv.get_opted_in_addr_bunches(
                 delivery_class)):
-            for contact in (yield contacts):
-                addr = contact.addr_for(delivery_class)
+            for contact_key, addr in (yield addr_bunch):
                 if addr not in excluded_addrs:
                     addrs.append(addr)
             self.emit("Addresses collected: %s" % (len(addrs),))
@@ -304,6 +304,18 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=0, minute=0),
         'args': ('daily',)
     },
+    'rollup-daily-billing-transactions': {
+        'task': 'go.billing.tasks.rollup_daily_transactions',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'reconcile-contact-group-member-counts': {
+        'task': 'go.contacts.tasks.reconcile_all_group_member_counts',
+        'schedule': crontab(hour=2, minute=0),
+    },
+#    'archive-billing-transactions': {
+#        'task': 'go.billing.tasks.archive_transactions',
+#        'schedule': crontab(day_of_month=1, hour=1, minute=0),
+#    },
 #    'generate-monthly-account-statements': {
 #        'task': 'go.billing.tasks.generate_monthly_account_statements',
 #        'schedule': crontab(day_of_month=1),
@@ -10,7 +10,7 @@ class RoutingTableField(Field):
     """
 
     def custom_to_riak(self, value):
-        return value._routing_table
+        return value.as_dict()
 
     def custom_from_riak(self, raw_value):
         return RoutingTable(raw_value)
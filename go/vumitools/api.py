@@ -29,6 +29,8 @@ from go.vumitools.contact import ContactStore
 from go.vumitools.conversation import ConversationStore
 from go.vumitools.opt_out import OptOutStore
 from go.vumitools.router import RouterStore
+from go.vumitools.routing_table_cache import RoutingTableVersions
+from go.vumitools.tag_ownership import TagOwnershipStore
 from go.vumitools.conversation.utils import ConversationWrapper
 from go.vumitools.token_manager import TokenManager
 
@@ -92,8 +94,9 @@ class VumiUserApi(object):
         self.user_account_key = user_account_key
         self.conversation_store = ConversationStore(self.api.manager,
                                                     self.user_account_key)
-        self.contact_store = ContactStore(self.api.manager,
-                                          self.user_account_key)
+        self.contact_store = ContactStore(
+            self.api.manager, self.user_account_key,
+            redis=self.api.redis.sub_manager('group_member_counts'))
         self.router_store = RouterStore(self.api.manager,
                                         self.user_account_key)
         self.channel_store = ChannelStore(self.api.manager,
@@ -297,6 +300,13 @@ class VumiUserApi(object):
                 "Routing table missing for account: %s" % (user_account.key,))
         returnValue(user_account.routing_table)
 
+    def routing_table_updated(self):
+        """Notify routing table caches that this account's routing table
+        has been saved.
+        """
+        return self.api.routing_table_versions.bump_version(
+            self.user_account_key)
+
     @Manager.calls_manager
     def validate_routing_table(self, user_account=None):
         """Check that the routing table on this account is valid.
@@ -345,6 +355,7 @@ class VumiUserApi(object):
         tag_info.metadata['user_account'] = user_account.key.decode('utf-8')
         yield tag_info.save()
         yield user_account.save()
+        yield self.api.tag_ownership.set_owner(tag, user_account.key)
 
     @Manager.calls_manager
     def acquire_tag(self, pool):
@@ -413,6 +424,7 @@ class VumiUserApi(object):
             if 'user_account' in tag_info.metadata:
                 del tag_info.metadata['user_account']
             yield tag_info.save()
+            yield self.api.tag_ownership.clear_owner(tag)
             # NOTE: This loads and saves the CurrentTag object a second time.
             #       We should probably refactor the message store to make this
             #       less clumsy.
@@ -424,6 +436,7 @@ class VumiUserApi(object):
             routing_table.remove_transport_tag(tag)
 
             yield user_account.save()
+            yield self.routing_table_updated()
         yield self.api.tpm.release_tag(tag)
 
     def delivery_class_for_msg(self, msg):
@@ -469,6 +482,7 @@ class VumiRouterApi(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         routing_table.remove_router(router)
         yield user_account.save()
+        yield self.user_api.routing_table_updated()
 
     @Manager.calls_manager
     def start_router(self, router=None):
@@ -527,6 +541,10 @@ class VumiApi(object):
                                 self.redis.sub_manager('token_manager'))
         self.session_manager = SessionManager(
             self.redis.sub_manager('session_manager'))
+        self.routing_table_versions = RoutingTableVersions(
+            self.redis.sub_manager('routing_table_versions'))
+        self.tag_ownership = TagOwnershipStore(
+            self.redis.sub_manager('tag_ownership'))
         self.mapi = sender
         self.metric_publisher = metric_publisher
 
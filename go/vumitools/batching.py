@@ -0,0 +1,127 @@
+# -*- test-case-name: go.vumitools.tests.test_batching -*-
+
+"""Collect items into small batches for processing together."""
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+from vumi import log
+
+
+class MicroBatcher(object):
+    """Collects items and processes them in batches.
+
+    A batch is processed once `batch_size` items have been added or
+    `delay` seconds after the first item in the batch was added, whichever
+    comes first.
+
+    :param process_batch:
+        Function that is called with a list of items. It must return
+        (or return a deferred that fires with) a list containing a result
+        for each item, in the same order. A result that is a `Failure`
+        is passed to the errback of the deferred returned by :meth:`add`
+        for that item.
+    :param int batch_size:
+        Maximum number of items in a batch.
+    :param float delay:
+        Maximum number of seconds to wait for a batch to fill.
+    :param clock:
+        Object with a `callLater()` method, used for scheduling batches.
+    """
+
+    def __init__(self, process_batch, batch_size, delay, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.delay = delay
+        self.clock = clock
+        self._pending = []
+        self._delayed_flush = None
+        self._processing = []
+        self._idle_waiters = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, item):
+        """Add an item to the current batch.
+
+        Returns a deferred that fires with the item's result once its batch
+        has been processed.
+        """
+        d = Deferred()
+        self._pending.append((item, d))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        """Process the current batch immediately.
+
+        Returns a deferred that fires once the batch has been processed.
+        """
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return succeed(None)
+
+        def fire_waiters(results):
+            for (_item, waiter), result in zip(batch, results):
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        def fail_waiters(failure):
+            for _item, waiter in batch:
+                waiter.errback(failure)
+
+        d = maybeDeferred(self.process_batch, [item for item, _ in batch])
+        d.addCallbacks(fire_waiters, fail_waiters)
+        self._processing.append(d)
+        d.addBoth(self._batch_processed, d)
+        return d
+
+    def _batch_processed(self, result, d):
+        self._processing.remove(d)
+        if not self._processing:
+            waiters, self._idle_waiters = self._idle_waiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+        return result
+
+    def wait(self):
+        """Wait for the batches that are being processed.
+
+        Returns a deferred that fires once no batches are being processed.
+        Items that are still waiting for their batch to be flushed aren't
+        waited for.
+        """
+        if not self._processing:
+            return succeed(None)
+        d = Deferred()
+        self._idle_waiters.append(d)
+        return d
+
+
+class ConcurrentConsumerMixin(object):
+    """Mixin for vumi consumers that handle several messages at once.
+
+    A vumi consumer waits for each message to be handled before reading
+    the next one. This reads the next message straight away instead, so
+    the messages it handles can be collected by a :class:`MicroBatcher`.
+    Each message is still only acknowledged once it has been handled. The
+    consumer's `prefetch_count` limits how many unacknowledged messages
+    the broker delivers, and so how many are handled at once.
+    """
+
+    def consume(self, message):
+        d = super(ConcurrentConsumerMixin, self).consume(message)
+        d.addErrback(log.err, "Error consuming message")
@@ -0,0 +1,87 @@
+# -*- test-case-name: go.vumitools.tests.test_billing_costs -*-
+
+"""In-process record of which messages are free of charge."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi import log
+
+
+class FreeMessageIndex(object):
+    """In-process index of the message costs that are zero.
+
+    The full list of message costs is fetched from the billing API and
+    used to decide whether messages for a given account, tagpool and
+    direction cost nothing. Costs are resolved the same way the billing
+    API resolves them when creating a transaction: an account's own cost
+    for the tagpool takes precedence over the tagpool's cost for all
+    accounts, which takes precedence over the default cost for the
+    direction. A cost is free only if both its message and session costs
+    are zero. Messages with no applicable cost are never free, so that
+    billing can still report them.
+
+    The costs are refetched in the background at most once every
+    `refresh_interval` seconds, while lookups continue to be answered
+    from the previous costs. If fetching the costs fails, the previous
+    costs are kept.
+
+    :type billing_api: :class:`go.vumitools.billing_worker.BillingApi`
+    :param billing_api:
+        Billing API client to fetch the message costs from.
+    :param float refresh_interval:
+        Number of seconds between refreshes of the message costs.
+    :param clock:
+        Object with a `seconds()` method that returns the current time.
+    """
+
+    def __init__(self, billing_api, refresh_interval, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.billing_api = billing_api
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self._free = {}
+        self._next_refresh = None
+        self._refreshing = None
+
+    @inlineCallbacks
+    def load(self):
+        """Fetch the message costs."""
+        self._next_refresh = self.clock.seconds() + self.refresh_interval
+        costs = yield self.billing_api.get_cost_list()
+        free = {}
+        for cost in costs:
+            key = (cost['account_number'], cost['tag_pool_name'],
+                   cost['message_direction'])
+            free[key] = (cost['message_cost'] == 0
+                         and cost['session_cost'] == 0)
+        self._free = free
+
+    def _refresh_failed(self, f):
+        log.err(f, "Error refreshing message costs.")
+
+    def _refresh_done(self, result):
+        self._refreshing = None
+        return result
+
+    def _maybe_refresh(self):
+        if self._refreshing is not None:
+            return
+        if (self._next_refresh is None
+                or self.clock.seconds() >= self._next_refresh):
+            self._refreshing = self.load()
+            self._refreshing.addErrback(self._refresh_failed)
+            self._refreshing.addBoth(self._refresh_done)
+
+    def is_free(self, account_number, tag_pool_name, message_direction):
+        """Return `True` if messages sent or received by `account_number`
+        via `tag_pool_name` in `message_direction` cost nothing.
+        """
+        self._maybe_refresh()
+        for key in [(account_number, tag_pool_name, message_direction),
+                    (None, tag_pool_name, message_direction),
+                    (None, None, message_direction)]:
+            if key in self._free:
+                return self._free[key]
+        return False
@@ -0,0 +1,178 @@
+# -*- test-case-name: go.vumitools.tests.test_billing_queue -*-
+
+"""Queue of billing transactions waiting to be sent to the billing API."""
+
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.blinkenlights.metrics import Metric, LAST, MAX
+from vumi.persist.redis_base import Manager
+
+from go.billing.utils import BillingRequestRejected
+
+
+class BillingQueue(object):
+    """Transactions waiting to be created, stored in a Redis list.
+
+    Each entry records the time it was queued so that the lag between a
+    message being billed and its transaction being created can be
+    reported.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    :param clock:
+        Object with a `seconds()` method that returns the current time.
+    """
+
+    QUEUE_KEY = "transactions"
+
+    def __init__(self, redis, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.manager = redis
+        self.clock = clock
+
+    @Manager.calls_manager
+    def push(self, transaction):
+        """Append `transaction` to the queue."""
+        yield self.manager.rpush(self.QUEUE_KEY, json.dumps({
+            "transaction": transaction,
+            "queued_at": self.clock.seconds(),
+        }))
+
+    @Manager.calls_manager
+    def peek(self, count):
+        """Return a list of up to `count` entries from the front of the
+        queue, without removing them.
+
+        Each entry is a dict with `transaction` and `queued_at` keys.
+        """
+        entries = yield self.manager.lrange(self.QUEUE_KEY, 0, count - 1)
+        returnValue([json.loads(entry) for entry in entries])
+
+    @Manager.calls_manager
+    def remove(self, count):
+        """Remove `count` entries from the front of the queue."""
+        yield self.manager.ltrim(self.QUEUE_KEY, count, -1)
+
+    def depth(self):
+        """Return the number of queued transactions."""
+        return self.manager.llen(self.QUEUE_KEY)
+
+
+class BillingQueueDrainer(object):
+    """Sends queued transactions to the billing API in batches.
+
+    Entries are only removed from the queue once the billing API has
+    created their transactions, so a batch that can't be sent (for example,
+    because the billing API is down or returns a server error) is retried
+    on the next drain. The billing API doesn't bill a message twice, so
+    resending a batch that was created without the drainer finding out is
+    safe.
+
+    If the billing API rejects a batch (with a 4xx response), its
+    transactions are sent one at a time. Each is removed from the queue
+    once it has been created, or logged and dropped if it is rejected on
+    its own, as it would be if it had been created synchronously. Any other
+    error stops the drain and leaves the remaining transactions queued.
+
+    Only one drainer should be run for each queue.
+
+    :param BillingQueue queue:
+        Queue to drain.
+    :type billing_api: :class:`go.vumitools.billing_worker.BillingApi`
+    :param billing_api:
+        Billing API client to create the transactions with.
+    :param int batch_size:
+        Maximum number of transactions to send in each request.
+    :param clock:
+        Object with a `seconds()` method that returns the current time and
+        a `callLater()` method for scheduling drains.
+    """
+
+    def __init__(self, queue, billing_api, batch_size, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.queue = queue
+        self.billing_api = billing_api
+        self.batch_size = batch_size
+        self.clock = clock
+        self.depth_metric = Metric('billing_queue.depth', [LAST, MAX])
+        self.lag_metric = Metric('billing_queue.lag', [LAST, MAX])
+        self._looper = None
+
+    def register_metrics(self, metric_manager):
+        """Publish the queue depth and the age of the oldest queued
+        transaction, measured at the start of each drain, via
+        `metric_manager`.
+        """
+        metric_manager.register(self.depth_metric)
+        metric_manager.register(self.lag_metric)
+
+    def start(self, interval):
+        """Drain the queue every `interval` seconds."""
+        self._looper = LoopingCall(self._drain_and_log)
+        self._looper.clock = self.clock
+        self._looper.start(interval, now=False)
+
+    def stop(self):
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        self._looper = None
+
+    def _drain_and_log(self):
+        d = self.drain()
+        d.addErrback(log.err, "Error draining billing queue.")
+        return d
+
+    @inlineCallbacks
+    def drain(self):
+        """Send all the queued transactions to the billing API.
+
+        Returns the number of queued transactions sent.
+        """
+        sent = 0
+        depth = yield self.queue.depth()
+        self.depth_metric.set(depth)
+        entries = yield self.queue.peek(self.batch_size)
+        if entries:
+            self.lag_metric.set(
+                self.clock.seconds() - entries[0]["queued_at"])
+        else:
+            self.lag_metric.set(0)
+        while entries:
+            yield self.send_batch(
+                [entry["transaction"] for entry in entries])
+            sent += len(entries)
+            entries = yield self.queue.peek(self.batch_size)
+        returnValue(sent)
+
+    @inlineCallbacks
+    def send_batch(self, transactions):
+        """Create `transactions`, which are at the front of the queue, and
+        remove them from the queue.
+        """
+        try:
+            yield self.billing_api.create_transaction_batch(transactions)
+        except BillingRequestRejected:
+            log.err(None, "Billing API rejected batch of %d transactions."
+                    " Retrying them individually." % (len(transactions),))
+            for transaction in transactions:
+                yield self.send_transaction(transaction)
+                yield self.queue.remove(1)
+        else:
+            yield self.queue.remove(len(transactions))
+
+    @inlineCallbacks
+    def send_transaction(self, transaction):
+        try:
+            yield self.billing_api.create_transaction(**transaction)
+        except BillingRequestRejected:
+            log.err(None, "Billing API rejected transaction for message %s."
+                    " Dropping it." % (transaction["message_id"],))
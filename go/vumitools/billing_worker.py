@@ -4,40 +4,68 @@ import urllib
 from urlparse import urljoin
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web.client import Agent, HTTPConnectionPool
 
 from vumi import log
 from vumi.dispatchers.endpoint_dispatchers import Dispatcher
-from vumi.config import ConfigText
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.config import ConfigText, ConfigBool, ConfigInt, ConfigFloat
 from vumi.utils import http_request_full
 
+from go.config import get_go_metrics_prefix
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
+from go.vumitools.billing_queue import BillingQueue, BillingQueueDrainer
 
-from go.billing.utils import JSONEncoder, JSONDecoder, BillingError
+from go.billing.utils import (
+    JSONDecoder, BillingError, BillingRequestRejected)
 
 
 class BillingApi(object):
-    """Proxy to the billing REST API"""
+    """Proxy to the billing REST API
 
-    def __init__(self, base_url):
+    Requests are made over persistent connections from ``pool``. If no
+    pool is given, a persistent pool that keeps up to
+    ``max_persistent_per_host`` idle connections open is created.
+    """
+
+    def __init__(self, base_url, pool=None, max_persistent_per_host=2):
         self.base_url = base_url
+        if pool is None:
+            from twisted.internet import reactor
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = max_persistent_per_host
+        self.pool = pool
+
+    def _agent(self, reactor, contextFactory):
+        return Agent(reactor, contextFactory=contextFactory, pool=self.pool)
+
+    def close(self):
+        """Close any idle persistent connections."""
+        return self.pool.closeCachedConnections()
 
     @inlineCallbacks
-    def _call_api(self, path, query=None, data=None, method='GET'):
+    def _call_api(self, path, query=None, body=None, method='GET'):
         """Perform the actual HTTP call to the billing API.
 
+        ``body`` should already be encoded as JSON.
+
         If the HTTP response code is anything other than 200,
-        raise a BillingError exception.
+        raise a BillingError exception. If it is a 4xx response code, the
+        request won't succeed if it is sent again and a
+        BillingRequestRejected exception is raised.
         """
         url = urljoin(self.base_url, path)
         if query:
             url = "%s?%s" % (url, urllib.urlencode(query))
-        data = json.dumps(data, cls=JSONEncoder)
         headers = {'Content-Type': 'application/json'}
-        log.debug("Sending billing request to %r: %r" % (url, data))
-        response = yield http_request_full(url, data, headers=headers,
-                                           method=method)
+        log.debug("Sending billing request to %r: %r" % (url, body))
+        response = yield http_request_full(url, body, headers=headers,
+                                           method=method,
+                                           agent_class=self._agent)
 
         log.debug("Got billing response: %r" % (response.delivered_body,))
+        if 400 <= response.code < 500:
+            raise BillingRequestRejected(response.delivered_body)
         if response.code != 200:
             raise BillingError(response.delivered_body)
         result = json.loads(response.delivered_body, cls=JSONDecoder)
@@ -45,7 +73,12 @@ class BillingApi(object):
 
     def create_transaction(self, account_number, message_id, tag_pool_name,
                            tag_name, message_direction, session_created):
-        """Create a new transaction for the given ``account_number``"""
+        """Create a new transaction for the given ``account_number``.
+
+        If a transaction has already been created for the message, the
+        existing transaction is returned instead, so a request that may or
+        may not have succeeded can safely be sent again.
+        """
         data = {
             'account_number': account_number,
             'message_id': message_id,
@@ -54,7 +87,23 @@ class BillingApi(object):
             'message_direction': message_direction,
             'session_created': session_created,
         }
-        return self._call_api("/transactions", data=data, method='POST')
+        return self._call_api(
+            "/transactions", body=json.dumps(data), method='POST')
+
+    def create_transaction_batch(self, transactions):
+        """Create new transactions for a list of messages.
+
+        Each transaction is a dict with the same fields as the arguments to
+        :meth:`create_transaction`. As with :meth:`create_transaction`,
+        messages that have already been billed aren't billed again.
+        """
+        body = json.dumps({'transactions': transactions})
+        return self._call_api(
+            "/transactions/batch", body=body, method='POST')
+
+    def get_cost_list(self):
+        """Return all message costs."""
+        return self._call_api("/costs", method='GET')
 
 
 class BillingDispatcherConfig(Dispatcher.CONFIG_CLASS, GoWorkerConfigMixin):
@@ -62,6 +111,30 @@ class BillingDispatcherConfig(Dispatcher.CONFIG_CLASS, GoWorkerConfigMixin):
     api_url = ConfigText(
         "Base URL of the billing REST API",
         static=True, required=True)
+    api_max_persistent_connections = ConfigInt(
+        "Maximum number of idle connections to the billing REST API to keep"
+        " open for reuse.",
+        default=10, static=True, required=False)
+    async_billing = ConfigBool(
+        "Mark messages as paid and publish them without waiting for the"
+        " billing API. Their transactions are queued in Redis and sent to"
+        " the billing API in the background. Billing dispatchers that share"
+        " a Redis key prefix share a queue, so only one of them should have"
+        " this set.",
+        default=False, static=True, required=False)
+    billing_queue_batch_size = ConfigInt(
+        "Maximum number of queued transactions to send to the billing API"
+        " in each request.",
+        default=100, static=True, required=False)
+    billing_queue_drain_interval = ConfigFloat(
+        "Number of seconds between sending queued transactions to the"
+        " billing API. Transactions that couldn't be sent are retried after"
+        " this long.",
+        default=1.0, static=True, required=False)
+    billing_queue_metrics_interval = ConfigInt(
+        "Number of seconds between publishing the billing queue depth and"
+        " lag.",
+        default=60, static=True, required=False)
 
     def post_validate(self):
         if len(self.receive_inbound_connectors) != 1:
@@ -83,6 +156,9 @@ class BillingDispatcher(Dispatcher, GoWorkerMixin):
 
     worker_name = 'billing_dispatcher'
 
+    billing_queue = None
+    billing_queue_drainer = None
+
     @inlineCallbacks
     def setup_dispatcher(self):
         yield super(BillingDispatcher, self).setup_dispatcher()
@@ -95,13 +171,39 @@ class BillingDispatcher(Dispatcher, GoWorkerMixin):
             self.get_configured_ro_connectors()[0]
 
         self.api_url = config.api_url
-        self.billing_api = BillingApi(self.api_url)
+        self.billing_api = BillingApi(
+            self.api_url,
+            max_persistent_per_host=config.api_max_persistent_connections)
+        if config.async_billing:
+            self.setup_billing_queue(config)
 
     @inlineCallbacks
     def teardown_dispatcher(self):
+        if self.billing_queue_drainer is not None:
+            self.billing_queue_drainer.stop()
+            self.billing_queue_metrics.stop_polling()
+        yield self.billing_api.close()
         yield self._go_teardown_worker()
         yield super(BillingDispatcher, self).teardown_dispatcher()
 
+    def setup_billing_queue(self, config):
+        """Queue transactions in Redis and start sending them to the billing
+        API in the background.
+        """
+        self.billing_queue = BillingQueue(
+            self.redis.sub_manager('billing_queue'))
+        self.billing_queue_drainer = BillingQueueDrainer(
+            self.billing_queue, self.billing_api,
+            config.billing_queue_batch_size)
+        self.billing_queue_metrics = MetricManager(
+            "%s%s." % (get_go_metrics_prefix(), self.worker_name),
+            config.billing_queue_metrics_interval,
+            publisher=self.metric_publisher)
+        self.billing_queue_drainer.register_metrics(
+            self.billing_queue_metrics)
+        self.billing_queue_metrics.start_polling()
+        self.billing_queue_drainer.start(config.billing_queue_drain_interval)
+
     def validate_metadata(self, msg):
         msg_mdh = self.get_metadata_helper(msg)
         if not msg_mdh.has_user_account():
@@ -113,13 +215,21 @@ class BillingDispatcher(Dispatcher, GoWorkerMixin):
             raise BillingError(
                 "No tag found for message %s" % (msg.get('message_id'),))
 
+    def create_transaction(self, **transaction):
+        """Create a transaction, or queue it to be created later if billing
+        is asynchronous.
+        """
+        if self.billing_queue is not None:
+            return self.billing_queue.push(transaction)
+        return self.billing_api.create_transaction(**transaction)
+
     @inlineCallbacks
     def create_transaction_for_inbound(self, msg):
         """Create a transaction for the given inbound message"""
         self.validate_metadata(msg)
         msg_mdh = self.get_metadata_helper(msg)
         session_created = msg['session_event'] == 'new'
-        yield self.billing_api.create_transaction(
+        yield self.create_transaction(
             account_number=msg_mdh.get_account_key(),
             message_id=msg['message_id'],
             tag_pool_name=msg_mdh.tag[0], tag_name=msg_mdh.tag[1],
@@ -132,7 +242,7 @@ class BillingDispatcher(Dispatcher, GoWorkerMixin):
         self.validate_metadata(msg)
         msg_mdh = self.get_metadata_helper(msg)
         session_created = msg['session_event'] == 'new'
-        yield self.billing_api.create_transaction(
+        yield self.create_transaction(
             account_number=msg_mdh.get_account_key(),
             message_id=msg['message_id'],
             tag_pool_name=msg_mdh.tag[0], tag_name=msg_mdh.tag[1],
@@ -1,6 +1,8 @@
 from go.vumitools.contact.models import (
-    ContactGroup, Contact, ContactStore, ContactError, ContactNotFoundError)
+    ContactGroup, Contact, SmartGroupSnapshot, SmartGroupSnapshotChunk,
+    ContactStore, ContactError, ContactNotFoundError)
 
 
-__all__ = ['ContactGroup', 'Contact', 'ContactStore', 'ContactError',
+__all__ = ['ContactGroup', 'Contact', 'SmartGroupSnapshot',
+           'SmartGroupSnapshotChunk', 'ContactStore', 'ContactError',
            'ContactNotFoundError']
@@ -0,0 +1,67 @@
+# -*- test-case-name: go.vumitools.tests.test_contact -*-
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class GroupMemberCounts(object):
+    """
+    Counts of the members of static contact groups, kept in Redis so that
+    groups can be counted without a Riak index query.
+
+    Each group's count is a hash with a ``count`` field, holding the count
+    as of when it was last set, and a ``delta`` field, holding the changes
+    made since. :meth:`add` always adds to ``delta`` with a single HINCRBY,
+    so it can't race with the count being set or deleted.
+
+    A group only has a count once its ``count`` field has been set with
+    :meth:`set_count` or :meth:`init_count`. Changes made without calling
+    :meth:`add` are only picked up when the count is set again, which is
+    what reconciliation does.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    @Manager.calls_manager
+    def get_count(self, group_key):
+        """Return the count for ``group_key``, or ``None`` if it has none."""
+        fields = yield self.manager.hgetall(group_key)
+        if 'count' not in fields:
+            returnValue(None)
+        returnValue(int(fields['count']) + int(fields.get('delta', 0)))
+
+    @Manager.calls_manager
+    def get_delta(self, group_key):
+        """
+        Return the changes added to ``group_key`` since its count was last
+        set. Pass this to :meth:`init_count`.
+        """
+        delta = yield self.manager.hget(group_key, 'delta')
+        returnValue(int(delta) if delta is not None else 0)
+
+    def set_count(self, group_key, count):
+        """Set the count for ``group_key``, replacing any it has."""
+        return self.manager.hmset(group_key, {'count': count, 'delta': 0})
+
+    def init_count(self, group_key, count, delta):
+        """
+        Set the count for ``group_key`` if it doesn't have one yet.
+
+        ``count`` should have been looked up after ``delta`` was fetched
+        with :meth:`get_delta`, so that changes added while looking it up
+        are kept.
+        """
+        return self.manager.hsetnx(group_key, 'count', count - delta)
+
+    def add(self, group_key, amount):
+        """Add ``amount`` to the count for ``group_key``."""
+        return self.manager.hincrby(group_key, 'delta', amount)
+
+    def delete(self, group_key):
+        return self.manager.delete(group_key)
@@ -2,6 +2,16 @@
 from vumi.persist.model import ModelMigrator
 
 
+def surname_initial_for(surname):
+    """
+    Return the lower-cased first letter of ``surname``, or ``None`` if there
+    is no surname.
+    """
+    if surname:
+        return surname[0].lower()
+    return None
+
+
 class ContactMigrator(ModelMigrator):
 
     def migrate_from_unversioned(self, mdata):
@@ -42,3 +52,26 @@ class ContactMigrator(ModelMigrator):
             mdata.set_value(field, value, index=('%s_bin' % (field,)))
 
         return mdata
+
+    def migrate_from_2(self, mdata):
+
+        mdata.copy_values(
+            'name', 'surname', 'email_address', 'dob', 'created_at',
+            'msisdn', 'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id',
+            'mxit_id', 'wechat_id')
+
+        mdata.copy_dynamic_values(
+            'extras-', 'subscription-')
+        mdata.copy_indexes(
+            'user_account_bin', 'groups_bin', 'msisdn_bin',
+            'twitter_handle_bin', 'facebook_id_bin', 'bbm_pin_bin',
+            'gtalk_id_bin', 'mxit_id_bin', 'wechat_id_bin')
+
+        # Add stuff that's new in this version
+        mdata.set_value('$VERSION', 3)
+        mdata.set_value(
+            'surname_initial',
+            surname_initial_for(mdata.old_data.get('surname')),
+            index='surname_initial_bin')
+
+        return mdata
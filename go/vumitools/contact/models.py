@@ -1,15 +1,17 @@
 # -*- test-case-name: go.vumitools.tests.test_contact -*-
 
 from uuid import uuid4
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from twisted.internet.defer import returnValue
 from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (
-    Unicode, ManyToMany, ForeignKey, Timestamp, Dynamic)
+    Unicode, ManyToMany, ForeignKey, Timestamp, Dynamic, ListOf, Integer)
 
 from go.vumitools.account import UserAccount, PerAccountStore
-from go.vumitools.contact.migrations import ContactMigrator
+from go.vumitools.contact.counts import GroupMemberCounts
+from go.vumitools.contact.migrations import (
+    ContactMigrator, surname_initial_for)
 from go.vumitools.opt_out import OptOutStore
 
 
@@ -70,6 +72,23 @@ def contact_field_for_addr(delivery_class, addr):
     return (contact_field, addr)
 
 
+def addr_field_for(delivery_class):
+    """
+    Return the name of the contact field holding the address for
+    ``delivery_class``, or ``None`` if the delivery class is unknown.
+    """
+    if delivery_class is None:
+        # FIXME: Find a better way to do get delivery_class and get rid of
+        #        this hack.
+        return 'msisdn'
+
+    delivery_class_dict = DELIVERY_CLASSES.get(delivery_class)
+    if delivery_class_dict is not None:
+        return delivery_class_dict['field']
+
+    return None
+
+
 class ContactGroup(Model):
     """A group of contacts"""
     # key is UUID
@@ -78,12 +97,6 @@ class ContactGroup(Model):
     user_account = ForeignKey(UserAccount)
     created_at = Timestamp(default=datetime.utcnow)
 
-    @Manager.calls_manager
-    def add_contacts(self, contacts, save=True):
-        for contact in contacts:
-            contact.groups.add(self)
-            yield contact.save()
-
     def is_smart_group(self):
         return self.query is not None
 
@@ -91,10 +104,50 @@ class ContactGroup(Model):
         return self.name
 
 
+class SmartGroupSnapshot(Model):
+    """The members of a smart group as found by its query at a point in time
+
+    The contact keys are stored in ``chunk_count`` separate
+    :class:`SmartGroupSnapshotChunk` objects so that no single Riak object
+    holds all of a large group's keys. ``contact_count`` is the number of
+    keys, so the group can be counted without loading them.
+    """
+    # key is the group's key
+    user_account = ForeignKey(UserAccount)
+    query = Unicode()
+    contact_count = Integer(default=0)
+    chunk_count = Integer(default=0)
+    refreshed_at = Timestamp(default=datetime.utcnow)
+
+    def chunk_keys(self):
+        return [chunk_key_for(self.key, i) for i in range(self.chunk_count)]
+
+    def is_fresh(self, group, max_age):
+        """
+        Return ``True`` if this snapshot is of ``group``'s current query and
+        is less than ``max_age`` seconds old.
+        """
+        if self.query != group.query:
+            return False
+        age = datetime.utcnow() - self.refreshed_at
+        return age < timedelta(seconds=max_age)
+
+
+def chunk_key_for(group_key, index):
+    return u'%s:%d' % (group_key, index)
+
+
+class SmartGroupSnapshotChunk(Model):
+    """Some of the contact keys of a :class:`SmartGroupSnapshot`"""
+    # key is the snapshot's key and the chunk's index, see chunk_key_for()
+    user_account = ForeignKey(UserAccount)
+    contact_keys = ListOf(Unicode())
+
+
 class Contact(Model):
     """A contact"""
 
-    VERSION = 2
+    VERSION = 3
     MIGRATOR = ContactMigrator
 
     # key is UUID
@@ -117,21 +170,30 @@ class Contact(Model):
     mxit_id = Unicode(null=True, index=True)
     wechat_id = Unicode(null=True, index=True)
 
+    # Set from ``surname`` on save so that contacts can be filtered on the
+    # first letter of their surname through Riak 2i.
+    surname_initial = Unicode(null=True, index=True)
+
+    def save(self):
+        self.surname_initial = surname_initial_for(self.surname)
+        return super(Contact, self).save()
+
     def add_to_group(self, group):
+        """
+        Add this contact to ``group`` and return ``True`` if it wasn't
+        already in it.
+        """
         if isinstance(group, ContactGroup):
-            self.groups.add(group)
-        else:
-            self.groups.add_key(group)
+            group = group.key
+        if group in self.groups.keys():
+            return False
+        self.groups.add_key(group)
+        return True
 
     def addr_for(self, delivery_class):
-        if delivery_class is None:
-            # FIXME: Find a better way to do get delivery_class and get rid of
-            #        this hack.
-            return self.msisdn
-
-        delivery_class = DELIVERY_CLASSES.get(delivery_class)
-        if delivery_class is not None:
-            return getattr(self, delivery_class['field'])
+        field = addr_field_for(delivery_class)
+        if field is not None:
+            return getattr(self, field)
 
         return None
 
@@ -146,7 +208,8 @@ class Contact(Model):
 
 
 class ContactStore(PerAccountStore):
-    NONSETTABLE_CONTACT_FIELDS = ['$VERSION', 'user_account']
+    NONSETTABLE_CONTACT_FIELDS = [
+        '$VERSION', 'user_account', 'surname_initial']
 
     # These two values control how contacts are found based on address.
     # If FIND_BY_INDEX is disabled, search will be used instead of index
@@ -160,9 +223,36 @@ class ContactStore(PerAccountStore):
     FIND_BY_INDEX = True
     FIND_BY_INDEX_SEARCH_FALLBACK = False
 
+    # This controls how contacts are filtered on the first letter of their
+    # surnames. Contacts are only in the surname_initial index once they
+    # have been migrated to version 3, so go/scripts/migrate_contacts.py must
+    # be run for every account when deploying version 3. Until it has been,
+    # FILTER_ON_SURNAME_BY_INDEX should be disabled so that a mapreduce over
+    # the contacts bucket is used instead of the index, otherwise contacts
+    # that haven't been migrated will be left out.
+    FILTER_ON_SURNAME_BY_INDEX = True
+
+    # How many seconds a snapshot of a smart group's members may be used for
+    # by callers that use smart groups repeatedly, such as conversation sends
+    # and sandbox member counts, before the group's search is run again.
+    SMART_GROUP_SNAPSHOT_MAX_AGE = 60
+
+    # How many contact keys are stored in each chunk of a smart group
+    # snapshot.
+    SMART_GROUP_SNAPSHOT_CHUNK_SIZE = 10000
+
+    def __init__(self, base_manager, user_account_key, redis=None):
+        super(ContactStore, self).__init__(base_manager, user_account_key)
+        self.group_counts = None
+        if redis is not None:
+            self.group_counts = GroupMemberCounts(redis)
+
     def setup_proxies(self):
         self.contacts = self.manager.proxy(Contact)
         self.groups = self.manager.proxy(ContactGroup)
+        self.smart_group_snapshots = self.manager.proxy(SmartGroupSnapshot)
+        self.smart_group_snapshot_chunks = self.manager.proxy(
+            SmartGroupSnapshotChunk)
 
     @classmethod
     def settable_contact_fields(cls, **fields):
@@ -180,10 +270,11 @@ class ContactStore(PerAccountStore):
             contact_id, user_account=self.user_account_key,
             **self.settable_contact_fields(**fields))
 
-        for group in groups:
-            contact.add_to_group(group)
+        added_groups = [
+            group for group in groups if contact.add_to_group(group)]
 
         yield contact.save()
+        yield self._update_group_counts(added_groups, 1)
         returnValue(contact)
 
     @Manager.calls_manager
@@ -197,12 +288,66 @@ class ContactStore(PerAccountStore):
             if field_name in contact.field_descriptors:
                 setattr(contact, field_name, field_value)
 
-        for group in groups:
-            contact.add_to_group(group)
+        added_groups = [
+            group for group in groups if contact.add_to_group(group)]
 
         yield contact.save()
+        yield self._update_group_counts(added_groups, 1)
         returnValue(contact)
 
+    @Manager.calls_manager
+    def delete_contact(self, contact):
+        yield contact.delete()
+        yield self._update_group_counts(contact.groups.keys(), -1)
+
+    @Manager.calls_manager
+    def add_contacts_to_group(self, group, contacts):
+        """
+        Add ``contacts`` to ``group``, saving them and updating the group's
+        member count.
+        """
+        added = 0
+        for contact in contacts:
+            if contact.add_to_group(group):
+                yield contact.save()
+                added += 1
+        yield self._update_group_counts([group], added)
+
+    @Manager.calls_manager
+    def remove_contact_from_group(self, contact, group):
+        """
+        Remove ``contact`` from ``group``, saving it and updating the group's
+        member count.
+        """
+        old_group_keys = contact.groups.keys()
+        contact.groups.remove(group)
+        yield contact.save()
+        yield self.update_group_counts(old_group_keys, contact.groups.keys())
+
+    @Manager.calls_manager
+    def update_group_counts(self, old_group_keys, new_group_keys):
+        """
+        Update the member counts of the groups a contact has been added to
+        or removed from, given the keys of the groups it was in before it
+        was saved and the keys of the groups it is in now.
+
+        Anything that changes a contact's groups without going through the
+        store's other methods must call this after saving the contact.
+        """
+        old_group_keys = set(old_group_keys)
+        new_group_keys = set(new_group_keys)
+        yield self._update_group_counts(new_group_keys - old_group_keys, 1)
+        yield self._update_group_counts(old_group_keys - new_group_keys, -1)
+
+    @Manager.calls_manager
+    def _update_group_counts(self, groups, amount):
+        if self.group_counts is None or amount == 0:
+            return
+        for group in groups:
+            if isinstance(group, ContactGroup):
+                group = group.key
+            yield self.group_counts.add(group, amount)
+
     @Manager.calls_manager
     def new_group(self, name):
         group_id = uuid4().get_hex()
@@ -231,27 +376,35 @@ class ContactStore(PerAccountStore):
         return self.groups.load(key)
 
     @Manager.calls_manager
-    def get_contacts_for_group(self, group):
-        """Return contact keys for this group."""
+    def get_contacts_for_group(self, group, max_age=None):
+        """
+        Return contact keys for this group.
+
+        See :meth:`get_dynamic_contacts_for_group` for ``max_age``.
+        """
         contacts = set([])
         static_contacts = yield self.get_static_contacts_for_group(group)
         contacts.update(static_contacts)
         if group.is_smart_group():
-            dynamic_contacts = yield self.get_dynamic_contacts_for_group(group)
+            dynamic_contacts = yield self.get_dynamic_contacts_for_group(
+                group, max_age=max_age)
             contacts.update(dynamic_contacts)
         returnValue(list(contacts))
 
     @Manager.calls_manager
-    def get_contacts_for_conversation(self, conversation):
+    def get_contacts_for_conversation(self, conversation, max_age=None):
         """
         Collect all contacts relating to a conversation from static &
         dynamic groups.
+
+        See :meth:`get_dynamic_contacts_for_group` for ``max_age``.
         """
         # Grab all contacts we can find
         contacts = set([])
         for groups in conversation.groups.load_all_bunches():
             for group in (yield groups):
-                group_contacts = yield self.get_contacts_for_group(group)
+                group_contacts = yield self.get_contacts_for_group(
+                    group, max_age=max_age)
                 contacts.update(group_contacts)
 
         returnValue(list(contacts))
@@ -262,35 +415,213 @@ class ContactStore(PerAccountStore):
         """
         return group.backlinks.contacts()
 
-    def get_dynamic_contacts_for_group(self, group):
+    @Manager.calls_manager
+    def get_dynamic_contacts_for_group(self, group, max_age=None):
         """
         Use Riak search to find matching contacts.
+
+        If ``max_age`` is given, the contacts in a snapshot of the group
+        taken less than ``max_age`` seconds ago are returned instead, if
+        there is one. Otherwise the search is run and a new snapshot is
+        stored for later callers.
         """
-        return self.contacts.raw_search(group.query).get_keys()
+        if max_age is None:
+            keys = yield self.contacts.raw_search(group.query).get_keys()
+            returnValue(keys)
 
-    def count_contacts_for_group(self, group):
-        if group.is_smart_group():
-            return self.contacts.raw_search(group.query).get_count()
+        snapshot, keys = yield self.get_fresh_smart_group_snapshot(
+            group, max_age)
+        if keys is None:
+            keys = yield self.get_smart_group_snapshot_keys(snapshot)
+        returnValue(keys)
+
+    @Manager.calls_manager
+    def get_fresh_smart_group_snapshot(self, group, max_age):
+        """
+        Return ``(snapshot, keys)`` for the group's snapshot, refreshing it
+        first if it is older than ``max_age`` seconds or was taken with a
+        different query.
+
+        ``keys`` is the list of contact keys if the search was run and
+        ``None`` if an existing snapshot was used, in which case its keys
+        haven't been loaded.
+        """
+        snapshot = yield self.smart_group_snapshots.load(group.key)
+        if snapshot is not None and snapshot.is_fresh(group, max_age):
+            returnValue((snapshot, None))
+
+        keys = yield self.contacts.raw_search(group.query).get_keys()
+        snapshot = yield self.store_smart_group_snapshot(group, keys, snapshot)
+        returnValue((snapshot, keys))
+
+    @Manager.calls_manager
+    def get_smart_group_snapshot_keys(self, snapshot):
+        """
+        Load the contact keys stored in ``snapshot``'s chunks.
+        """
+        keys = []
+        chunk_keys = snapshot.chunk_keys()
+        for chunks_bunch in self.smart_group_snapshot_chunks.load_all_bunches(
+                chunk_keys):
+            for chunk in (yield chunks_bunch):
+                keys.extend(chunk.contact_keys)
+        returnValue(keys)
+
+    @Manager.calls_manager
+    def store_smart_group_snapshot(self, group, keys, snapshot=None):
+        """
+        Store ``keys`` as the group's snapshot, updating ``snapshot`` if it
+        is given.
+
+        The chunks are saved before the snapshot, and chunks left over from
+        a larger earlier snapshot are deleted after it.
+        """
+        chunk_size = self.SMART_GROUP_SNAPSHOT_CHUNK_SIZE
+        chunk_count = (len(keys) + chunk_size - 1) // chunk_size
+        for i in range(chunk_count):
+            chunk = self.smart_group_snapshot_chunks(
+                chunk_key_for(group.key, i),
+                user_account=self.user_account_key,
+                contact_keys=keys[i * chunk_size:(i + 1) * chunk_size])
+            yield chunk.save()
+
+        old_chunk_keys = []
+        if snapshot is None:
+            snapshot = self.smart_group_snapshots(
+                group.key, user_account=self.user_account_key)
+        else:
+            old_chunk_keys = snapshot.chunk_keys()[chunk_count:]
+            snapshot.refreshed_at = datetime.utcnow()
+        snapshot.query = group.query
+        snapshot.contact_count = len(keys)
+        snapshot.chunk_count = chunk_count
+        yield snapshot.save()
+
+        yield self._delete_snapshot_chunks(old_chunk_keys)
+        returnValue(snapshot)
+
+    @Manager.calls_manager
+    def _delete_snapshot_chunks(self, chunk_keys):
+        for chunk_key in chunk_keys:
+            chunk = yield self.smart_group_snapshot_chunks.load(chunk_key)
+            if chunk is not None:
+                yield chunk.delete()
+
+    @Manager.calls_manager
+    def clear_group_caches(self, group):
+        """
+        Delete the smart group snapshot and the member count kept for
+        ``group``. This should be done when the group is deleted.
+        """
+        snapshot = yield self.smart_group_snapshots.load(group.key)
+        if snapshot is not None:
+            yield self._delete_snapshot_chunks(snapshot.chunk_keys())
+            yield snapshot.delete()
+        if self.group_counts is not None:
+            yield self.group_counts.delete(group.key)
+
+    @Manager.calls_manager
+    def count_static_contacts_for_group(self, group):
+        """
+        Count the contacts in a static group, using the group's member
+        count if there is one and storing one if there isn't.
+        """
+        if self.group_counts is None:
+            count = yield self.contacts.index_lookup(
+                'groups', group.key).get_count()
+            returnValue(count)
+
+        count = yield self.group_counts.get_count(group.key)
+        if count is not None:
+            returnValue(count)
+
+        # Contacts added or removed while the index is being counted are
+        # kept in the count's delta, so the delta is fetched first.
+        delta = yield self.group_counts.get_delta(group.key)
+        count = yield self.contacts.index_lookup(
+            'groups', group.key).get_count()
+        yield self.group_counts.init_count(group.key, count, delta)
+        stored_count = yield self.group_counts.get_count(group.key)
+        returnValue(stored_count if stored_count is not None else count)
+
+    @Manager.calls_manager
+    def reconcile_group_counts(self):
+        """
+        Set the member counts of all the account's static groups that have
+        one to their counts from Riak 2i. Returns the number of counts that
+        were wrong.
+        """
+        if self.group_counts is None:
+            returnValue(0)
+
+        corrected = 0
+        groups = yield self.list_static_groups()
+        for group in groups:
+            cached_count = yield self.group_counts.get_count(group.key)
+            if cached_count is None:
+                continue
+            count = yield self.contacts.index_lookup(
+                'groups', group.key).get_count()
+            if count != cached_count:
+                yield self.group_counts.set_count(group.key, count)
+                corrected += 1
+        returnValue(corrected)
+
+    @Manager.calls_manager
+    def count_contacts_for_group(self, group, max_age=None):
+        """
+        Count the contacts in this group.
+
+        See :meth:`get_dynamic_contacts_for_group` for ``max_age``. The count
+        stored with a smart group's snapshot is used, so the snapshot's keys
+        aren't loaded.
+        """
+        if not group.is_smart_group():
+            count = yield self.count_static_contacts_for_group(group)
+        elif max_age is None:
+            count = yield self.contacts.raw_search(group.query).get_count()
         else:
-            return self.contacts.index_lookup('groups', group.key).get_count()
+            snapshot, _ = yield self.get_fresh_smart_group_snapshot(
+                group, max_age)
+            count = snapshot.contact_count
+        returnValue(count)
 
     @Manager.calls_manager
-    def filter_contacts_on_surname(self, letter, group=None):
+    def get_contact_keys_on_surname(self, letter, group=None):
+        """
+        Return the sorted keys of the contacts whose surnames start with
+        ``letter``, limited to the static members of ``group`` if it is
+        given.
+
+        All the matching keys are fetched, and with a group so are all of
+        its members' keys. See :attr:`FILTER_ON_SURNAME_BY_INDEX` for
+        contacts that haven't been migrated to version 3.
+        """
+        initial = surname_initial_for(letter)
+        if initial is None:
+            returnValue([])
+        if not self.FILTER_ON_SURNAME_BY_INDEX:
+            keys = yield self._surname_keys_mapreduce(initial, group)
+            returnValue(sorted(keys))
+        keys = yield self.contacts.index_keys('surname_initial', initial)
+        if group is not None:
+            group_keys = yield self.get_static_contacts_for_group(group)
+            keys = set(keys).intersection(group_keys)
+        returnValue(sorted(keys))
+
+    def _surname_keys_mapreduce(self, initial, group=None):
         # FIXME: This does a mapreduce over a bucket, which means hitting every
-        #        key in riak.
-        # TODO: vumi.persist needs to have better ways of supporting
-        #       generic map reduce functions. There's a bunch of boilerplate
-        #       around getting bucket names and indexes that I'm doing
-        #       manually that could be automated.
+        #        key in riak. It is only used until all contacts have been
+        #        migrated to version 3 and are in the surname_initial index.
         mr = self.manager.riak_map_reduce()
         bucket = self.manager.bucket_name(Contact)
-        mr.add_bucket(bucket)
         if group is not None:
             mr.index(bucket, 'groups_bin', group.key)
+        else:
+            mr.add_bucket(bucket)
         # Deleted values hang around with tombstone markers in Riak for a while
         # before they get removed, and this happens a lot in tests. We need to
         # find the real values amongst the deleted ones here.
-        # TODO: Make this a general thing?
         js_function = """function(value, keyData, arg){
             for (i in value.values) {
                 var val = value.values[i]
@@ -298,18 +629,65 @@ class ContactStore(PerAccountStore):
                     var data = JSON.parse(val.data);
                     if (data.surname) {
                         if (data.surname.toLowerCase()[0] === arg) {
-                            return [[value.key, val]];
+                            return [value.key];
                         }
                     }
                 }
             }
             return [];
         }"""
-        mr.map(js_function, {'arg': letter.lower()})
-        contacts = yield self.manager.run_map_reduce(mr,
-            lambda manager, result: Contact.load(
-                manager, result[0], result[1]))
-        returnValue(contacts)
+        mr.map(js_function, {'arg': initial})
+        return self.manager.run_map_reduce(
+            mr, lambda manager, result: result)
+
+    @Manager.calls_manager
+    def filter_contacts_on_surname(self, letter, group=None, start=0,
+                                   limit=None):
+        """
+        Return the contacts whose surnames start with ``letter``, limited to
+        the static members of ``group`` if it is given.
+
+        The contacts are ordered by key. ``start`` and ``limit`` select a
+        page of them, so that only the contacts on that page are loaded.
+        Every page still fetches and sorts all the matching keys, and all
+        of the group's member keys if there is a group, because the index
+        lookup isn't paginated.
+
+        Contacts saved before version 3 of the model aren't in the surname
+        index until they're migrated, see
+        :attr:`FILTER_ON_SURNAME_BY_INDEX`.
+        """
+        keys = yield self.get_contact_keys_on_surname(letter, group=group)
+        if limit is not None:
+            keys = keys[start:start + limit]
+        else:
+            keys = keys[start:]
+        contacts = []
+        for contacts_bunch in self.contacts.load_all_bunches(keys):
+            contacts.extend((yield contacts_bunch))
+        returnValue(sorted(contacts, key=lambda contact: contact.key))
+
+    def load_addr_bunches(self, keys, delivery_class):
+        """
+        Return a generator of bunches of ``(contact key, address)`` pairs for
+        the contacts with the given ``keys`` that have an address for
+        ``delivery_class``, in bunches of up to the manager's
+        ``load_bunch_size`` keys.
+        """
+        if addr_field_for(delivery_class) is None:
+            return
+        for contacts_bunch in self.contacts.load_all_bunches(list(keys)):
+            yield self._addrs_for_contacts(contacts_bunch, delivery_class)
+
+    @Manager.calls_manager
+    def _addrs_for_contacts(self, contacts, delivery_class):
+        contacts = yield contacts
+        addrs = []
+        for contact in contacts:
+            addr = contact.addr_for(delivery_class)
+            if addr:
+                addrs.append((contact.key, addr))
+        returnValue(addrs)
 
     def list_contacts(self):
         return self.list_keys(self.contacts)
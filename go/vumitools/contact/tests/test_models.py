@@ -6,7 +6,8 @@ from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 from go.vumitools.account.models import AccountStore
 from go.vumitools.contact.models import (
     ContactNotFoundError, Contact, ContactStore)
-from go.vumitools.contact.old_models import ContactVNone, ContactV1
+from go.vumitools.contact.old_models import (
+    ContactVNone, ContactV1, ContactV2)
 from go.vumitools.tests.helpers import VumiApiHelper
 
 
@@ -23,7 +24,8 @@ class TestContact(VumiTestCase):
         per_account_manager = riak_manager.sub_manager(self.user.key)
         self.contacts_vnone = per_account_manager.proxy(ContactVNone)
         self.contacts_v1 = per_account_manager.proxy(ContactV1)
-        self.contacts_v2 = per_account_manager.proxy(Contact)
+        self.contacts_v2 = per_account_manager.proxy(ContactV2)
+        self.contacts_v3 = per_account_manager.proxy(Contact)
 
     def assert_with_index(self, model_obj, field, value):
         self.assertEqual(getattr(model_obj, field), value)
@@ -58,6 +60,9 @@ class TestContact(VumiTestCase):
     def make_contact_v2(self, **fields):
         return self._make_contact(self.contacts_v2, **fields)
 
+    def make_contact_v3(self, **fields):
+        return self._make_contact(self.contacts_v3, **fields)
+
     @inlineCallbacks
     def test_contact_vnone(self):
         contact = yield self.make_contact_vnone(name=u'name', msisdn=u'msisdn')
@@ -150,6 +155,58 @@ class TestContact(VumiTestCase):
         self.assert_with_index(contact_v2, 'mxit_id', None)
         self.assert_with_index(contact_v2, 'wechat_id', None)
 
+    @inlineCallbacks
+    def test_contact_v3(self):
+        contact = yield self.make_contact_v3(
+            name=u'name', surname=u'Surname', msisdn=u'msisdn')
+        self.assertEqual(contact.name, 'name')
+        self.assert_with_index(contact, 'msisdn', 'msisdn')
+        self.assert_with_index(contact, 'surname_initial', 's')
+
+        contact.surname = u'Other'
+        yield contact.save()
+        self.assert_with_index(contact, 'surname_initial', 'o')
+
+        contact.surname = None
+        yield contact.save()
+        self.assert_with_index(contact, 'surname_initial', None)
+
+    @inlineCallbacks
+    def test_contact_v2_to_v3(self):
+        contact_v2 = yield self.make_contact_v2(
+            name=u'name', surname=u'Surname', msisdn=u'msisdn',
+            twitter_handle=u'twitter', facebook_id=u'facebook',
+            bbm_pin=u'bbm', gtalk_id=u'gtalk', mxit_id=u'mxit',
+            wechat_id=u'wechat', groups=[u'group1'])
+        contact_v2.extra["thing"] = u"extra-thing"
+        contact_v2.subscription["app"] = u"1"
+        yield contact_v2.save()
+        self.assertEqual(contact_v2.VERSION, 2)
+        contact_v3 = yield self.contacts_v3.load(contact_v2.key)
+        self.assertEqual(contact_v3.name, 'name')
+        self.assertEqual(contact_v3.surname, 'Surname')
+        self.assertEqual(contact_v3.extra["thing"], u"extra-thing")
+        self.assertEqual(contact_v3.subscription["app"], u"1")
+        self.assertEqual(contact_v3.groups.keys(), [u'group1'])
+        self.assertEqual(contact_v3.user_account.key, self.user.key)
+        self.assertEqual(contact_v3.VERSION, 3)
+        self.assert_with_index(contact_v3, 'msisdn', 'msisdn')
+        self.assert_with_index(contact_v3, 'twitter_handle', 'twitter')
+        self.assert_with_index(contact_v3, 'facebook_id', 'facebook')
+        self.assert_with_index(contact_v3, 'bbm_pin', 'bbm')
+        self.assert_with_index(contact_v3, 'gtalk_id', 'gtalk')
+        self.assert_with_index(contact_v3, 'mxit_id', 'mxit')
+        self.assert_with_index(contact_v3, 'wechat_id', 'wechat')
+        self.assert_with_index(contact_v3, 'surname_initial', 's')
+
+    @inlineCallbacks
+    def test_contact_v2_to_v3_without_surname(self):
+        contact_v2 = yield self.make_contact_v2(
+            name=u'name', msisdn=u'msisdn')
+        contact_v3 = yield self.contacts_v3.load(contact_v2.key)
+        self.assertEqual(contact_v3.VERSION, 3)
+        self.assert_with_index(contact_v3, 'surname_initial', None)
+
 
 class TestContactStore(VumiTestCase):
     @inlineCallbacks
@@ -243,6 +300,39 @@ class TestContactStore(VumiTestCase):
             'sms', u'+27831234567', create=False)
         self.assertEqual(contact.key, found_contact.key)
 
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_unindexed(self):
+        yield self.make_unindexed_contact(
+            name=u'name', surname=u'Foo', msisdn=u'+27831234567')
+        self.assertEqual(
+            (yield self.contact_store.filter_contacts_on_surname(u'f')), [])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_unindexed_index_disabled(self):
+        contact1 = yield self.make_unindexed_contact(
+            name=u'name', surname=u'Foo', msisdn=u'+27831234567')
+        contact2 = yield self.contact_store.new_contact(
+            name=u'name', surname=u'fab', msisdn=u'+27831234567')
+        yield self.make_unindexed_contact(
+            name=u'name', surname=u'Bar', msisdn=u'+27831234567')
+        self.contact_store.FILTER_ON_SURNAME_BY_INDEX = False
+        contacts = yield self.contact_store.filter_contacts_on_surname(u'F')
+        self.assertEqual(
+            [c.key for c in contacts], sorted([contact1.key, contact2.key]))
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_for_group_index_disabled(self):
+        group = yield self.contact_store.new_group(u'group')
+        contact = yield self.make_unindexed_contact(
+            name=u'name', surname=u'Foo', msisdn=u'+27831234567',
+            groups=[group])
+        yield self.make_unindexed_contact(
+            name=u'name', surname=u'Fab', msisdn=u'+27831234567')
+        self.contact_store.FILTER_ON_SURNAME_BY_INDEX = False
+        contacts = yield self.contact_store.filter_contacts_on_surname(
+            u'f', group=group)
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
     @inlineCallbacks
     def test_contact_for_addr_new(self):
         contact = yield self.contact_store.contact_for_addr(
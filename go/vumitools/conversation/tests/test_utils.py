@@ -342,6 +342,80 @@ class TestConversationWrapper(VumiTestCase):
             ['+27000000001'],
             (yield get_contacts()))
 
+    @inlineCallbacks
+    def test_get_opted_in_addr_bunches(self):
+        contact_store = self.user_helper.user_api.contact_store
+        user_account = yield self.user_helper.get_user_account()
+        opt_out_store = OptOutStore.from_user_account(user_account)
+
+        @inlineCallbacks
+        def get_addrs():
+            bunches = yield self.conv.get_opted_in_addr_bunches(
+                self.conv.delivery_class)
+            addrs = []
+            for bunch in bunches:
+                addrs.extend((yield bunch))
+            returnValue(sorted(addrs))
+
+        self.assertEqual([], (yield get_addrs()))
+
+        group = yield contact_store.new_group(u'a group')
+        self.conv.add_group(group)
+        yield self.conv.save()
+
+        contact1 = yield contact_store.new_contact(msisdn=u'+27000000001')
+        contact1.add_to_group(group)
+        yield contact1.save()
+
+        contact2 = yield contact_store.new_contact(msisdn=u'+27000000002')
+        contact2.add_to_group(group)
+        yield contact2.save()
+
+        self.assertEqual((yield get_addrs()), sorted([
+            (contact1.key, u'+27000000001'),
+            (contact2.key, u'+27000000002'),
+        ]))
+
+        yield opt_out_store.new_opt_out(u'msisdn', contact2.msisdn, {
+            'message_id': u'some-message-id',
+        })
+
+        self.assertEqual(
+            (yield get_addrs()), [(contact1.key, u'+27000000001')])
+
+    @inlineCallbacks
+    def test_get_opted_in_contact_bunches_without_loading_opt_outs(self):
+        contact_store = self.user_helper.user_api.contact_store
+        user_account = yield self.user_helper.get_user_account()
+        opt_out_store = OptOutStore.from_user_account(user_account)
+
+        group = yield contact_store.new_group(u'a group')
+        self.conv.add_group(group)
+        yield self.conv.save()
+
+        for i in range(1, 4):
+            contact = yield contact_store.new_contact(
+                msisdn=u'+2700000000%d' % (i,))
+            contact.add_to_group(group)
+            yield contact.save()
+
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000002', {
+            'message_id': u'some-message-id',
+        })
+
+        def get_opt_out(*args):
+            self.fail("Opt outs should not be loaded individually.")
+        self.patch(OptOutStore, 'get_opt_out', get_opt_out)
+
+        bunches = yield self.conv.get_opted_in_contact_bunches(
+            self.conv.delivery_class)
+        contacts = []
+        for bunch in bunches:
+            contacts.extend((yield bunch))
+        self.assertEqual(
+            sorted(c.msisdn for c in contacts),
+            [u'+27000000001', u'+27000000003'])
+
     @inlineCallbacks
     def test_get_inbound_throughput(self):
         yield self.conv.start()
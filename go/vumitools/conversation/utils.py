@@ -176,6 +176,7 @@ class ConversationWrapper(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         routing_table.remove_conversation(self.c)
         yield user_account.save()
+        yield self.user_api.routing_table_updated()
 
     @Manager.calls_manager
     def send_token_url(self, token_url, msisdn):
@@ -525,7 +526,8 @@ class ConversationWrapper(object):
         Get all contact keys for this conversation.
         """
         contact_store = self.user_api.contact_store
-        return contact_store.get_contacts_for_conversation(self.c)
+        return contact_store.get_contacts_for_conversation(
+            self.c, max_age=contact_store.SMART_GROUP_SNAPSHOT_MAX_AGE)
 
     @Manager.calls_manager
     def get_inbound_throughput(self, sample_time=300):
@@ -548,23 +550,42 @@ class ConversationWrapper(object):
         returnValue(count / (sample_time / 60.0))
 
     @Manager.calls_manager
-    def _filter_opted_out_contacts(self, contacts, delivery_class):
+    def _get_opted_in_filter(self, delivery_class):
+        """
+        Return a function that checks whether an address for
+        ``delivery_class`` is opted in. The account's opt outs are loaded
+        once up front rather than fetching an opt out for every address.
+        """
         # TODO: Less hacky address type handling.
         address_type = 'gtalk' if delivery_class == 'gtalk' else 'msisdn'
-        contacts = yield contacts
         opt_out_store = OptOutStore(
             self.api.manager, self.user_api.user_account_key)
+        opt_out_ids = yield opt_out_store.opt_out_ids()
+
+        def is_opted_in(addr):
+            opt_out_id = opt_out_store.opt_out_id(address_type, addr)
+            return opt_out_id not in opt_out_ids
+
+        returnValue(is_opted_in)
+
+    @Manager.calls_manager
+    def _filter_opted_out_contacts(self, contacts, delivery_class,
+                                   is_opted_in):
+        contacts = yield contacts
 
         filtered_contacts = []
         for contact in contacts:
             contact_addr = contact.addr_for(delivery_class)
-            if contact_addr:
-                opt_out = yield opt_out_store.get_opt_out(
-                    address_type, contact_addr)
-                if not opt_out:
-                    filtered_contacts.append(contact)
+            if contact_addr and is_opted_in(contact_addr):
+                filtered_contacts.append(contact)
         returnValue(filtered_contacts)
 
+    @Manager.calls_manager
+    def _filter_opted_out_addrs(self, addrs, is_opted_in):
+        addrs = yield addrs
+        returnValue([(contact_key, addr) for contact_key, addr in addrs
+                     if is_opted_in(addr)])
+
     @Manager.calls_manager
     def get_opted_in_contact_bunches(self, delivery_class):
         """
@@ -576,6 +597,7 @@ class ConversationWrapper(object):
         contact_keys = yield self.get_contact_keys()
         contacts_iter = yield contact_store.contacts.load_all_bunches(
             contact_keys)
+        is_opted_in = yield self._get_opted_in_filter(delivery_class)
 
         # We return a generator here. It's important that this is iterated over
         # slowly, otherwise we risk hammering our Riak servers to death.
@@ -583,6 +605,32 @@ class ConversationWrapper(object):
             # NOTE: This is a generator, *not* an async flattener.
             for contacts_bunch in contacts_iter:
                 yield self._filter_opted_out_contacts(
-                    contacts_bunch, delivery_class)
+                    contacts_bunch, delivery_class, is_opted_in)
 
         returnValue(opted_in_contacts_generator())
+
+    @Manager.calls_manager
+    def get_opted_in_addr_bunches(self, delivery_class):
+        """
+        Get a generator that produces batches of ``(contact key, address)``
+        pairs for the contacts that have an address appropriate for the
+        conversation's delivery_class and that are opted in.
+
+        This is the same as :meth:`get_opted_in_contact_bunches`, but only
+        the addresses are kept once each bunch of contacts has been loaded,
+        for sending to contacts that only need an address.
+        """
+        contact_store = self.user_api.contact_store
+        contact_keys = yield self.get_contact_keys()
+        addrs_iter = contact_store.load_addr_bunches(
+            contact_keys, delivery_class)
+        is_opted_in = yield self._get_opted_in_filter(delivery_class)
+
+        # We return a generator here. It's important that this is iterated over
+        # slowly, otherwise we risk hammering our Riak servers to death.
+        def opted_in_addrs_generator():
+            # NOTE: This is a generator, *not* an async flattener.
+            for addrs_bunch in addrs_iter:
+                yield self._filter_opted_out_addrs(addrs_bunch, is_opted_in)
+
+        returnValue(opted_in_addrs_generator())
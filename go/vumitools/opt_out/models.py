@@ -53,6 +53,18 @@ class OptOutStore(PerAccountStore):
     def list_opt_outs(self):
         return self.list_keys(self.opt_outs)
 
+    @Manager.calls_manager
+    def opt_out_ids(self):
+        """
+        Return the set of ids of all the account's opt outs. Checking
+        ``opt_out_id(addr_type, addr_value)`` against this set avoids
+        loading an opt out for every address when checking many addresses.
+        """
+        keys = yield self.list_opt_outs()
+        returnValue(set(
+            key.encode('utf-8') if isinstance(key, unicode) else key
+            for key in keys))
+
     def count(self):
         return self.opt_outs.index_lookup(
             'user_account', self.user_account_key).get_count()
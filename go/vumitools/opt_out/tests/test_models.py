@@ -91,6 +91,22 @@ class TestOptOutStore(VumiTestCase):
         opt_outs = yield self.opt_out_store.list_opt_outs()
         self.assertEqual(opt_outs, [])
 
+    @inlineCallbacks
+    def test_opt_out_ids(self):
+        addrs = [("msisdn", u"+1234"), ("mxit", u"fo\xf6")]
+        for addr_type, addr in addrs:
+            yield self.opt_out_store.new_opt_out(
+                addr_type, addr, self.msg_helper.make_inbound("inbound"))
+        opt_out_ids = yield self.opt_out_store.opt_out_ids()
+        self.assertEqual(opt_out_ids, set([
+            self.opt_out_store.opt_out_id(addr_type, addr)
+            for addr_type, addr in addrs]))
+
+    @inlineCallbacks
+    def test_opt_out_ids_empty(self):
+        opt_out_ids = yield self.opt_out_store.opt_out_ids()
+        self.assertEqual(opt_out_ids, set())
+
     @inlineCallbacks
     def test_count(self):
         store = self.opt_out_store
@@ -0,0 +1,94 @@
+# -*- test-case-name: go.vumitools.tests.test_outbound_hops -*-
+
+"""Short-lived record of the routing metadata of outbound messages."""
+
+import json
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.redis_commands import RedisCommands
+
+
+class OutboundHopCache(object):
+    """Routing metadata of recently sent outbound messages, stored in Redis.
+
+    Events need the hops, tag and account of the outbound message they
+    refer to. Most transports don't include these on events, so the
+    routing dispatcher records them here when it publishes an outbound
+    message to a transport. Entries expire after `ttl` seconds. The
+    message store is the fallback for events that arrive later than that.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    :param int ttl:
+        Number of seconds to keep entries for. If this is zero, nothing is
+        stored.
+    """
+
+    def __init__(self, redis, ttl):
+        self.manager = redis
+        self.commands = RedisCommands(redis)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+    def _hops_key(self, message_id):
+        return "hops.%s" % (message_id,)
+
+    @Manager.calls_manager
+    def store(self, message_id, hops, tag, user_account_key,
+              unroutable_reply=False):
+        """Record the routing metadata for an outbound message."""
+        if self.ttl <= 0:
+            return
+        self.round_trips += 1
+        yield self.manager.setex(
+            self._hops_key(message_id), int(self.ttl), json.dumps({
+                "hops": hops,
+                "tag": list(tag) if tag is not None else None,
+                "user_account": user_account_key,
+                "unroutable_reply": unroutable_reply,
+            }))
+
+    @Manager.calls_manager
+    def get(self, message_id):
+        """Return the routing metadata for an outbound message.
+
+        Returns a dict with `hops`, `tag`, `user_account` and
+        `unroutable_reply` keys, or `None` if no metadata is stored for the
+        message.
+        """
+        self.round_trips += 1
+        data = yield self.manager.get(self._hops_key(message_id))
+        if data is None:
+            self.misses += 1
+            returnValue(None)
+        self.hits += 1
+        returnValue(json.loads(data))
+
+    @Manager.calls_manager
+    def get_many(self, message_ids):
+        """Return the routing metadata for several outbound messages with a
+        single request.
+
+        Returns a list containing the dict :meth:`get` would return for
+        each message, in the same order.
+        """
+        if not message_ids:
+            returnValue([])
+        self.round_trips += 1
+        values = yield self.commands.mget(
+            [self._hops_key(message_id) for message_id in message_ids])
+        results = []
+        for data in values:
+            if data is None:
+                self.misses += 1
+                results.append(None)
+            else:
+                self.hits += 1
+                results.append(json.loads(data))
+        returnValue(results)
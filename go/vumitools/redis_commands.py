@@ -0,0 +1,40 @@
+# -*- test-case-name: go.vumitools.tests.test_redis_commands -*-
+
+"""Redis commands that vumi's Redis managers don't provide.
+
+The commands are built with the same `RedisCall` machinery the managers use
+for their own commands, so the manager's key prefix is applied and the call
+goes to whichever client the manager uses. `FakeRedis` doesn't implement
+them, so tests that use it need
+:class:`go.vumitools.tests.helpers.FakeRedisCommandsHelper`.
+"""
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager, RedisCall, make_callfunc
+
+
+_mget = make_callfunc(
+    'mget', RedisCall([], vararg='keys', key_args=['keys']))
+
+
+class RedisCommands(object):
+    """Extra Redis commands for a Redis manager.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    @Manager.calls_manager
+    def mget(self, keys):
+        """Return a list of the values of `keys`, with `None` for keys that
+        don't exist.
+        """
+        if not keys:
+            returnValue([])
+        values = yield _mget(self.manager, *keys)
+        returnValue(values)
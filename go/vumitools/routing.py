@@ -1,14 +1,28 @@
 # -*- test-case-name: go.vumitools.tests.test_routing -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import hashlib
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed)
+from twisted.python.failure import Failure
 
 from vumi.dispatchers.endpoint_dispatchers import RoutingTableDispatcher
-from vumi.config import ConfigDict, ConfigText
-from vumi.message import TransportEvent
+from vumi.config import (
+    ConfigDict, ConfigText, ConfigInt, ConfigFloat, ConfigBool, ConfigError)
+from vumi.message import TransportEvent, TransportUserMessage
+from vumi.blinkenlights.metrics import MetricManager
 from vumi import log
 
+from go.config import get_go_metrics_prefix
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
+from go.vumitools.batching import ConcurrentConsumerMixin, MicroBatcher
+from go.vumitools.billing_costs import FreeMessageIndex
+from go.vumitools.billing_worker import BillingApi, BillingDispatcher
+from go.vumitools.outbound_hops import OutboundHopCache
+from go.vumitools.routing_metrics import RoutingMetrics, timed_stage
 from go.vumitools.routing_table import GoConnector
+from go.vumitools.routing_table_cache import RoutingTableCache
+from go.vumitools.tag_ownership import TagOwnershipIndex
 
 
 class RoutingError(Exception):
@@ -54,36 +68,87 @@ class RoutingMetadata(object):
     to event messages. It allows dispatching events through multiple
     routers while only retrieving the outbound message from the message
     store once.
+
+    If `compact` is set, the connector strings in both hop lists are
+    replaced by indexes into a list of connectors stored in
+    `go_hop_connectors`, so that each connector string is only included
+    once per message. Messages that already have `go_hop_connectors` keep
+    using the compact form. Hops in either form can always be read.
     """
 
-    def __init__(self, msg, outbound=None):
+    HOP_CONNECTORS_KEY = 'go_hop_connectors'
+
+    def __init__(self, msg, outbound=None, compact=False):
         self._msg = msg
+        self._compact = (
+            compact or self.HOP_CONNECTORS_KEY in msg['routing_metadata'])
+
+    def _decode_hops(self, hops):
+        connectors = self._msg['routing_metadata'].get(
+            self.HOP_CONNECTORS_KEY)
+        if not hops or connectors is None:
+            return hops
+
+        def decode(conn_ep):
+            if conn_ep is None:
+                return None
+            conn, endpoint = conn_ep
+            if isinstance(conn, (int, long)):
+                conn = connectors[conn]
+            return [conn, endpoint]
+
+        return [[decode(src), decode(dst)] for src, dst in hops]
+
+    def _encode_hops(self, hops):
+        if not self._compact:
+            return hops
+        connectors = self._msg['routing_metadata'].setdefault(
+            self.HOP_CONNECTORS_KEY, [])
+        indexes = dict((conn, i) for i, conn in enumerate(connectors))
+
+        def encode(conn_ep):
+            if conn_ep is None:
+                return None
+            conn, endpoint = conn_ep
+            if conn not in indexes:
+                indexes[conn] = len(connectors)
+                connectors.append(conn)
+            return [indexes[conn], endpoint]
+
+        return [[encode(src), encode(dst)] for src, dst in hops]
 
     def get_hops(self):
-        """Return a reference to the hops list for the message."""
+        """Return the hops list for the message.
+
+        If the hops are stored in compact form this is a decoded copy, so
+        changes must be saved with :meth:`set_hops`.
+        """
         hops = self._msg['routing_metadata'].setdefault('go_hops', [])
-        return hops
+        return self._decode_hops(hops)
 
     def set_hops(self, hops):
         """Set the hops list for the message."""
-        self._msg['routing_metadata']['go_hops'] = hops[:]
+        self._msg['routing_metadata']['go_hops'] = self._encode_hops(hops[:])
 
     def get_outbound_hops(self):
-        """Return a reference to the cached outbound hops list.
+        """Return the cached outbound hops list.
 
-        Returns None if no cached outbound hops are present.
+        Returns None if no cached outbound hops are present. If the hops are
+        stored in compact form this is a decoded copy.
         """
         outbound_hops = self._msg['routing_metadata'].get('go_outbound_hops')
-        return outbound_hops
+        return self._decode_hops(outbound_hops)
 
     def set_outbound_hops(self, outbound_hops):
         """Set the cached list of outbound hops."""
-        self._msg['routing_metadata']['go_outbound_hops'] = outbound_hops[:]
+        self._msg['routing_metadata']['go_outbound_hops'] = (
+            self._encode_hops(outbound_hops[:]))
 
     def push_hop(self, source, destination):
         """Appends a `[source, destination]` pair to the hops list."""
         hops = self.get_hops()
         hops.append([source, destination])
+        self.set_hops(hops)
 
     def push_source(self, go_connector_str, endpoint):
         """Append a new hop to the hops list with destination set to None.
@@ -99,6 +164,7 @@ class RoutingMetadata(object):
                 " %r. Second source was %r." % (hops[-1][1], source),
                 self._msg)
         hops.append([source, None])
+        self.set_hops(hops)
 
     def push_destination(self, go_connector_str, endpoint):
         """Set the destination of the most recent hop.
@@ -112,6 +178,7 @@ class RoutingMetadata(object):
                 "Attempt to push destination hop without first pushing the"
                 " source hop. Destination is %r" % (destination,), self._msg)
         hops[-1][1] = destination
+        self.set_hops(hops)
 
     def next_hop(self):
         """Computes the next hop assuming this message is following the
@@ -189,6 +256,16 @@ class RoutingMetadata(object):
         return (dst == outbound_dst and src == outbound_src)
 
 
+def shard_for_account(user_account_key, shard_count):
+    """Return the index of the dispatcher shard that owns an account.
+
+    Account keys are hashed into the range `[0, 2**32)`, which is split into
+    `shard_count` equal, contiguous ranges.
+    """
+    digest = hashlib.md5(user_account_key.encode('utf-8')).hexdigest()
+    return (int(digest[:8], 16) * shard_count) >> 32
+
+
 class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
                                           GoWorkerConfigMixin):
     application_connector_mapping = ConfigDict(
@@ -211,6 +288,15 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
     billing_outbound_connector = ConfigText(
         "Connector to publish outbound messages on.",
         static=True, required=False)
+    billing_api_url = ConfigText(
+        "Base URL of the billing REST API. If this is set, messages whose"
+        " message and session costs are both zero are marked as paid and"
+        " routed without passing through the billing worker.",
+        static=True, required=False)
+    billing_cost_refresh_interval = ConfigFloat(
+        "Number of seconds between refreshes of the message costs fetched"
+        " from the billing API.",
+        default=60.0, static=True, required=False)
     user_account_key = ConfigText(
         "Key of the user account the message is from.")
     default_unroutable_inbound_reply = ConfigText(
@@ -219,6 +305,70 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         " `unroutable_inbound_reply`.",
         default="Vumi Go could not route your message. Please try again soon.",
         static=True, required=False)
+    routing_table_cache_size = ConfigInt(
+        "Maximum number of account routing tables to cache.",
+        default=1000, static=True, required=False)
+    routing_table_cache_ttl = ConfigFloat(
+        "Number of seconds to cache account routing tables for. Routing"
+        " table updates invalidate cached tables immediately, so this only"
+        " bounds how stale a table saved without a version bump can be."
+        " Set to zero to disable caching.",
+        default=60.0, static=True, required=False)
+    tag_ownership_refresh_interval = ConfigFloat(
+        "Minimum number of seconds between checks for changes to tag"
+        " ownership. Tag owners and tagpool metadata are otherwise served"
+        " from memory.",
+        default=5.0, static=True, required=False)
+    outbound_hop_cache_ttl = ConfigInt(
+        "Number of seconds to remember the hops, tag and account of outbound"
+        " messages sent to transports for. Events for messages older than"
+        " this load the outbound message from the message store instead."
+        " Set to zero to always use the message store.",
+        default=3600, static=True, required=False)
+    event_batch_size = ConfigInt(
+        "Maximum number of events to route together. The routing metadata"
+        " for a batch of events is fetched at once. Events are only"
+        " acknowledged once their batch has been routed, so a batch can't"
+        " hold more than `amqp_prefetch_count` events. Set to zero to route"
+        " events one at a time.",
+        default=0, static=True, required=False)
+    event_batch_delay = ConfigFloat(
+        "Maximum number of seconds to wait for a batch of events to fill"
+        " before routing it.",
+        default=0.05, static=True, required=False)
+    compact_hops = ConfigBool(
+        "Store routing hops on messages in compact form, with each connector"
+        " string only included once per message. Only enable this once all"
+        " workers that read routing hops understand the compact form.",
+        default=False, static=True, required=False)
+    shard_count = ConfigInt(
+        "Number of dispatcher shards. Each shard routes messages for the"
+        " accounts whose keys hash into its range and forwards any other"
+        " messages it receives to the shard that owns them. All shards must"
+        " have the same connectors, `shard_count` and `shard_queue_prefix`.",
+        default=1, static=True, required=False)
+    shard_index = ConfigInt(
+        "Index of this shard, from zero to `shard_count - 1`.",
+        default=0, static=True, required=False)
+    shard_queue_prefix = ConfigText(
+        "Prefix for the names of the queues messages are forwarded between"
+        " shards on.",
+        default="routing_table_dispatcher_shard", static=True,
+        required=False)
+    hot_path_metrics_sample_rate = ConfigInt(
+        "Publish timings of the stages of routing for one in every this"
+        " many messages, along with datastore round trips per message and"
+        " cache hit ratios. Set to zero to disable these metrics.",
+        default=0, static=True, required=False)
+    hot_path_metrics_interval = ConfigInt(
+        "Number of seconds between publishing hot path metrics.",
+        default=60, static=True, required=False)
+
+    def post_validate(self):
+        if not 0 <= self.shard_index < self.shard_count:
+            raise ConfigError(
+                "Shard index %r is not in the range of shards (%r shards)."
+                % (self.shard_index, self.shard_count))
 
 
 class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
@@ -275,6 +425,13 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
     Messages received from these sources are expected to include the same
     metadata.
+
+    The dispatcher may be run as several shards (see `shard_count`), each
+    consuming from the same connectors. Every account is owned by exactly
+    one shard, chosen by hashing the account key. Messages and events for
+    accounts owned by another shard are forwarded to it before any hops
+    are recorded, so each account's messages are routed (and its routing
+    table cached) by a single shard.
     """
 
     CONFIG_CLASS = AccountRoutingTableDispatcherConfig
@@ -291,6 +448,15 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
     INBOUND = GoConnector.INBOUND
     OUTBOUND = GoConnector.OUTBOUND
 
+    event_batcher = None
+    compact_hops = False
+    shard_count = 1
+    shard_index = 0
+    routing_metrics = None
+    free_messages = None
+    # Number of requests made to the message store.
+    round_trips = 0
+
     @inlineCallbacks
     def setup_dispatcher(self):
         yield super(AccountRoutingTableDispatcher, self).setup_dispatcher()
@@ -320,12 +486,149 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             config.receive_inbound_connectors)
         self.transport_connectors.discard(
             self.router_connectors)
+        self.routing_table_cache = RoutingTableCache(
+            self.vumi_api.routing_table_versions,
+            config.routing_table_cache_size, config.routing_table_cache_ttl)
+        self.tag_index = TagOwnershipIndex(
+            self.vumi_api, config.tag_ownership_refresh_interval)
+        yield self.tag_index.load()
+        self.outbound_hop_cache = OutboundHopCache(
+            self.redis.sub_manager('outbound_hop_cache'),
+            config.outbound_hop_cache_ttl)
+        if config.event_batch_size > 0:
+            self.event_batcher = MicroBatcher(
+                self._process_event_batch, config.event_batch_size,
+                config.event_batch_delay)
+        if config.billing_api_url:
+            self.free_messages = FreeMessageIndex(
+                BillingApi(config.billing_api_url),
+                config.billing_cost_refresh_interval)
+        self.compact_hops = config.compact_hops
+        self.shard_count = config.shard_count
+        self.shard_index = config.shard_index
+        self.shard_publishers = {}
+        self.shard_consumers = []
+        if self.shard_count > 1:
+            yield self.setup_shards(config)
+        if config.hot_path_metrics_sample_rate > 0:
+            self.setup_routing_metrics(config)
 
     @inlineCallbacks
     def teardown_dispatcher(self):
+        if self.routing_metrics is not None:
+            self.routing_metrics.metric_manager.stop_polling()
+        if self.free_messages is not None:
+            yield self.free_messages.billing_api.close()
+        if self.event_batcher is not None:
+            yield self.event_batcher.flush()
+        for consumer in self.shard_consumers:
+            yield consumer.stop()
         yield self._go_teardown_worker()
         yield super(AccountRoutingTableDispatcher, self).teardown_dispatcher()
 
+    def setup_routing_metrics(self, config):
+        """Start publishing timings and counters for the routing hot path.
+        """
+        metric_manager = MetricManager(
+            "%s%s." % (get_go_metrics_prefix(), self.worker_name),
+            config.hot_path_metrics_interval, publisher=self.metric_publisher)
+        self.routing_metrics = RoutingMetrics(
+            metric_manager, config.hot_path_metrics_sample_rate)
+        self.routing_metrics.add_cache(
+            'routing_table_cache', self.routing_table_cache)
+        self.routing_metrics.add_cache('tag_ownership', self.tag_index)
+        self.routing_metrics.add_cache(
+            'outbound_hop_cache', self.outbound_hop_cache)
+        self.routing_metrics.add_round_trip_source(self)
+        metric_manager.start_polling()
+
+    def _mkhandler(self, handler_func, errback_func, connector_name):
+        handler = super(AccountRoutingTableDispatcher, self)._mkhandler(
+            handler_func, errback_func, connector_name)
+
+        def timed_handler(msg):
+            if self.routing_metrics is None:
+                return handler(msg)
+            return self.routing_metrics.process_message(msg, handler, msg)
+        return timed_handler
+
+    @inlineCallbacks
+    def setup_shards(self, config):
+        """Consume messages forwarded to this shard and start publishers
+        for forwarding messages to the other shards.
+        """
+        handlers = {
+            'inbound': (TransportUserMessage, self.process_inbound,
+                        self.errback_inbound),
+            'outbound': (TransportUserMessage, self.process_outbound,
+                         self.errback_outbound),
+            'event': (TransportEvent, self.process_event,
+                      self.errback_event),
+        }
+        for shard in range(self.shard_count):
+            for message_type, (message_class, handler_func,
+                               errback_func) in handlers.iteritems():
+                routing_key = "%s.%d.%s" % (
+                    config.shard_queue_prefix, shard, message_type)
+                if shard == self.shard_index:
+                    consumer = yield self.consume(
+                        routing_key,
+                        self._mk_shard_handler(handler_func, errback_func),
+                        message_class=message_class,
+                        prefetch_count=config.amqp_prefetch_count)
+                    self.shard_consumers.append(consumer)
+                else:
+                    publisher = yield self.publish_to(routing_key)
+                    self.shard_publishers[(shard, message_type)] = publisher
+
+    def _mk_shard_handler(self, handler_func, errback_func):
+        def handler(msg):
+            connector_name = msg['routing_metadata'].pop('go_shard_connector')
+            return self._mkhandler(
+                handler_func, errback_func, connector_name)(msg)
+        return handler
+
+    def owns_account(self, user_account_key):
+        """Return `True` if this shard routes messages for
+        `user_account_key`.
+        """
+        if self.shard_count <= 1:
+            return True
+        return (shard_for_account(user_account_key, self.shard_count)
+                == self.shard_index)
+
+    def forward_to_shard(self, msg, message_type, connector_name,
+                         user_account_key):
+        """Forward a message to the shard that owns `user_account_key`.
+
+        Returns a deferred that fires with `True` if the message was
+        forwarded or `False` if this shard owns the account (or the message
+        has no account) and should route the message itself.
+        """
+        if user_account_key is None or self.owns_account(user_account_key):
+            return succeed(False)
+        shard = shard_for_account(user_account_key, self.shard_count)
+        publisher = self.shard_publishers[(shard, message_type)]
+        # The message is serialized when it is published, so the connector
+        # name is only attached for the forwarded copy.
+        msg['routing_metadata']['go_shard_connector'] = connector_name
+        d = maybeDeferred(publisher.publish_message, msg)
+        del msg['routing_metadata']['go_shard_connector']
+        return d.addCallback(lambda _: True)
+
+    def process_command_flush_routing_table_cache(self,
+                                                  user_account_key=None):
+        """Remove cached routing tables.
+
+        Removes the routing table for `user_account_key` if one is given,
+        otherwise removes all cached routing tables.
+        """
+        if user_account_key is None:
+            self.routing_table_cache.clear()
+        else:
+            self.routing_table_cache.invalidate(user_account_key)
+
+    @timed_stage('get_config')
     @inlineCallbacks
     def get_config(self, msg):
         """Determine the config (primarily the routing table) for the given
@@ -337,6 +640,9 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         For a given message there are two cases. Either it already has
         a user account key in the Vumi Go helper metadata, or it is from
         a transport and has a tag.
+
+        Messages for accounts owned by another shard are only forwarded to
+        it, so their routing tables aren't loaded.
         """
         if isinstance(msg, TransportEvent):
             config_dict = self.config.copy()
@@ -349,8 +655,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         if msg_mdh.has_user_account():
             user_account_key = msg_mdh.get_account_key()
         elif msg_mdh.tag is not None:
-            tag_info = yield msg_mdh.get_tag_info()
-            user_account_key = tag_info.metadata['user_account']
+            user_account_key = yield self.get_tag_owner(msg, msg_mdh.tag)
             if user_account_key is None:
                 raise UnownedTagError(
                     "Message received for unowned tag.", msg)
@@ -358,15 +663,25 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             raise UnroutableMessageError(
                 "No user account key or tag on message", msg)
 
-        user_api = self.get_user_api(user_account_key)
-        routing_table = yield user_api.get_routing_table()
-
         config_dict = self.config.copy()
         config_dict['user_account_key'] = user_account_key
-        config_dict['routing_table'] = routing_table._routing_table
+        if self.owns_account(user_account_key):
+            user_api = self.get_user_api(user_account_key)
+            routing_table = yield self.routing_table_cache.get_routing_table(
+                user_api)
+            config_dict['routing_table'] = routing_table.as_dict()
+        else:
+            config_dict['routing_table'] = {}
 
         returnValue(self.CONFIG_CLASS(config_dict))
 
+    @timed_stage('tag_lookup')
+    def get_tag_owner(self, msg, tag):
+        """Return the key of the account that owns the tag `msg` was
+        received on.
+        """
+        return self.tag_index.get_owner(tag)
+
     def connector_type(self, connector_name):
         if connector_name in self.billing_connectors:
             return self.BILLING
@@ -403,6 +718,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         }.get(direction)
         return router_direction
 
+    @timed_stage('set_destination')
     @inlineCallbacks
     def set_destination(self, msg, target, direction, push_hops=True):
         """Parse a target `(str(go_connector), endpoint)` pair and determine
@@ -439,7 +755,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         elif conn.ctype == conn.TRANSPORT_TAG:
             msg_mdh.set_tag([conn.tagpool, conn.tagname])
-            tagpool_metadata = yield msg_mdh.get_tagpool_metadata()
+            tagpool_metadata = yield self.tag_index.get_tagpool_metadata(
+                conn.tagpool)
             transport_name = tagpool_metadata.get('transport_name')
             if transport_name is None:
                 raise UnroutableMessageError(
@@ -536,7 +853,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         src_conn_str = str(src_conn)
         if push_hops:
-            rmeta = RoutingMetadata(msg)
+            rmeta = RoutingMetadata(msg, compact=self.compact_hops)
             rmeta.push_source(src_conn_str, msg.get_routing_endpoint())
         return src_conn_str
 
@@ -583,6 +900,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             msg, [str(dst_conn), 'default'], self.OUTBOUND)
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
+    @timed_stage('billing', msg_arg=1)
     @inlineCallbacks
     def publish_inbound_to_billing(self, config, msg):
         """Publish an inbound message to the billing worker."""
@@ -592,6 +910,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         yield self.publish_inbound(msg, dst_connector_name, dst_endpoint)
 
+    @timed_stage('billing', msg_arg=1)
     @inlineCallbacks
     def publish_outbound_to_billing(self, config, msg, tag):
         """Publish an outbound message to the billing worker."""
@@ -603,6 +922,26 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
+    def mark_paid_if_free(self, config, msg, tag, direction):
+        """Mark `msg` as paid and return `True` if messages for its account
+        via `tag` in `direction` cost nothing, otherwise return `False`.
+
+        Free messages don't need to pass through the billing worker.
+        """
+        if self.free_messages is None:
+            return False
+        if direction == self.INBOUND:
+            message_direction = BillingDispatcher.MESSAGE_DIRECTION_INBOUND
+        else:
+            message_direction = BillingDispatcher.MESSAGE_DIRECTION_OUTBOUND
+        if not self.free_messages.is_free(
+                config.user_account_key, tag[0], message_direction):
+            return False
+        msg_mdh = self.get_metadata_helper(msg)
+        msg_mdh.set_tag(tag)
+        msg_mdh.set_paid()
+        return True
+
     @inlineCallbacks
     def publish_outbound_from_billing(self, config, msg):
         """Publish an outbound message to its intended destination
@@ -628,7 +967,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             # but this is an error path)
             f.raiseException()
 
-        tagpool_metadata = yield msg_mdh.get_tagpool_metadata()
+        tagpool_metadata = yield self.tag_index.get_tagpool_metadata(
+            msg_mdh.tag[0])
         if not tagpool_metadata.get('reply_to_unroutable_inbound'):
             f.raiseException()
 
@@ -650,7 +990,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         # mark as an unroutable reply
         reply_rmeta = RoutingMetadata(reply)
         reply_rmeta.set_unroutable_reply()
-        self.publish_outbound(
+        yield self.publish_outbound(
             reply, dst_connector_name, dst_endpoint)
 
     def errback_inbound(self, f, msg, connector_name):
@@ -675,6 +1015,11 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         * the billing worker
         """
         log.debug("Processing inbound: %r" % (msg,))
+        forwarded = yield self.forward_to_shard(
+            msg, 'inbound', connector_name, config.user_account_key)
+        if forwarded:
+            return
+
         msg_mdh = self.get_metadata_helper(msg)
         msg_mdh.set_user_account(config.user_account_key)
 
@@ -683,8 +1028,10 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         if self.billing_inbound_connector:
             if connector_type == self.TRANSPORT_TAG:
-                yield self.publish_inbound_to_billing(config, msg)
-                return
+                if not self.mark_paid_if_free(
+                        config, msg, msg_mdh.tag, self.INBOUND):
+                    yield self.publish_inbound_to_billing(config, msg)
+                    return
             if connector_type == self.BILLING:
                 # set the src_conn to the transport and keep routing
                 src_conn = str(GoConnector.for_transport_tag(*msg_mdh.tag))
@@ -722,6 +1069,11 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         * the billing worker
         """
         log.debug("Processing outbound: %s" % (msg,))
+        forwarded = yield self.forward_to_shard(
+            msg, 'outbound', connector_name, config.user_account_key)
+        if forwarded:
+            return
+
         msg_mdh = self.get_metadata_helper(msg)
         msg_mdh.set_user_account(config.user_account_key)
 
@@ -733,7 +1085,10 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 msg_mdh.reset_paid()
             elif connector_type == self.OPT_OUT:
                 tag = yield self.tag_for_reply(msg)
-                yield self.publish_outbound_to_billing(config, msg, tag)
+                if self.mark_paid_if_free(config, msg, tag, self.OUTBOUND):
+                    yield self.publish_outbound_from_billing(config, msg)
+                else:
+                    yield self.publish_outbound_to_billing(config, msg, tag)
                 return
             elif connector_type == self.BILLING:
                 yield self.publish_outbound_from_billing(config, msg)
@@ -753,92 +1108,206 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             target_conn = GoConnector.parse(target[0])
             if target_conn.ctype == target_conn.TRANSPORT_TAG:
                 tag = [target_conn.tagpool, target_conn.tagname]
-                yield self.publish_outbound_to_billing(config, msg, tag)
-                return
+                if not self.mark_paid_if_free(
+                        config, msg, tag, self.OUTBOUND):
+                    yield self.publish_outbound_to_billing(config, msg, tag)
+                    return
 
         dst_connector_name, dst_endpoint = yield self.set_destination(
             msg, target, self.OUTBOUND)
 
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
+    def _outbound_metadata(self, msg):
+        """Return the routing metadata an event needs from its outbound
+        message.
+
+        The metadata is a dict with `hops`, `tag`, `user_account` and
+        `unroutable_reply` keys.
+        """
+        msg_mdh = self.get_metadata_helper(msg)
+        msg_rmeta = RoutingMetadata(msg)
+        user_account_key = None
+        if msg_mdh.has_user_account():
+            user_account_key = msg_mdh.get_account_key()
+        return {
+            "hops": msg_rmeta.get_hops(),
+            "tag": msg_mdh.tag,
+            "user_account": user_account_key,
+            "unroutable_reply": msg_rmeta.get_unroutable_reply(),
+        }
+
+    @timed_stage('publish')
+    def publish_inbound(self, msg, connector_name, endpoint):
+        return super(AccountRoutingTableDispatcher, self).publish_inbound(
+            msg, connector_name, endpoint)
+
+    @timed_stage('publish')
     @inlineCallbacks
-    def _set_event_metadata(self, event):
-        """Sets the user account, tag and outbound hops metadata on an event
-        if it does not already have them.
+    def publish_outbound(self, msg, connector_name, endpoint):
+        """Publish an outbound message, remembering its routing metadata if
+        it is going to a transport so that events for it can be routed
+        without loading it from the message store.
+        """
+        if self.connector_type(connector_name) == self.TRANSPORT_TAG:
+            metadata = self._outbound_metadata(msg)
+            yield self.outbound_hop_cache.store(
+                msg['message_id'], metadata["hops"], metadata["tag"],
+                metadata["user_account"], metadata["unroutable_reply"])
+        yield super(AccountRoutingTableDispatcher, self).publish_outbound(
+            msg, connector_name, endpoint)
+
+    @timed_stage('publish')
+    def publish_event(self, event, connector_name, endpoint):
+        return super(AccountRoutingTableDispatcher, self).publish_event(
+            event, connector_name, endpoint)
+
+    def _needs_outbound_metadata(self, event):
+        """Return `True` if an event is missing any of the user account,
+        tag or outbound hops metadata.
         """
         # TODO: the setdefault can be removed once Vumi events have
         #       helper_metadata
         event.payload.setdefault('helper_metadata', {})
         event_mdh = self.get_metadata_helper(event)
         event_rmeta = RoutingMetadata(event)
+        return (event_rmeta.get_outbound_hops() is None
+                or not event_mdh.has_user_account()
+                or event_mdh.tag is None)
 
-        if (event_rmeta.get_outbound_hops() is not None
-                and event_mdh.has_user_account()
-                and event_mdh.tag is not None):
-            return
+    @inlineCallbacks
+    def _get_outbound_metadata(self, event):
+        """Return the routing metadata of the outbound message for an event.
 
-        # some metadata is missing, grab the associated outbound message
-        # and look for it there:
+        The outbound hop cache is checked first. If the metadata isn't
+        there, the outbound message is loaded from the message store.
 
+        Returns a tuple of `(outbound, metadata)`. `outbound` describes the
+        source of the metadata for use in error messages and `metadata` is
+        the dict returned by :meth:`_outbound_metadata`.
+        """
+        user_message_id = event.get('user_message_id')
+        if user_message_id is not None:
+            metadata = yield self.outbound_hop_cache.get(user_message_id)
+            if metadata is not None:
+                returnValue((
+                    "cached hops for %s" % (user_message_id,), metadata))
+
+        self.round_trips += 1
         msg = yield self.find_message_for_event(event)
         if msg is None:
             raise UnroutableMessageError(
                 "Could not find transport user message for event", event)
-        msg_mdh = self.get_metadata_helper(msg)
-        msg_rmeta = RoutingMetadata(msg)
-        msg_unroutable = msg_rmeta.get_unroutable_reply()
+        returnValue((msg, self._outbound_metadata(msg)))
+
+    @inlineCallbacks
+    def _get_outbound_metadata_batch(self, events):
+        """Return the routing metadata of the outbound messages for a batch
+        of events.
+
+        The outbound hop cache is checked for all of the events with a
+        single request and the remaining outbound messages are loaded from
+        the message store in bunches.
+
+        Returns a dict mapping outbound message ids to `(outbound,
+        metadata)` tuples, as returned by :meth:`_get_outbound_metadata`.
+        Outbound messages that can't be found are left out.
+        """
+        message_ids = []
+        for event in events:
+            user_message_id = event.get('user_message_id')
+            if (user_message_id is not None
+                    and user_message_id not in message_ids
+                    and self._needs_outbound_metadata(event)):
+                message_ids.append(user_message_id)
+
+        outbound_metadata = {}
+        cached = yield self.outbound_hop_cache.get_many(message_ids)
+        missing_ids = []
+        for message_id, metadata in zip(message_ids, cached):
+            if metadata is None:
+                missing_ids.append(message_id)
+            else:
+                outbound_metadata[message_id] = (
+                    "cached hops for %s" % (message_id,), metadata)
+
+        outbound_messages = self.vumi_api.mdb.outbound_messages
+        for bunch in outbound_messages.load_all_bunches(missing_ids):
+            self.round_trips += 1
+            for outbound_message in (yield bunch):
+                msg = outbound_message.msg
+                outbound_metadata[outbound_message.key] = (
+                    msg, self._outbound_metadata(msg))
+
+        returnValue(outbound_metadata)
 
-        msg_hops = msg_rmeta.get_hops()
+    @inlineCallbacks
+    def _set_event_metadata(self, event, outbound_metadata=None):
+        """Sets the user account, tag and outbound hops metadata on an event
+        if it does not already have them.
+
+        If `outbound_metadata` is given, it should be a dict returned by
+        :meth:`_get_outbound_metadata_batch`. Outbound messages not in it
+        are looked up individually.
+        """
+        if not self._needs_outbound_metadata(event):
+            return
+
+        # some metadata is missing, grab the routing metadata of the
+        # associated outbound message and look for it there:
+
+        user_message_id = event.get('user_message_id')
+        if (outbound_metadata is not None
+                and user_message_id in outbound_metadata):
+            outbound, metadata = outbound_metadata[user_message_id]
+        else:
+            outbound, metadata = yield self._get_outbound_metadata(event)
+
+        event_mdh = self.get_metadata_helper(event)
+        event_rmeta = RoutingMetadata(event, compact=self.compact_hops)
+        msg_unroutable = metadata["unroutable_reply"]
+
+        msg_hops = metadata["hops"]
         event_rmeta.set_outbound_hops(msg_hops)
 
         if msg_unroutable:
             event_rmeta.set_unroutable_reply()
 
-        if msg_mdh.tag is None:
+        if metadata["tag"] is None:
             raise UnroutableMessageError(
-                "Outbound message for event has no tag set: %r" % (msg,),
-                event)
+                "Outbound message for event has no tag set: %r"
+                % (outbound,), event)
         # set the tag on the event so that if it is from a transport
         # we can set the source of the message correctly in acquire_source.
-        event_mdh.set_tag(msg_mdh.tag)
+        event_mdh.set_tag(metadata["tag"])
 
         if not msg_unroutable or msg_hops:
             # unroutable replies without hops were never associated with a
             # user account and so aren't required to have one. All other
             # messages must.
-            if not msg_mdh.has_user_account():
+            if metadata["user_account"] is None:
                 raise UnroutableMessageError(
                     "Outbound message for event has no associated"
-                    " user account: %r" % (msg,), event)
-            event_mdh.set_user_account(msg_mdh.get_account_key())
+                    " user account: %r" % (outbound,), event)
+            event_mdh.set_user_account(metadata["user_account"])
 
     @inlineCallbacks
-    def process_event(self, config, event, connector_name):
-        """Process an event message.
-
-        Events must trace back the path through the routers
-        and conversations that was taken by the associated outbound
-        message.
-
-        Events thus ignore the routing table itself.
-
-        Events can be from:
-
-        * transports
-        * routers
-
-        And may go to:
-
-        * routers
-        * conversations
-        * the opt-out worker
+    def _route_event(self, event, connector_name, outbound_metadata=None):
+        """Route an event along the reverse of its outbound message's hops.
         """
-        log.debug("Processing event: %s" % (event,))
-
         # events are in same direction as inbound messages so
         # we use INBOUND as the direction in this method.
 
-        yield self._set_event_metadata(event)
+        yield self._set_event_metadata(event, outbound_metadata)
+
+        event_mdh = self.get_metadata_helper(event)
+        user_account_key = None
+        if event_mdh.has_user_account():
+            user_account_key = event_mdh.get_account_key()
+        forwarded = yield self.forward_to_shard(
+            event, 'event', connector_name, user_account_key)
+        if forwarded:
+            return
 
         # events for unroutable messages that have completed their hops
         # don't need to be processed further.
@@ -860,3 +1329,70 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         dst_connector_name, dst_endpoint = yield self.set_destination(
             event, target, self.INBOUND)
         yield self.publish_event(event, dst_connector_name, dst_endpoint)
+
+    @inlineCallbacks
+    def _process_event_batch(self, batch):
+        """Route a batch of `(event, connector_name)` pairs.
+
+        The routing metadata for all of the events is fetched up front and
+        the events are then published one at a time, in the order they
+        were received.
+
+        Returns a list containing `None` or a `Failure` for each event.
+        """
+        outbound_metadata = yield self._get_outbound_metadata_batch(
+            [event for event, _connector_name in batch])
+        results = []
+        for event, connector_name in batch:
+            try:
+                yield self._route_event(
+                    event, connector_name, outbound_metadata)
+            except Exception:
+                results.append(Failure())
+            else:
+                results.append(None)
+        returnValue(results)
+
+    def process_event(self, config, event, connector_name):
+        """Process an event message.
+
+        Events must trace back the path through the routers
+        and conversations that was taken by the associated outbound
+        message.
+
+        Events thus ignore the routing table itself.
+
+        Events can be from:
+
+        * transports
+        * routers
+
+        And may go to:
+
+        * routers
+        * conversations
+        * the opt-out worker
+
+        If `event_batch_size` is set, events are collected and routed in
+        batches rather than one at a time. The event consumers read the
+        next event without waiting for this one (see :meth:`start_consumer`)
+        and the event is only acknowledged once its batch has been routed.
+        """
+        log.debug("Processing event: %s" % (event,))
+        if self.event_batcher is not None:
+            return self.event_batcher.add((event, connector_name))
+        return self._route_event(event, connector_name)
+
+    def start_consumer(self, consumer_class, *args, **kw):
+        """Start a consumer.
+
+        If `event_batch_size` is set, event consumers handle several events
+        at once so that batches of events can fill up.
+        """
+        if (self.get_static_config().event_batch_size > 0 and
+                consumer_class.routing_key.endswith('.event')):
+            consumer_class = type(
+                consumer_class.__name__,
+                (ConcurrentConsumerMixin, consumer_class), {})
+        return super(AccountRoutingTableDispatcher, self).start_consumer(
+            consumer_class, *args, **kw)
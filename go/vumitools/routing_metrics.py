@@ -0,0 +1,177 @@
+# -*- test-case-name: go.vumitools.tests.test_routing_metrics -*-
+
+"""Instrumentation for the routing dispatcher's message processing."""
+
+import time
+from functools import wraps
+
+from twisted.internet.defer import maybeDeferred
+
+from vumi.blinkenlights.metrics import Metric, AVG, MAX, SUM
+
+
+class PolledDeltaMetric(Metric):
+    """Publishes how much a running total has increased since the last
+    poll.
+
+    :param str name:
+        Name of the metric.
+    :param total:
+        Function that returns the current value of the running total.
+    """
+
+    DEFAULT_AGGREGATORS = [SUM]
+
+    def __init__(self, name, total, aggregators=None):
+        super(PolledDeltaMetric, self).__init__(name, aggregators)
+        self.total = total
+        self._last = total()
+
+    def poll(self):
+        total = self.total()
+        delta, self._last = total - self._last, total
+        return [(int(time.time()), delta)]
+
+
+class PolledRatioMetric(Metric):
+    """Publishes the ratio between the increases in two running totals since
+    the last poll.
+
+    Nothing is published if the denominator hasn't increased.
+
+    :param str name:
+        Name of the metric.
+    :param numerator:
+        Function that returns the current value of the numerator total.
+    :param denominator:
+        Function that returns the current value of the denominator total.
+    """
+
+    def __init__(self, name, numerator, denominator, aggregators=None):
+        super(PolledRatioMetric, self).__init__(name, aggregators)
+        self.numerator = numerator
+        self.denominator = denominator
+        self._last = (numerator(), denominator())
+
+    def poll(self):
+        numerator, denominator = self.numerator(), self.denominator()
+        last_numerator, last_denominator = self._last
+        self._last = (numerator, denominator)
+        if denominator <= last_denominator:
+            return []
+        ratio = (float(numerator - last_numerator)
+                 / (denominator - last_denominator))
+        return [(int(time.time()), ratio)]
+
+
+class RoutingMetrics(object):
+    """Sampled stage timings and aggregate counters for a dispatcher.
+
+    One in every `sample_rate` messages has the time spent in each stage of
+    its processing recorded. Message counts, datastore round trips and
+    cache hit ratios are published for all messages, computed from running
+    totals when the metrics are polled, so they cost nothing per message.
+
+    :type metric_manager: :class:`vumi.blinkenlights.metrics.MetricManager`
+    :param metric_manager:
+        Manager to register the metrics with. The caller is responsible
+        for polling it.
+    :param int sample_rate:
+        Number of messages to process for each message timed.
+    :param clock:
+        Function that returns the current time in seconds.
+    """
+
+    STAGES = (
+        'total', 'get_config', 'tag_lookup', 'set_destination', 'publish',
+        'billing')
+
+    def __init__(self, metric_manager, sample_rate, clock=time.time):
+        self.metric_manager = metric_manager
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.messages = 0
+        self._sampled = set()
+        self._timers = {}
+        for stage in self.STAGES:
+            self._timers[stage] = metric_manager.register(
+                Metric('%s.time' % (stage,), [AVG, MAX]))
+        metric_manager.register(
+            PolledDeltaMetric('messages', lambda: self.messages))
+        self._round_trip_sources = []
+        metric_manager.register(PolledDeltaMetric(
+            'datastore_round_trips', self.get_round_trips))
+        metric_manager.register(PolledRatioMetric(
+            'datastore_round_trips_per_message', self.get_round_trips,
+            lambda: self.messages))
+
+    def add_cache(self, name, cache):
+        """Publish the hit ratio and round trips of `cache`.
+
+        `cache` must have `hits`, `misses` and `round_trips` counters.
+        """
+        self.add_round_trip_source(cache)
+        self.metric_manager.register(PolledRatioMetric(
+            '%s.hit_ratio' % (name,), lambda: cache.hits,
+            lambda: cache.hits + cache.misses))
+
+    def add_round_trip_source(self, source):
+        """Include the `round_trips` counter of `source` in the datastore
+        round trips.
+        """
+        self._round_trip_sources.append(source)
+
+    def get_round_trips(self):
+        return sum(source.round_trips for source in self._round_trip_sources)
+
+    def is_sampled(self, msg):
+        return id(msg) in self._sampled
+
+    def process_message(self, msg, func, *args, **kw):
+        """Call `func` to process `msg`, timing it if it is sampled."""
+        self.messages += 1
+        if self.sample_rate <= 0 or self.messages % self.sample_rate:
+            return func(*args, **kw)
+        self._sampled.add(id(msg))
+        d = self.time_stage(msg, 'total', func, *args, **kw)
+        d.addBoth(self._finish_sample, msg)
+        return d
+
+    def _finish_sample(self, result, msg):
+        self._sampled.discard(id(msg))
+        return result
+
+    def time_stage(self, msg, stage, func, *args, **kw):
+        """Call `func` and record how long it took as `stage` of processing
+        `msg`, if `msg` is being sampled.
+
+        Returns a deferred if `msg` is sampled, otherwise `func`'s result.
+        """
+        if id(msg) not in self._sampled:
+            return func(*args, **kw)
+        start = self.clock()
+
+        def record(result):
+            self._timers[stage].set(self.clock() - start)
+            return result
+
+        return maybeDeferred(func, *args, **kw).addBoth(record)
+
+
+def timed_stage(stage, msg_arg=0):
+    """Decorate a dispatcher method so that calls to it are timed as
+    `stage` of processing the message passed as positional argument
+    `msg_arg`.
+
+    The dispatcher's `routing_metrics` attribute may be `None`, in which
+    case nothing is timed.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kw):
+            if self.routing_metrics is None:
+                return func(self, *args, **kw)
+            return self.routing_metrics.time_stage(
+                args[msg_arg], stage, func, self, *args, **kw)
+        return wrapper
+    return decorator
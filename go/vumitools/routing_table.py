@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from vumi import log
 
 from go.errors import VumiGoError
@@ -12,7 +14,16 @@ class GoConnectorError(GoRoutingTableError):
 
 
 class GoConnector(object):
-    """Container for Go routing table connector item."""
+    """Container for Go routing table connector item.
+
+    Connectors are immutable. Connectors created by :meth:`parse` are
+    cached by connector string, so parsing the same string repeatedly
+    returns the same object.
+    """
+
+    __slots__ = ('ctype', 'conv_type', 'conv_key', 'router_type',
+                 'router_key', 'tagpool', 'tagname', '_direction', '_str',
+                 '_hash')
 
     # Types of connectors in Go routing tables
 
@@ -27,48 +38,62 @@ class GoConnector(object):
     INBOUND = "INBOUND"
     OUTBOUND = "OUTBOUND"
 
+    # Maximum number of parsed connectors to keep. The least recently used
+    # connector is dropped when the cache is full.
+
+    PARSE_CACHE_SIZE = 10000
+    _parse_cache = OrderedDict()
+
     def __init__(self, ctype, names, parts):
-        self.ctype = ctype
-        self._names = names
-        self._parts = parts
-        self._attrs = dict(zip(self._names, self._parts))
+        set_attr = super(GoConnector, self).__setattr__
+        set_attr('ctype', ctype)
+        for name, part in zip(names, parts):
+            # `direction` is a property that also covers connector types
+            # with a fixed direction.
+            set_attr('_direction' if name == 'direction' else name, part)
+        set_attr('_str', ":".join([ctype] + list(parts)))
+        set_attr('_hash', hash(self._str))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("GoConnector objects are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("GoConnector objects are immutable.")
+
+    def __reduce__(self):
+        return (GoConnector.parse, (self._str,))
 
     @property
     def direction(self):
+        if self.ctype in (self.ROUTER, self.BILLING):
+            return self._direction
         return {
             self.OPT_OUT: self.INBOUND,
             self.CONVERSATION: self.INBOUND,
             self.TRANSPORT_TAG: self.OUTBOUND,
-            self.ROUTER: self._attrs.get('direction'),
-            self.BILLING: self._attrs.get('direction'),
         }[self.ctype]
 
     def __str__(self):
-        return ":".join([self.ctype] + self._parts)
+        return self._str
 
     def __repr__(self):
-        return "<GoConnector: %r>" % str(self)
+        return "<GoConnector: %r>" % self._str
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, GoConnector):
             return False
-        return str(self) == str(other)
+        return self._str == other._str
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __cmp__(self, other):
-        if self == other:
-            return 0
-        if str(self) < str(other):
-            return -1
-        return 1
+        return cmp(str(self), str(other))
 
     def __hash__(self):
-        return hash(str(self))
-
-    def __getattr__(self, name):
-        return self._attrs[name]
+        return self._hash
 
     def flip_direction(self):
         if self.ctype != self.ROUTER:
@@ -113,6 +138,16 @@ class GoConnector(object):
 
     @classmethod
     def parse(cls, s):
+        conn = cls._parse_cache.pop(s, None)
+        if conn is None:
+            conn = cls._parse(s)
+            if len(cls._parse_cache) >= cls.PARSE_CACHE_SIZE:
+                cls._parse_cache.popitem(last=False)
+        cls._parse_cache[s] = conn
+        return conn
+
+    @classmethod
+    def _parse(cls, s):
         parts = s.split(":")
         ctype, parts = parts[0], parts[1:]
         constructors = {
@@ -154,12 +189,6 @@ class GoConnector(object):
             "Unknown object type for connector: %s" % (model_obj,))
 
 
-def _to_conn(conn):
-    if not isinstance(conn, GoConnector):
-        conn = GoConnector.parse(conn)
-    return conn
-
-
 class RoutingTable(object):
     """Interface to routing table dictionaries.
 
@@ -174,12 +203,19 @@ class RoutingTable(object):
 
     in order to make storing the mapping as JSON easier (JSON keys cannot be
     lists).
+
+    The nested mapping should only be changed through :meth:`add_entry`
+    and :meth:`remove_entry`, which keep the reverse index of destinations
+    to sources up to date.
     """
 
     def __init__(self, routing_table=None):
         if routing_table is None:
             routing_table = {}
         self._routing_table = routing_table
+        # Reverse index of the routing table, built on first use:
+        #     dst_conn_str -> dst_endpoint -> set([(src_conn_str, src_ep)])
+        self._reverse = None
 
     def __eq__(self, other):
         if not isinstance(other, RoutingTable):
@@ -189,33 +225,78 @@ class RoutingTable(object):
     def __nonzero__(self):
         return bool(self._routing_table)
 
+    def as_dict(self):
+        """Return the nested mapping the routing table is stored as.
+
+        This is the routing table's own dict rather than a copy, so that it
+        can be stored without copying. It must not be changed.
+        """
+        return self._routing_table
+
+    def _conn(self, conn):
+        if isinstance(conn, GoConnector):
+            return conn
+        return GoConnector.parse(conn)
+
+    def _reverse_index(self):
+        if self._reverse is None:
+            self._reverse = {}
+            for src_str, endpoints in self._routing_table.iteritems():
+                for src_endp, (dst_str, dst_endp) in endpoints.iteritems():
+                    self._add_reverse(src_str, src_endp, dst_str, dst_endp)
+        return self._reverse
+
+    def _add_reverse(self, src_str, src_endp, dst_str, dst_endp):
+        endpoints = self._reverse.setdefault(dst_str, {})
+        endpoints.setdefault(dst_endp, set()).add((src_str, src_endp))
+
+    def _remove_reverse(self, src_str, src_endp, dst_str, dst_endp):
+        endpoints = self._reverse.get(dst_str, {})
+        sources = endpoints.get(dst_endp, set())
+        sources.discard((src_str, src_endp))
+        if not sources:
+            endpoints.pop(dst_endp, None)
+        if not endpoints:
+            self._reverse.pop(dst_str, None)
+
     def lookup_target(self, src_conn, src_endpoint):
         target = self._routing_table.get(str(src_conn), {}).get(src_endpoint)
         if target is not None:
             conn, ep = target
-            target = [_to_conn(conn), ep]
+            target = [self._conn(conn), ep]
         return target
 
     def lookup_targets(self, src_conn):
         targets = []
         for ep, dst in self._routing_table.get(str(src_conn), {}).iteritems():
             dst_str, dst_ep = dst
-            targets.append((ep, [_to_conn(dst_str), dst_ep]))
+            targets.append((ep, [self._conn(dst_str), dst_ep]))
         return targets
 
     def lookup_source(self, target_conn, target_endpoint):
-        target_conn = _to_conn(target_conn)
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn and dst_endpoint == target_endpoint:
-                return [src_conn, src_endpoint]
-        return None
+        """Return the `[source_connector, source_endpoint]` that routes to
+        the given target, or `None` if there isn't one.
+
+        If more than one source routes to the target, the source with the
+        lowest connector string and endpoint is returned, so the result
+        doesn't depend on the order the entries were added in.
+        """
+        target_str = str(self._conn(target_conn))
+        sources = self._reverse_index().get(target_str, {}).get(
+            target_endpoint)
+        if not sources:
+            return None
+        src_str, src_endpoint = min(sources)
+        return [self._conn(src_str), src_endpoint]
 
     def lookup_sources(self, target_conn):
-        target_conn = _to_conn(target_conn)
+        target_str = str(self._conn(target_conn))
         sources = []
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn:
-                sources.append((dst_endpoint, [src_conn, src_endpoint]))
+        endpoints = self._reverse_index().get(target_str, {})
+        for dst_endpoint, srcs in endpoints.iteritems():
+            for src_str, src_endpoint in srcs:
+                sources.append(
+                    (dst_endpoint, [self._conn(src_str), src_endpoint]))
         return sources
 
     def entries(self):
@@ -225,23 +306,30 @@ class RoutingTable(object):
         """
         for src_conn, endpoints in self._routing_table.iteritems():
             for src_endp, (dst_conn, dst_endp) in endpoints.iteritems():
-                yield (
-                    _to_conn(src_conn), src_endp, _to_conn(dst_conn), dst_endp)
+                yield (self._conn(src_conn), src_endp,
+                       self._conn(dst_conn), dst_endp)
 
     def add_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
-        src_conn = _to_conn(src_conn)
-        dst_conn = _to_conn(dst_conn)
+        src_conn = self._conn(src_conn)
+        dst_conn = self._conn(dst_conn)
         self.validate_entry(src_conn, src_endpoint, dst_conn, dst_endpoint)
-        connector_dict = self._routing_table.setdefault(str(src_conn), {})
+        src_str, dst_str = str(src_conn), str(dst_conn)
+        connector_dict = self._routing_table.setdefault(src_str, {})
         if src_endpoint in connector_dict:
+            old_dst_str, old_dst_endpoint = connector_dict[src_endpoint]
             log.info(
                 "Replacing routing entry for (%r, %r): was %r, now %r" % (
-                    str(src_conn), src_endpoint, connector_dict[src_endpoint],
-                    [str(dst_conn), dst_endpoint]))
-        connector_dict[src_endpoint] = [str(dst_conn), dst_endpoint]
+                    src_str, src_endpoint, connector_dict[src_endpoint],
+                    [dst_str, dst_endpoint]))
+            if self._reverse is not None:
+                self._remove_reverse(
+                    src_str, src_endpoint, old_dst_str, old_dst_endpoint)
+        connector_dict[src_endpoint] = [dst_str, dst_endpoint]
+        if self._reverse is not None:
+            self._add_reverse(src_str, src_endpoint, dst_str, dst_endpoint)
 
     def remove_entry(self, src_conn, src_endpoint):
-        src_conn = _to_conn(src_conn)
+        src_conn = self._conn(src_conn)
         src_str = str(src_conn)
         connector_dict = self._routing_table.get(src_str)
         if connector_dict is None or src_endpoint not in connector_dict:
@@ -256,6 +344,11 @@ class RoutingTable(object):
             # This is the last entry for this connector
             self._routing_table.pop(src_str)
 
+        if self._reverse is not None:
+            old_dst_str, old_dst_endpoint = old_dest
+            self._remove_reverse(
+                src_str, src_endpoint, old_dst_str, old_dst_endpoint)
+
         return old_dest
 
     def remove_endpoint(self, conn, endpoint):
@@ -271,22 +364,16 @@ class RoutingTable(object):
 
         Useful when the connector is going away for some reason.
         """
-        conn = _to_conn(conn)
+        conn_str = str(self._conn(conn))
         # remove entries with connector as source
-        self._routing_table.pop(str(conn), None)
-
-        # remove entires with connector as destination
-        to_remove = []
-        for src_str, routes in self._routing_table.iteritems():
-            for src_endpoint, (dst_str, dst_endpoint) in routes.items():
-                if dst_str == str(conn):
-                    del routes[src_endpoint]
-            if not routes:
-                # We can't modify this dict while iterating over it.
-                to_remove.append(src_str)
+        for src_endpoint in self._routing_table.get(conn_str, {}).keys():
+            self.remove_entry(conn_str, src_endpoint)
 
-        for src_str in to_remove:
-            del self._routing_table[src_str]
+        # remove entries with connector as destination
+        endpoints = self._reverse_index().get(conn_str, {})
+        sources = [src for srcs in endpoints.values() for src in srcs]
+        for src_str, src_endpoint in sources:
+            self.remove_entry(src_str, src_endpoint)
 
     def remove_conversation(self, conv):
         """Remove all entries linking to or from a given conversation.
@@ -334,7 +421,7 @@ class RoutingTable(object):
         :param str src_conn: source connector to start search with.
         :rtype: set of destination connector strings.
         """
-        src_conn = _to_conn(src_conn)
+        src_conn = self._conn(src_conn)
         sources = [src_conn]
         sources_seen = set(sources)
         results = set()
@@ -371,7 +458,7 @@ class RoutingTable(object):
         :param str dst_conn: destination connector to start search with.
         :rtype: set of source connector strings.
         """
-        dst_conn = _to_conn(dst_conn)
+        dst_conn = self._conn(dst_conn)
         destinations = [dst_conn]
         destinations_seen = set(destinations)
         results = set()
@@ -394,8 +481,8 @@ class RoutingTable(object):
         This method currently only validates that the source and destination
         have opposite directionality (IN->OUT or OUT->IN).
         """
-        src_conn = _to_conn(src_conn)
-        dst_conn = _to_conn(dst_conn)
+        src_conn = self._conn(src_conn)
+        dst_conn = self._conn(dst_conn)
         if src_conn.direction == dst_conn.direction:
             raise ValueError(
                 "Invalid routing table entry: %s source (%s, %s) maps to %s"
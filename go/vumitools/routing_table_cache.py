@@ -0,0 +1,132 @@
+# -*- test-case-name: go.vumitools.tests.test_routing_table_cache -*-
+
+"""In-process caching of account routing tables."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class RoutingTableVersions(object):
+    """Per-account routing table version counters stored in Redis.
+
+    Anything that saves a modified routing table should call
+    :meth:`bump_version` so that processes caching the old table can
+    notice the change.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    def _version_key(self, user_account_key):
+        return "version.%s" % (user_account_key,)
+
+    @Manager.calls_manager
+    def get_version(self, user_account_key):
+        """Return the current routing table version for an account.
+
+        Accounts that have never had a version bump are at version 0.
+        """
+        version = yield self.manager.get(self._version_key(user_account_key))
+        returnValue(int(version or 0))
+
+    def bump_version(self, user_account_key):
+        """Increment the routing table version for an account."""
+        return self.manager.incr(self._version_key(user_account_key))
+
+
+class RoutingTableCache(object):
+    """A bounded, expiring cache of account routing tables.
+
+    Each cached routing table is stored along with the routing table
+    version it was loaded at. A cached table is only used if it is younger
+    than `ttl` seconds and its version still matches the one in Redis, so
+    a routing table update is seen by the next message routed for the
+    account. The oldest table is evicted once `max_size` accounts are
+    cached.
+
+    :param RoutingTableVersions versions:
+        Source of the current routing table versions.
+    :param int max_size:
+        Maximum number of accounts to cache routing tables for.
+    :param float ttl:
+        Number of seconds to cache a routing table for. If this is zero,
+        nothing is cached.
+    :param clock:
+        Object with a `seconds()` method that returns the current time.
+    """
+
+    def __init__(self, versions, max_size, ttl, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.versions = versions
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_account_key):
+        return user_account_key in self._entries
+
+    def _get_entry(self, user_account_key, version):
+        entry = self._entries.get(user_account_key)
+        if entry is None:
+            return None
+        expires_at, entry_version, routing_table = entry
+        if expires_at <= self.clock.seconds() or entry_version != version:
+            del self._entries[user_account_key]
+            return None
+        return routing_table
+
+    def _evict_oldest(self):
+        oldest_key = min(
+            self._entries, key=lambda k: self._entries[k][0])
+        del self._entries[oldest_key]
+
+    def _set_entry(self, user_account_key, version, routing_table):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries.pop(user_account_key, None)
+        while len(self._entries) >= self.max_size:
+            self._evict_oldest()
+        self._entries[user_account_key] = (
+            self.clock.seconds() + self.ttl, version, routing_table)
+
+    @inlineCallbacks
+    def get_routing_table(self, user_api):
+        """Return the routing table for the account `user_api` belongs to.
+
+        The routing table is loaded from Riak if there is no fresh copy
+        in the cache.
+        """
+        user_account_key = user_api.user_account_key
+        version = yield self.versions.get_version(user_account_key)
+        self.round_trips += 1
+        routing_table = self._get_entry(user_account_key, version)
+        if routing_table is not None:
+            self.hits += 1
+            returnValue(routing_table)
+        self.misses += 1
+        routing_table = yield user_api.get_routing_table()
+        self.round_trips += 1
+        self._set_entry(user_account_key, version, routing_table)
+        returnValue(routing_table)
+
+    def invalidate(self, user_account_key):
+        """Remove the cached routing table for an account."""
+        self._entries.pop(user_account_key, None)
+
+    def clear(self):
+        """Remove all cached routing tables."""
+        self._entries.clear()
@@ -0,0 +1,149 @@
+# -*- test-case-name: go.vumitools.tests.test_tag_ownership -*-
+
+"""Fast lookups of which account owns a tag."""
+
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class TagOwnershipStore(object):
+    """Record of tag ownership stored in Redis.
+
+    The `CurrentTag` objects in the message store remain the authoritative
+    record of tag ownership. This store mirrors the owner of each acquired
+    tag in a single Redis hash so that the whole mapping can be loaded with
+    one request, and keeps a version counter that is bumped on every change
+    so that in-process copies can tell when they are out of date.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    OWNERS_KEY = "owners"
+    VERSION_KEY = "version"
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    def _tag_field(self, tag):
+        return json.dumps(list(tag))
+
+    @Manager.calls_manager
+    def set_owner(self, tag, user_account_key):
+        """Record `user_account_key` as the owner of `tag`."""
+        yield self.manager.hset(
+            self.OWNERS_KEY, self._tag_field(tag), user_account_key)
+        yield self.manager.incr(self.VERSION_KEY)
+
+    @Manager.calls_manager
+    def clear_owner(self, tag):
+        """Record `tag` as no longer owned by any account."""
+        yield self.manager.hdel(self.OWNERS_KEY, self._tag_field(tag))
+        yield self.manager.incr(self.VERSION_KEY)
+
+    @Manager.calls_manager
+    def get_owners(self):
+        """Return a dict mapping `(tagpool, tag)` to account keys."""
+        owners = yield self.manager.hgetall(self.OWNERS_KEY)
+        returnValue(dict(
+            (tuple(json.loads(field)), user_account_key)
+            for field, user_account_key in owners.iteritems()))
+
+    @Manager.calls_manager
+    def get_version(self):
+        version = yield self.manager.get(self.VERSION_KEY)
+        returnValue(int(version or 0))
+
+
+class TagOwnershipIndex(object):
+    """In-process index of tag owners and tagpool metadata.
+
+    Lookups are answered from memory. Tags that are not in the index (for
+    example, tags acquired before `TagOwnershipStore` existed) are looked
+    up in the message store once and then remembered.
+
+    The version counter in the `TagOwnershipStore` is checked at most once
+    every `refresh_interval` seconds. When it changes, the owners are
+    reloaded and anything remembered from the message store is dropped.
+    Cached tagpool metadata is dropped on every check.
+
+    :param VumiApi vumi_api:
+        API object to load tag and tagpool information from.
+    :param float refresh_interval:
+        Number of seconds between checks for ownership changes.
+    :param clock:
+        Object with a `seconds()` method that returns the current time.
+    """
+
+    def __init__(self, vumi_api, refresh_interval, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.vumi_api = vumi_api
+        self.store = vumi_api.tag_ownership
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self._owners = {}
+        self._tagpool_metadata = {}
+        self._version = None
+        self._next_refresh = None
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+    @inlineCallbacks
+    def load(self):
+        """Load the tag owners, regardless of the current version."""
+        version = yield self.store.get_version()
+        owners = yield self.store.get_owners()
+        self.round_trips += 2
+        self._owners = owners
+        self._tagpool_metadata = {}
+        self._version = version
+        self._next_refresh = self.clock.seconds() + self.refresh_interval
+
+    @inlineCallbacks
+    def refresh(self):
+        """Reload the tag owners if the ownership version has changed."""
+        self._next_refresh = self.clock.seconds() + self.refresh_interval
+        self._tagpool_metadata = {}
+        version = yield self.store.get_version()
+        self.round_trips += 1
+        if version != self._version:
+            yield self.load()
+
+    def _maybe_refresh(self):
+        if (self._next_refresh is None
+                or self.clock.seconds() >= self._next_refresh):
+            return self.refresh()
+
+    @inlineCallbacks
+    def get_owner(self, tag):
+        """Return the key of the account that owns `tag`.
+
+        Returns `None` if the tag is not owned by an account.
+        """
+        yield self._maybe_refresh()
+        tag = tuple(tag)
+        if tag in self._owners:
+            self.hits += 1
+        else:
+            self.misses += 1
+            tag_info = yield self.vumi_api.mdb.get_tag_info(tag)
+            self.round_trips += 1
+            self._owners[tag] = tag_info.metadata['user_account']
+        returnValue(self._owners[tag])
+
+    @inlineCallbacks
+    def get_tagpool_metadata(self, tagpool):
+        """Return the metadata for `tagpool`."""
+        yield self._maybe_refresh()
+        if tagpool not in self._tagpool_metadata:
+            metadata = yield self.vumi_api.tpm.get_metadata(tagpool)
+            self.round_trips += 1
+            self._tagpool_metadata[tagpool] = metadata
+        returnValue(self._tagpool_metadata[tagpool])
@@ -7,6 +7,7 @@ from twisted.python.monkey import MonkeyPatcher
 
 from zope.interface import implements
 
+from vumi.persist import fake_redis
 from vumi.tests.helpers import (
     WorkerHelper, MessageHelper, PersistenceHelper, maybe_async, proxyable,
     generate_proxies, IHelper, maybe_async_return)
@@ -19,6 +20,37 @@ from go.vumitools.routing import RoutingMetadata
 from go.vumitools.utils import MessageMetadataHelper
 
 
+def fake_redis_mget(self, *keys):
+    return [self.get.sync(self, key) for key in keys]
+
+
+class FakeRedisCommandsHelper(object):
+    """
+    Adds the commands in :mod:`go.vumitools.redis_commands` to vumi's
+    ``FakeRedis``, which doesn't implement them, until cleanup.
+    """
+    implements(IHelper)
+
+    COMMANDS = {
+        'mget': fake_redis_mget,
+    }
+
+    def __init__(self):
+        self._added = []
+
+    def setup(self):
+        for name, func in self.COMMANDS.items():
+            if not hasattr(fake_redis.FakeRedis, name):
+                setattr(fake_redis.FakeRedis, name,
+                        fake_redis.maybe_async(func))
+                self._added.append(name)
+
+    def cleanup(self):
+        for name in self._added:
+            delattr(fake_redis.FakeRedis, name)
+        self._added = []
+
+
 class PatchHelper(object):
     implements(IHelper)
 
@@ -285,6 +317,7 @@ class VumiApiHelper(object):
         self.is_sync = is_sync
         self._patch_helper = PatchHelper()
         generate_proxies(self, self._patch_helper)
+        self._fake_redis_commands_helper = FakeRedisCommandsHelper()
 
         self._persistence_helper = PersistenceHelper(
             use_riak=use_riak, is_sync=is_sync)
@@ -297,6 +330,7 @@ class VumiApiHelper(object):
         generate_proxies(self, self._persistence_helper)
 
     def setup(self, setup_vumi_api=True):
+        self._fake_redis_commands_helper.setup()
         self._persistence_helper.setup()
         if self.is_sync:
             self._django_amqp_setup()
@@ -310,6 +344,7 @@ class VumiApiHelper(object):
             yield worker_helper.cleanup()
         yield self._persistence_helper.cleanup()
         self._patch_helper.cleanup()
+        self._fake_redis_commands_helper.cleanup()
 
     def _django_amqp_setup(self):
         import go.base.amqp
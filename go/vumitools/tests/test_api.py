@@ -184,6 +184,22 @@ class TestTxVumiUserApi(VumiTestCase):
         yield self.user_api.release_tag(tag)
         yield self.assert_account_tags([])
 
+    @inlineCallbacks
+    def test_tag_ownership_recorded(self):
+        [tag] = yield self.vumi_helper.setup_tagpool(u"pool1", [u"1234"])
+        yield self.user_helper.add_tagpool_permission(u"pool1")
+        tag_ownership = self.vumi_api.tag_ownership
+
+        yield self.user_api.acquire_specific_tag(tag)
+        self.assertEqual(
+            (yield tag_ownership.get_owners()),
+            {tag: self.user_api.user_account_key})
+        self.assertEqual((yield tag_ownership.get_version()), 1)
+
+        yield self.user_api.release_tag(tag)
+        self.assertEqual((yield tag_ownership.get_owners()), {})
+        self.assertEqual((yield tag_ownership.get_version()), 2)
+
     @inlineCallbacks
     def test_batch_id_for_specific_tag(self):
         [tag] = yield self.vumi_helper.setup_tagpool(u"poolA", [u"tag1"])
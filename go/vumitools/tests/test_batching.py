@@ -0,0 +1,139 @@
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.batching import ConcurrentConsumerMixin, MicroBatcher
+
+
+class TestMicroBatcher(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def process_batch(self, items):
+        self.batches.append(items)
+        return succeed([item * 2 for item in items])
+
+    def mk_batcher(self, process_batch=None, batch_size=3, delay=1.0):
+        if process_batch is None:
+            process_batch = self.process_batch
+        return MicroBatcher(
+            process_batch, batch_size, delay, clock=self.clock)
+
+    def collect(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_flush_when_full(self):
+        batcher = self.mk_batcher()
+        results = [self.collect(batcher.add(i)) for i in range(4)]
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        self.assertEqual(results, [[0], [2], [4], []])
+        self.assertEqual(len(batcher), 1)
+
+    def test_flush_after_delay(self):
+        batcher = self.mk_batcher()
+        results = [self.collect(batcher.add(i)) for i in range(2)]
+        self.clock.advance(0.5)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.batches, [[0, 1]])
+        self.assertEqual(results, [[0], [2]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush_when_full_cancels_delayed_flush(self):
+        batcher = self.mk_batcher()
+        for i in range(3):
+            batcher.add(i)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        batcher.add(3)
+        self.clock.advance(1.0)
+        self.assertEqual(self.batches, [[0, 1, 2], [3]])
+
+    def test_flush_empty(self):
+        batcher = self.mk_batcher()
+        self.assertEqual(self.collect(batcher.flush()), [None])
+        self.assertEqual(self.batches, [])
+
+    def test_item_failure(self):
+        def process_batch(items):
+            try:
+                raise ValueError("Bad item.")
+            except ValueError:
+                failure = Failure()
+            return [None, failure]
+
+        batcher = self.mk_batcher(process_batch, batch_size=2)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        self.assertEqual(self.successResultOf(d1), None)
+        self.failureResultOf(d2, ValueError)
+
+    def test_batch_failure(self):
+        def process_batch(items):
+            return fail(ValueError("Bad batch."))
+
+        batcher = self.mk_batcher(process_batch, batch_size=2)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+    def test_wait(self):
+        processing = []
+
+        def process_batch(items):
+            d = Deferred()
+            processing.append(d)
+            return d
+
+        batcher = self.mk_batcher(process_batch, batch_size=2)
+        self.assertEqual(self.collect(batcher.wait()), [None])
+        batcher.add(1)
+        # Items waiting for their batch aren't waited for.
+        self.assertEqual(self.collect(batcher.wait()), [None])
+        batcher.add(2)
+        waited = self.collect(batcher.wait())
+        self.assertEqual(waited, [])
+        batcher.add(3)
+        self.clock.advance(1.0)
+        processing[0].callback([None, None])
+        self.assertEqual(waited, [])
+        processing[1].callback([None])
+        self.assertEqual(waited, [None])
+
+
+class FakeConsumer(object):
+    def __init__(self):
+        self.consuming = []
+
+    def consume(self, message):
+        d = Deferred()
+        self.consuming.append((message, d))
+        return d
+
+
+class ConcurrentConsumer(ConcurrentConsumerMixin, FakeConsumer):
+    pass
+
+
+class TestConcurrentConsumerMixin(VumiTestCase):
+
+    def test_consume_does_not_wait(self):
+        consumer = ConcurrentConsumer()
+        self.assertEqual(consumer.consume("msg1"), None)
+        self.assertEqual(consumer.consume("msg2"), None)
+        self.assertEqual(
+            [msg for msg, _d in consumer.consuming], ["msg1", "msg2"])
+
+    def test_consume_error_logged(self):
+        consumer = ConcurrentConsumer()
+        consumer.consume("msg1")
+        [(_msg, d)] = consumer.consuming
+        d.errback(ValueError("bad"))
+        [failure] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(str(failure.value), "bad")
@@ -0,0 +1,105 @@
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.billing.utils import BillingError
+from go.vumitools.billing_costs import FreeMessageIndex
+
+
+def mk_cost(account_number, tag_pool_name, message_direction,
+            message_cost=0, session_cost=0):
+    return {
+        'account_number': account_number,
+        'tag_pool_name': tag_pool_name,
+        'message_direction': message_direction,
+        'message_cost': message_cost,
+        'session_cost': session_cost,
+        'markup_percent': 10,
+    }
+
+
+class FakeBillingApi(object):
+    def __init__(self, costs):
+        self.costs = costs
+        self.requests = 0
+
+    def get_cost_list(self):
+        self.requests += 1
+        if isinstance(self.costs, Exception):
+            return fail(self.costs)
+        if isinstance(self.costs, Deferred):
+            return self.costs
+        return succeed(self.costs)
+
+
+class TestFreeMessageIndex(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_index(self, costs, refresh_interval=10):
+        self.billing_api = FakeBillingApi(costs)
+        return FreeMessageIndex(
+            self.billing_api, refresh_interval, clock=self.clock)
+
+    def test_free_tagpool(self):
+        index = self.mk_index([mk_cost(None, 'pool1', 'Inbound')])
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertFalse(index.is_free('acc1', 'pool1', 'Outbound'))
+        self.assertFalse(index.is_free('acc1', 'pool2', 'Inbound'))
+
+    def test_session_cost(self):
+        index = self.mk_index([
+            mk_cost(None, 'pool1', 'Inbound', session_cost=1)])
+        self.assertFalse(index.is_free('acc1', 'pool1', 'Inbound'))
+
+    def test_account_override(self):
+        index = self.mk_index([
+            mk_cost(None, 'pool1', 'Inbound'),
+            mk_cost('acc2', 'pool1', 'Inbound', message_cost=1),
+            mk_cost('acc3', 'pool2', 'Inbound'),
+        ])
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertFalse(index.is_free('acc2', 'pool1', 'Inbound'))
+        self.assertTrue(index.is_free('acc3', 'pool2', 'Inbound'))
+        self.assertFalse(index.is_free('acc1', 'pool2', 'Inbound'))
+
+    def test_default_cost(self):
+        index = self.mk_index([
+            mk_cost(None, None, 'Outbound'),
+            mk_cost(None, 'pool1', 'Outbound', message_cost=1),
+        ])
+        self.assertTrue(index.is_free('acc1', 'pool2', 'Outbound'))
+        self.assertFalse(index.is_free('acc1', 'pool1', 'Outbound'))
+
+    def test_refresh(self):
+        index = self.mk_index([mk_cost(None, 'pool1', 'Inbound')])
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.billing_api.costs = []
+        self.clock.advance(5)
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertEqual(self.billing_api.requests, 1)
+        self.clock.advance(5)
+        self.assertFalse(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertEqual(self.billing_api.requests, 2)
+
+    def test_lookups_during_refresh(self):
+        index = self.mk_index([mk_cost(None, 'pool1', 'Inbound')])
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        d = self.billing_api.costs = Deferred()
+        self.clock.advance(10)
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.assertEqual(self.billing_api.requests, 2)
+        d.callback([])
+        self.assertFalse(index.is_free('acc1', 'pool1', 'Inbound'))
+
+    def test_refresh_error(self):
+        index = self.mk_index([mk_cost(None, 'pool1', 'Inbound')])
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        self.billing_api.costs = BillingError("Eep!")
+        self.clock.advance(10)
+        self.assertTrue(index.is_free('acc1', 'pool1', 'Inbound'))
+        [err] = self.flushLoggedErrors(BillingError)
+        self.assertEqual(err.getErrorMessage(), "Eep!")
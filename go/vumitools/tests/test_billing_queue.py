@@ -0,0 +1,185 @@
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.billing.utils import BillingError, BillingRequestRejected
+from go.vumitools.billing_queue import BillingQueue, BillingQueueDrainer
+
+
+def mk_transaction(message_id):
+    return {
+        "account_number": "12345",
+        "message_id": message_id,
+        "tag_pool_name": "pool1",
+        "tag_name": "1234",
+        "message_direction": "Inbound",
+        "session_created": False,
+    }
+
+
+class FakeBillingApi(object):
+    def __init__(self):
+        self.batches = []
+        self.transactions = []
+        self.batch_error = None
+        self.rejected = set()
+        self.errors = {}
+
+    def create_transaction_batch(self, transactions):
+        if self.batch_error is not None:
+            return fail(self.batch_error)
+        self.batches.append([t["message_id"] for t in transactions])
+        return succeed(transactions)
+
+    def create_transaction(self, **transaction):
+        if transaction["message_id"] in self.rejected:
+            return fail(BillingRequestRejected("Rejected."))
+        if transaction["message_id"] in self.errors:
+            return fail(self.errors[transaction["message_id"]])
+        self.transactions.append(transaction["message_id"])
+        return succeed(transaction)
+
+
+class TestBillingQueue(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.queue = BillingQueue(
+            self.redis.sub_manager('billing_queue'), clock=self.clock)
+
+    @inlineCallbacks
+    def test_push_and_peek(self):
+        self.assertEqual((yield self.queue.peek(10)), [])
+        yield self.queue.push(mk_transaction("msg-1"))
+        self.clock.advance(5)
+        yield self.queue.push(mk_transaction("msg-2"))
+        self.assertEqual((yield self.queue.depth()), 2)
+        self.assertEqual((yield self.queue.peek(10)), [
+            {"transaction": mk_transaction("msg-1"), "queued_at": 0},
+            {"transaction": mk_transaction("msg-2"), "queued_at": 5},
+        ])
+        [entry] = yield self.queue.peek(1)
+        self.assertEqual(entry["transaction"], mk_transaction("msg-1"))
+
+    @inlineCallbacks
+    def test_remove(self):
+        for message_id in ["msg-1", "msg-2", "msg-3"]:
+            yield self.queue.push(mk_transaction(message_id))
+        yield self.queue.remove(2)
+        self.assertEqual((yield self.queue.depth()), 1)
+        [entry] = yield self.queue.peek(10)
+        self.assertEqual(entry["transaction"], mk_transaction("msg-3"))
+
+
+class TestBillingQueueDrainer(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.queue = BillingQueue(
+            self.redis.sub_manager('billing_queue'), clock=self.clock)
+        self.billing_api = FakeBillingApi()
+        self.drainer = BillingQueueDrainer(
+            self.queue, self.billing_api, 2, clock=self.clock)
+        self.add_cleanup(self.drainer.stop)
+
+    @inlineCallbacks
+    def queue_transactions(self, *message_ids):
+        for message_id in message_ids:
+            yield self.queue.push(mk_transaction(message_id))
+
+    def metric_values(self, metric):
+        return [value for _, value in metric.poll()]
+
+    @inlineCallbacks
+    def test_drain(self):
+        yield self.queue_transactions("msg-1", "msg-2", "msg-3")
+        self.clock.advance(3)
+        sent = yield self.drainer.drain()
+        self.assertEqual(sent, 3)
+        self.assertEqual(
+            self.billing_api.batches, [["msg-1", "msg-2"], ["msg-3"]])
+        self.assertEqual((yield self.queue.depth()), 0)
+        self.assertEqual(self.metric_values(self.drainer.depth_metric), [3])
+        self.assertEqual(self.metric_values(self.drainer.lag_metric), [3])
+
+    @inlineCallbacks
+    def test_drain_empty(self):
+        sent = yield self.drainer.drain()
+        self.assertEqual(sent, 0)
+        self.assertEqual(self.billing_api.batches, [])
+        self.assertEqual(self.metric_values(self.drainer.depth_metric), [0])
+        self.assertEqual(self.metric_values(self.drainer.lag_metric), [0])
+
+    @inlineCallbacks
+    def test_drain_failure_keeps_transactions(self):
+        yield self.queue_transactions("msg-1", "msg-2")
+        self.billing_api.batch_error = ValueError("Connection lost.")
+        yield self.assertFailure(self.drainer.drain(), ValueError)
+        self.assertEqual((yield self.queue.depth()), 2)
+
+        self.billing_api.batch_error = None
+        yield self.drainer.drain()
+        self.assertEqual(self.billing_api.batches, [["msg-1", "msg-2"]])
+        self.assertEqual((yield self.queue.depth()), 0)
+
+    @inlineCallbacks
+    def test_drain_server_error_keeps_transactions(self):
+        yield self.queue_transactions("msg-1", "msg-2")
+        self.billing_api.batch_error = BillingError("Internal error.")
+        yield self.assertFailure(self.drainer.drain(), BillingError)
+        self.assertEqual(self.billing_api.transactions, [])
+        self.assertEqual((yield self.queue.depth()), 2)
+
+    @inlineCallbacks
+    def test_drain_rejected_batch(self):
+        yield self.queue_transactions("msg-1", "msg-2")
+        self.billing_api.batch_error = BillingRequestRejected("Rejected.")
+        self.billing_api.rejected.add("msg-1")
+        yield self.drainer.drain()
+        self.assertEqual(self.billing_api.transactions, ["msg-2"])
+        self.assertEqual((yield self.queue.depth()), 0)
+        self.assertEqual(
+            len(self.flushLoggedErrors(BillingRequestRejected)), 2)
+
+    @inlineCallbacks
+    def test_drain_rejected_batch_failure(self):
+        yield self.queue_transactions("msg-1", "msg-2", "msg-3")
+        self.billing_api.batch_error = BillingRequestRejected("Rejected.")
+        self.billing_api.errors["msg-2"] = ValueError("Connection lost.")
+        yield self.assertFailure(self.drainer.drain(), ValueError)
+        self.assertEqual(self.billing_api.transactions, ["msg-1"])
+        self.flushLoggedErrors(BillingRequestRejected)
+
+        # Only the transactions that weren't created are sent again
+        self.billing_api.batch_error = None
+        yield self.drainer.drain()
+        self.assertEqual(self.billing_api.batches, [["msg-2", "msg-3"]])
+        self.assertEqual((yield self.queue.depth()), 0)
+
+    def test_start(self):
+        drains = []
+        self.patch(self.drainer, 'drain',
+                   lambda: succeed(drains.append(self.clock.seconds())))
+        self.drainer.start(10)
+        self.clock.advance(5)
+        self.assertEqual(drains, [])
+        self.clock.advance(5)
+        self.clock.advance(10)
+        self.assertEqual(drains, [10, 20])
+
+    def test_start_logs_errors(self):
+        self.patch(self.drainer, 'drain',
+                   lambda: fail(ValueError("Connection lost.")))
+        self.drainer.start(10)
+        self.clock.advance(10)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Connection lost.")
+        self.clock.advance(10)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
@@ -1,6 +1,7 @@
 import json
 import decimal
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web.client import Agent, Request, Response
 
@@ -13,7 +14,7 @@ from go.vumitools.tests.helpers import VumiApiHelper, GoMessageHelper
 from go.vumitools.utils import MessageMetadataHelper
 
 from go.billing.api import BillingError
-from go.billing.utils import JSONEncoder
+from go.billing.utils import JSONEncoder, BillingRequestRejected
 
 
 class BillingApiMock(object):
@@ -21,6 +22,9 @@ class BillingApiMock(object):
     def __init__(self):
         self.transactions = []
 
+    def close(self):
+        pass
+
     def _record(self, items, vars):
         del vars["self"]
         items.append(vars)
@@ -62,6 +66,7 @@ class HttpRequestMock(object):
                                 data_limit=None, context_factory=None,
                                 agent_class=Agent):
         self.request = self._mk_request(url, method, headers, data)
+        self.agent_class = agent_class
         return self.response
 
 
@@ -100,6 +105,20 @@ class TestBillingApi(VumiTestCase):
         self.assertEqual(hrm.request.bodyProducer.body,
                          json.dumps(kwargs, cls=JSONEncoder))
 
+    @inlineCallbacks
+    def test_persistent_connections(self):
+        billing_api = BillingApi(self.api_url, max_persistent_per_host=5)
+        self.add_cleanup(billing_api.close)
+        self.assertTrue(billing_api.pool.persistent)
+        self.assertEqual(billing_api.pool.maxPersistentPerHost, 5)
+
+        hrm = HttpRequestMock(self._mk_response(delivered_body='[]'))
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+        yield billing_api.get_cost_list()
+        agent = hrm.agent_class(reactor, contextFactory=None)
+        self.assertTrue(agent._pool is billing_api.pool)
+
     @inlineCallbacks
     def test_create_transaction_response(self):
         delivered_body = {
@@ -154,7 +173,73 @@ class TestBillingApi(VumiTestCase):
             'session_created': False,
         }
         d = self.billing_api.create_transaction(**kwargs)
-        yield self.assertFailure(d, BillingError)
+        failure = yield self.assertFailure(d, BillingError)
+        self.assertFalse(isinstance(failure, BillingRequestRejected))
+
+    @inlineCallbacks
+    def test_create_transaction_rejected(self):
+        response = self._mk_response(code=400, phrase="Bad Request",
+                                     delivered_body="Unknown account.")
+
+        hrm = HttpRequestMock(response)
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        kwargs = {
+            'account_number': "test-account",
+            'message_id': 'msg-id-1',
+            'tag_pool_name': "pool1",
+            'tag_name': "1234",
+            'message_direction': "Inbound",
+            'session_created': False,
+        }
+        d = self.billing_api.create_transaction(**kwargs)
+        failure = yield self.assertFailure(d, BillingRequestRejected)
+        self.assertEqual(failure.args, ("Unknown account.",))
+
+    @inlineCallbacks
+    def test_create_transaction_batch_request(self):
+        hrm = HttpRequestMock(self._mk_response(delivered_body='[]'))
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        transactions = [{
+            'account_number': "test-account",
+            'message_id': 'msg-id-1',
+            'tag_pool_name': "pool1",
+            'tag_name': "1234",
+            'message_direction': "Inbound",
+            'session_created': False,
+        }]
+        yield self.billing_api.create_transaction_batch(transactions)
+        self.assertEqual(
+            hrm.request.uri, "%stransactions/batch" % (self.api_url,))
+        self.assertEqual(
+            hrm.request.bodyProducer.body,
+            json.dumps({'transactions': transactions}, cls=JSONEncoder))
+
+    @inlineCallbacks
+    def test_get_cost_list(self):
+        costs = [{
+            "account_number": None,
+            "tag_pool_name": "pool1",
+            "message_direction": "Inbound",
+            "message_cost": 0,
+            "session_cost": 0,
+            "markup_percent": decimal.Decimal('10.0'),
+        }]
+        response = self._mk_response(
+            delivered_body=json.dumps(costs, cls=JSONEncoder))
+
+        hrm = HttpRequestMock(response)
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        result = yield self.billing_api.get_cost_list()
+        self.assertEqual(hrm.request.uri, "%scosts" % (self.api_url,))
+        self.assertEqual(hrm.request.method, "GET")
+        self.assertEqual(hrm.request.bodyProducer, None)
+        self.assertEqual(result, costs)
 
 
 class TestBillingDispatcher(VumiTestCase):
@@ -330,3 +415,24 @@ class TestBillingDispatcher(VumiTestCase):
         yield self.ri_helper.dispatch_event(ack)
         self.assertEqual([ack], self.ro_helper.get_dispatched_events())
         self.assert_no_transactions()
+
+    @inlineCallbacks
+    def test_async_billing(self):
+        dispatcher = yield self.get_dispatcher(async_billing=True)
+        inbound = yield self.make_dispatch_inbound(
+            "inbound", user_account="12345", tag=("pool1", "1234"))
+        outbound = yield self.make_dispatch_outbound(
+            "hi", user_account="12345", tag=("pool1", "1234"))
+
+        self.add_md(inbound, is_paid=True)
+        self.add_md(outbound, is_paid=True)
+        self.assertEqual([inbound], self.ro_helper.get_dispatched_inbound())
+        self.assertEqual([outbound], self.ri_helper.get_dispatched_outbound())
+        self.assert_no_transactions()
+
+        entries = yield dispatcher.billing_queue.peek(10)
+        self.assertEqual(
+            [(e["transaction"]["message_id"],
+              e["transaction"]["message_direction"]) for e in entries],
+            [(inbound["message_id"], "Inbound"),
+             (outbound["message_id"], "Outbound")])
@@ -2,13 +2,16 @@
 
 """Tests for go.vumitools.contact."""
 
-from twisted.internet.defer import inlineCallbacks
+from datetime import datetime, timedelta
 
-from vumi.tests.helpers import VumiTestCase
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 from go.vumitools.tests.utils import model_eq
 from go.vumitools.contact import (
     ContactStore, ContactError, ContactNotFoundError)
+from go.vumitools.contact.counts import GroupMemberCounts
 from go.vumitools.opt_out import OptOutStore
 from go.vumitools.tests.helpers import VumiApiHelper
 
@@ -190,6 +193,16 @@ class TestContactStore(VumiTestCase):
         self.assertEqual([contact.key], (yield group1.backlinks.contacts()))
         self.assertEqual([contact.key], (yield group2.backlinks.contacts()))
 
+    @inlineCallbacks
+    def test_add_to_group_returns_whether_added(self):
+        contact = yield self.store.new_contact(
+            name=u'J Random', surname=u'Person', msisdn=u'27831234567')
+        group = yield self.store.new_group(u'group1')
+        self.assertTrue(contact.add_to_group(group))
+        self.assertFalse(contact.add_to_group(group))
+        self.assertFalse(contact.add_to_group(group.key))
+        self.assertEqual([group.key], contact.groups.keys())
+
     @inlineCallbacks
     def test_check_for_opted_out_contact(self):
         contact1 = yield self.store.new_contact(
@@ -217,6 +230,85 @@ class TestContactStore(VumiTestCase):
         count = yield self.store.count_contacts_for_group(group)
         self.assertEqual(count, 2)
 
+    @inlineCallbacks
+    def test_count_contacts_for_static_group_cached(self):
+        store = self.user_helper.user_api.contact_store
+        group = yield store.new_group(u'test group')
+        yield store.new_contact(
+            name=u'Contact', surname=u'1', msisdn=u'12345', groups=[group])
+        self.assertEqual((yield store.group_counts.get_count(group.key)), None)
+        self.assertEqual((yield store.count_contacts_for_group(group)), 1)
+        self.assertEqual((yield store.group_counts.get_count(group.key)), 1)
+
+        # Contacts added and removed through the store update the count.
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'2', msisdn=u'12345', groups=[group])
+        yield store.update_contact(contact.key, groups=[group])
+        self.assertEqual((yield store.group_counts.get_count(group.key)), 2)
+        yield store.delete_contact(contact)
+        self.assertEqual((yield store.group_counts.get_count(group.key)), 1)
+
+        # Changes made elsewhere aren't seen until the count is reconciled.
+        yield store.group_counts.set_count(group.key, 5)
+        self.assertEqual((yield store.count_contacts_for_group(group)), 5)
+
+    @inlineCallbacks
+    def test_group_membership_changes_update_counts(self):
+        store = self.user_helper.user_api.contact_store
+        group1 = yield store.new_group(u'group1')
+        group2 = yield store.new_group(u'group2')
+        yield store.group_counts.set_count(group1.key, 0)
+        yield store.group_counts.set_count(group2.key, 0)
+        contact1 = yield store.new_contact(
+            name=u'Contact', surname=u'1', msisdn=u'12345')
+        contact2 = yield store.new_contact(
+            name=u'Contact', surname=u'2', msisdn=u'12345')
+
+        yield store.add_contacts_to_group(group1, [contact1, contact2])
+        self.assertEqual((yield store.group_counts.get_count(group1.key)), 2)
+        # Contacts already in the group aren't counted again.
+        yield store.add_contacts_to_group(group1, [contact1])
+        self.assertEqual((yield store.group_counts.get_count(group1.key)), 2)
+        contact1 = yield store.get_contact_by_key(contact1.key)
+        self.assertEqual(contact1.groups.keys(), [group1.key])
+
+        yield store.remove_contact_from_group(contact1, group1)
+        self.assertEqual((yield store.group_counts.get_count(group1.key)), 1)
+        contact1 = yield store.get_contact_by_key(contact1.key)
+        self.assertEqual(contact1.groups.keys(), [])
+
+        old_group_keys = contact2.groups.keys()
+        contact2.groups.clear()
+        contact2.add_to_group(group2)
+        yield contact2.save()
+        yield store.update_group_counts(
+            old_group_keys, contact2.groups.keys())
+        self.assertEqual((yield store.group_counts.get_count(group1.key)), 0)
+        self.assertEqual((yield store.group_counts.get_count(group2.key)), 1)
+
+    @inlineCallbacks
+    def test_reconcile_group_counts(self):
+        store = self.user_helper.user_api.contact_store
+        group1 = yield store.new_group(u'group1')
+        group2 = yield store.new_group(u'group2')
+        group3 = yield store.new_group(u'group3')
+        yield store.new_contact(
+            name=u'Contact', surname=u'1', msisdn=u'12345',
+            groups=[group1, group2, group3])
+        yield store.group_counts.set_count(group1.key, 1)
+        yield store.group_counts.set_count(group2.key, 7)
+
+        self.assertEqual((yield store.reconcile_group_counts()), 1)
+        self.assertEqual((yield store.group_counts.get_count(group1.key)), 1)
+        self.assertEqual((yield store.group_counts.get_count(group2.key)), 1)
+        # Groups without a count are left alone.
+        self.assertEqual(
+            (yield store.group_counts.get_count(group3.key)), None)
+
+    @inlineCallbacks
+    def test_reconcile_group_counts_without_redis(self):
+        self.assertEqual((yield self.store.reconcile_group_counts()), 0)
+
     @inlineCallbacks
     def test_count_contacts_for_smart_group(self):
         group = yield self.store.new_smart_group(u'test group',
@@ -227,6 +319,266 @@ class TestContactStore(VumiTestCase):
         count = yield self.store.count_contacts_for_group(group)
         self.assertEqual(count, 1)
 
+    @inlineCallbacks
+    def test_get_dynamic_contacts_for_group(self):
+        group = yield self.store.new_smart_group(
+            u'test group', u'surname:"Foo 1"')
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 2', msisdn=u'12345')
+        self.assertEqual(
+            (yield self.store.get_dynamic_contacts_for_group(group)),
+            [contact1.key])
+        # No snapshot is stored if no max_age is given.
+        self.assertEqual(
+            (yield self.store.smart_group_snapshots.load(group.key)), None)
+
+    @inlineCallbacks
+    def test_get_dynamic_contacts_for_group_with_max_age(self):
+        group = yield self.store.new_smart_group(
+            u'test group', u'surname:"Foo 1"')
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+        self.assertEqual(
+            (yield self.store.get_dynamic_contacts_for_group(
+                group, max_age=60)),
+            [contact1.key])
+        snapshot = yield self.store.smart_group_snapshots.load(group.key)
+        self.assertEqual(snapshot.contact_count, 1)
+        self.assertEqual(snapshot.chunk_count, 1)
+        self.assertEqual(snapshot.query, group.query)
+        self.assertEqual(
+            (yield self.store.get_smart_group_snapshot_keys(snapshot)),
+            [contact1.key])
+
+        # A fresh snapshot is used instead of searching again.
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+        self.assertEqual(
+            (yield self.store.get_dynamic_contacts_for_group(
+                group, max_age=60)),
+            [contact1.key])
+        self.assertEqual(
+            (yield self.store.count_contacts_for_group(group, max_age=60)),
+            1)
+
+        # A stale snapshot is refreshed.
+        snapshot.refreshed_at = datetime.utcnow() - timedelta(seconds=61)
+        yield snapshot.save()
+        self.assertEqual(
+            sorted((yield self.store.get_dynamic_contacts_for_group(
+                group, max_age=60))),
+            sorted([contact1.key, contact2.key]))
+        self.assertEqual(
+            (yield self.store.count_contacts_for_group(group, max_age=60)),
+            2)
+
+    @inlineCallbacks
+    def test_get_dynamic_contacts_for_group_with_changed_query(self):
+        group = yield self.store.new_smart_group(
+            u'test group', u'surname:"Foo 1"')
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 2', msisdn=u'12345')
+        yield self.store.get_dynamic_contacts_for_group(group, max_age=60)
+
+        group.query = u'surname:"Foo 2"'
+        yield group.save()
+        self.assertEqual(
+            (yield self.store.get_dynamic_contacts_for_group(
+                group, max_age=60)),
+            [contact2.key])
+
+    @inlineCallbacks
+    def test_smart_group_snapshot_chunks(self):
+        self.store.SMART_GROUP_SNAPSHOT_CHUNK_SIZE = 2
+        group = yield self.store.new_smart_group(
+            u'test group', u'surname:"Foo 1"')
+        contact_keys = []
+        for i in range(5):
+            contact = yield self.store.new_contact(
+                name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+            contact_keys.append(contact.key)
+        self.assertEqual(
+            sorted((yield self.store.get_dynamic_contacts_for_group(
+                group, max_age=60))),
+            sorted(contact_keys))
+        snapshot = yield self.store.smart_group_snapshots.load(group.key)
+        self.assertEqual(snapshot.contact_count, 5)
+        self.assertEqual(snapshot.chunk_count, 3)
+        for chunk_key in snapshot.chunk_keys():
+            chunk = yield self.store.smart_group_snapshot_chunks.load(
+                chunk_key)
+            self.assertTrue(len(chunk.contact_keys) <= 2)
+        self.assertEqual(
+            sorted((yield self.store.get_smart_group_snapshot_keys(
+                snapshot))),
+            sorted(contact_keys))
+
+        # Chunks left over from a larger snapshot are deleted.
+        old_chunk_keys = snapshot.chunk_keys()
+        for key in contact_keys[2:]:
+            yield self.store.delete_contact(
+                (yield self.store.get_contact_by_key(key)))
+        snapshot.refreshed_at = datetime.utcnow() - timedelta(seconds=61)
+        yield snapshot.save()
+        self.assertEqual(
+            (yield self.store.count_contacts_for_group(group, max_age=60)),
+            2)
+        snapshot = yield self.store.smart_group_snapshots.load(group.key)
+        self.assertEqual(snapshot.chunk_count, 1)
+        self.assertNotEqual(
+            (yield self.store.smart_group_snapshot_chunks.load(
+                old_chunk_keys[0])), None)
+        for chunk_key in old_chunk_keys[1:]:
+            self.assertEqual(
+                (yield self.store.smart_group_snapshot_chunks.load(
+                    chunk_key)), None)
+
+    @inlineCallbacks
+    def test_clear_group_caches(self):
+        group = yield self.store.new_smart_group(
+            u'test group', u'surname:"Foo 1"')
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo 1', msisdn=u'12345')
+        yield self.store.get_dynamic_contacts_for_group(group, max_age=60)
+        snapshot = yield self.store.smart_group_snapshots.load(group.key)
+        self.assertNotEqual(snapshot, None)
+        [chunk_key] = snapshot.chunk_keys()
+        yield self.store.clear_group_caches(group)
+        self.assertEqual(
+            (yield self.store.smart_group_snapshots.load(group.key)), None)
+        self.assertEqual(
+            (yield self.store.smart_group_snapshot_chunks.load(chunk_key)),
+            None)
+        # Clearing caches that don't exist does nothing.
+        yield self.store.clear_group_caches(group)
+
+    @inlineCallbacks
+    def test_clear_group_caches_deletes_member_count(self):
+        store = self.user_helper.user_api.contact_store
+        group = yield store.new_group(u'test group')
+        yield store.count_contacts_for_group(group)
+        self.assertEqual((yield store.group_counts.get_count(group.key)), 0)
+        yield store.clear_group_caches(group)
+        self.assertEqual((yield store.group_counts.get_count(group.key)), None)
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname(self):
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo', msisdn=u'12345')
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'fab', msisdn=u'12345')
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Bar', msisdn=u'12345')
+        yield self.store.new_contact(name=u'Contact', msisdn=u'12345')
+
+        contacts = yield self.store.filter_contacts_on_surname(u'f')
+        self.assertEqual(
+            [c.key for c in contacts], sorted([contact1.key, contact2.key]))
+        contacts = yield self.store.filter_contacts_on_surname(u'F')
+        self.assertEqual(
+            [c.key for c in contacts], sorted([contact1.key, contact2.key]))
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'z')), [])
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'')), [])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_for_group(self):
+        group = yield self.store.new_group(u'group')
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo', msisdn=u'12345', groups=[group])
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Fab', msisdn=u'12345')
+        yield self.store.new_contact(
+            name=u'Contact', surname=u'Bar', msisdn=u'12345', groups=[group])
+
+        contacts = yield self.store.filter_contacts_on_surname(
+            u'f', group=group)
+        self.assertEqual([c.key for c in contacts], [contact1.key])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_paginated(self):
+        keys = []
+        for i in range(5):
+            contact = yield self.store.new_contact(
+                name=u'Contact', surname=u'Foo %d' % i, msisdn=u'12345')
+            keys.append(contact.key)
+        keys.sort()
+
+        self.assertEqual(
+            (yield self.store.get_contact_keys_on_surname(u'f')), keys)
+        contacts = yield self.store.filter_contacts_on_surname(
+            u'f', start=0, limit=2)
+        self.assertEqual([c.key for c in contacts], keys[0:2])
+        contacts = yield self.store.filter_contacts_on_surname(
+            u'f', start=2, limit=2)
+        self.assertEqual([c.key for c in contacts], keys[2:4])
+        contacts = yield self.store.filter_contacts_on_surname(u'f', start=4)
+        self.assertEqual([c.key for c in contacts], keys[4:])
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_after_update(self):
+        contact = yield self.store.new_contact(
+            name=u'Contact', surname=u'Foo', msisdn=u'12345')
+        yield self.store.update_contact(contact.key, surname=u'Bar')
+        self.assertEqual(
+            (yield self.store.filter_contacts_on_surname(u'f')), [])
+        contacts = yield self.store.filter_contacts_on_surname(u'b')
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+    @inlineCallbacks
+    def get_addr_bunches(self, keys, delivery_class):
+        addrs = []
+        for bunch in self.store.load_addr_bunches(keys, delivery_class):
+            addrs.extend((yield bunch))
+        returnValue(sorted(addrs))
+
+    @inlineCallbacks
+    def test_load_addr_bunches(self):
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'1', msisdn=u'+27831234567',
+            gtalk_id=u'random@gmail.com')
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'2', msisdn=u'+27830000000')
+        keys = [contact1.key, contact2.key, u'unknown']
+
+        self.assertEqual((yield self.get_addr_bunches(keys, 'sms')), sorted([
+            (contact1.key, u'+27831234567'),
+            (contact2.key, u'+27830000000'),
+        ]))
+        self.assertEqual((yield self.get_addr_bunches(keys, None)), sorted([
+            (contact1.key, u'+27831234567'),
+            (contact2.key, u'+27830000000'),
+        ]))
+        self.assertEqual((yield self.get_addr_bunches(keys, 'gtalk')), [
+            (contact1.key, u'random@gmail.com'),
+        ])
+        self.assertEqual(
+            (yield self.get_addr_bunches(keys, 'bad_delivery_class')), [])
+
+    @inlineCallbacks
+    def test_load_addr_bunches_in_bunches(self):
+        self.store.manager.load_bunch_size = 2
+        keys = []
+        for i in range(5):
+            contact = yield self.store.new_contact(
+                name=u'Contact', surname=u'%d' % i,
+                msisdn=u'+2783000000%d' % i)
+            keys.append(contact.key)
+
+        bunch_sizes = []
+        addr_keys = []
+        for bunch in self.store.load_addr_bunches(keys, 'sms'):
+            addrs = yield bunch
+            bunch_sizes.append(len(addrs))
+            addr_keys.extend(key for key, addr in addrs)
+        self.assertEqual(bunch_sizes, [2, 2, 1])
+        self.assertEqual(sorted(addr_keys), sorted(keys))
+
     @inlineCallbacks
     def test_new_contact_for_addr(self):
         @inlineCallbacks
@@ -316,3 +668,64 @@ class TestContactStore(VumiTestCase):
                                      msisdn=u'unknown')
         yield check_contact_for_addr('voice', u'+27831234567',
                                      msisdn=u'+27831234567')
+
+
+class TestGroupMemberCounts(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.counts = GroupMemberCounts(
+            self.redis.sub_manager('group_member_counts'))
+
+    @inlineCallbacks
+    def test_get_count_missing(self):
+        self.assertEqual((yield self.counts.get_count('group1')), None)
+
+    @inlineCallbacks
+    def test_set_count(self):
+        yield self.counts.set_count('group1', 3)
+        self.assertEqual((yield self.counts.get_count('group1')), 3)
+
+    @inlineCallbacks
+    def test_add(self):
+        yield self.counts.set_count('group1', 3)
+        yield self.counts.add('group1', 2)
+        self.assertEqual((yield self.counts.get_count('group1')), 5)
+        yield self.counts.add('group1', -4)
+        self.assertEqual((yield self.counts.get_count('group1')), 1)
+
+    @inlineCallbacks
+    def test_add_without_count(self):
+        yield self.counts.add('group1', 1)
+        self.assertEqual((yield self.counts.get_count('group1')), None)
+
+    @inlineCallbacks
+    def test_set_count_after_add(self):
+        yield self.counts.add('group1', 1)
+        yield self.counts.set_count('group1', 3)
+        self.assertEqual((yield self.counts.get_count('group1')), 3)
+
+    @inlineCallbacks
+    def test_init_count(self):
+        yield self.counts.add('group1', 1)
+        delta = yield self.counts.get_delta('group1')
+        self.assertEqual(delta, 1)
+        # A change made while the count was being looked up is kept.
+        yield self.counts.add('group1', 1)
+        yield self.counts.init_count('group1', 3, delta)
+        self.assertEqual((yield self.counts.get_count('group1')), 4)
+
+    @inlineCallbacks
+    def test_init_count_existing(self):
+        yield self.counts.set_count('group1', 3)
+        delta = yield self.counts.get_delta('group1')
+        yield self.counts.init_count('group1', 5, delta)
+        self.assertEqual((yield self.counts.get_count('group1')), 3)
+
+    @inlineCallbacks
+    def test_delete(self):
+        yield self.counts.set_count('group1', 3)
+        yield self.counts.delete('group1')
+        self.assertEqual((yield self.counts.get_count('group1')), None)
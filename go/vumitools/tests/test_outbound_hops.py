@@ -0,0 +1,83 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.outbound_hops import OutboundHopCache
+from go.vumitools.tests.helpers import FakeRedisCommandsHelper
+
+
+class TestOutboundHopCache(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.add_helper(FakeRedisCommandsHelper())
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+
+    def mk_cache(self, ttl=3600):
+        return OutboundHopCache(
+            self.redis.sub_manager('outbound_hop_cache'), ttl)
+
+    @inlineCallbacks
+    def test_get_missing(self):
+        cache = self.mk_cache()
+        self.assertEqual((yield cache.get(u'msg-1')), None)
+
+    @inlineCallbacks
+    def test_store_and_get(self):
+        cache = self.mk_cache()
+        hops = [
+            [["CONVERSATION:app1:conv1", "default"],
+             ["TRANSPORT_TAG:pool1:1234", "default"]],
+        ]
+        yield cache.store(u'msg-1', hops, (u"pool1", u"1234"), u"user-1")
+        self.assertEqual((yield cache.get(u'msg-1')), {
+            "hops": hops,
+            "tag": [u"pool1", u"1234"],
+            "user_account": u"user-1",
+            "unroutable_reply": False,
+        })
+
+    @inlineCallbacks
+    def test_get_many(self):
+        cache = self.mk_cache()
+        yield cache.store(u'msg-1', [], (u"pool1", u"1234"), u"user-1")
+        yield cache.store(u'msg-3', [], (u"pool1", u"5678"), u"user-1")
+        round_trips = cache.round_trips
+        [md1, md2, md3] = yield cache.get_many([u'msg-1', u'msg-2', u'msg-3'])
+        self.assertEqual(cache.round_trips, round_trips + 1)
+        self.assertEqual(md1["tag"], [u"pool1", u"1234"])
+        self.assertEqual(md2, None)
+        self.assertEqual(md3["tag"], [u"pool1", u"5678"])
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    @inlineCallbacks
+    def test_get_many_empty(self):
+        cache = self.mk_cache()
+        self.assertEqual((yield cache.get_many([])), [])
+        self.assertEqual(cache.round_trips, 0)
+
+    @inlineCallbacks
+    def test_store_unroutable_reply(self):
+        cache = self.mk_cache()
+        yield cache.store(
+            u'msg-1', [], (u"pool1", u"1234"), None, unroutable_reply=True)
+        self.assertEqual((yield cache.get(u'msg-1')), {
+            "hops": [],
+            "tag": [u"pool1", u"1234"],
+            "user_account": None,
+            "unroutable_reply": True,
+        })
+
+    @inlineCallbacks
+    def test_store_sets_expiry(self):
+        cache = self.mk_cache(ttl=60)
+        yield cache.store(u'msg-1', [], (u"pool1", u"1234"), u"user-1")
+        ttl = yield cache.manager.ttl(cache._hops_key(u'msg-1'))
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_store_disabled(self):
+        cache = self.mk_cache(ttl=0)
+        yield cache.store(u'msg-1', [], (u"pool1", u"1234"), u"user-1")
+        self.assertEqual((yield cache.get(u'msg-1')), None)
@@ -0,0 +1,28 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.redis_commands import RedisCommands
+from go.vumitools.tests.helpers import FakeRedisCommandsHelper
+
+
+class TestRedisCommands(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.add_helper(FakeRedisCommandsHelper())
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.manager = self.redis.sub_manager('commands')
+        self.commands = RedisCommands(self.manager)
+
+    @inlineCallbacks
+    def test_mget(self):
+        yield self.manager.set('a', '1')
+        yield self.manager.set('c', '3')
+        self.assertEqual(
+            (yield self.commands.mget(['a', 'b', 'c'])), ['1', None, '3'])
+
+    @inlineCallbacks
+    def test_mget_no_keys(self):
+        self.assertEqual((yield self.commands.mget([])), [])
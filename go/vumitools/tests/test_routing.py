@@ -1,11 +1,13 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.task import Clock, deferLater
 
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 from vumi.tests.utils import LogCatcher
 
 from go.vumitools.routing import (
     AccountRoutingTableDispatcher, RoutingMetadata, RoutingError,
-    UnroutableMessageError, NoTargetError)
+    UnroutableMessageError, NoTargetError, shard_for_account)
 from go.vumitools.routing_table import RoutingTable
 from go.vumitools.tests.helpers import VumiApiHelper
 from go.vumitools.utils import MessageMetadataHelper
@@ -276,6 +278,59 @@ class TestRoutingMetadata(VumiTestCase):
         self.set_outbound_hops(msg, [["dc2", "sc2"], ["dc1", "sc1"]])
         self.assertEqual(rmeta.unroutable_event_done(), True)
 
+    def test_compact_push_hops(self):
+        msg, _ = self.mk_msg_rmeta()
+        rmeta = RoutingMetadata(msg, compact=True)
+        rmeta.push_source('sc1', 'se1')
+        rmeta.push_destination('dc1', 'de1')
+        rmeta.push_hop(['dc1', 'se2'], ['sc1', 'de2'])
+        self.assert_hops(msg, [
+            [[0, 'se1'], [1, 'de1']],
+            [[1, 'se2'], [0, 'de2']],
+        ])
+        self.assertEqual(msg['routing_metadata']['go_hop_connectors'],
+                         ['sc1', 'dc1'])
+        self.assertEqual(rmeta.get_hops(), [
+            [['sc1', 'se1'], ['dc1', 'de1']],
+            [['dc1', 'se2'], ['sc1', 'de2']],
+        ])
+
+    def test_compact_outbound_hops_share_connectors(self):
+        msg, _ = self.mk_msg_rmeta()
+        rmeta = RoutingMetadata(msg, compact=True)
+        rmeta.set_outbound_hops([
+            [['sc1', 'se1'], ['dc1', 'de1']],
+        ])
+        rmeta.push_source('dc1', 'de1')
+        self.assert_outbound_hops(msg, [[[0, 'se1'], [1, 'de1']]])
+        self.assert_hops(msg, [[[1, 'de1'], None]])
+        self.assertEqual(msg['routing_metadata']['go_hop_connectors'],
+                         ['sc1', 'dc1'])
+        self.assertEqual(rmeta.next_hop(), ['sc1', 'se1'])
+
+    def test_compact_is_sticky(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        RoutingMetadata(msg, compact=True).push_source('sc1', 'se1')
+        rmeta = RoutingMetadata(msg)
+        rmeta.push_destination('dc1', 'de1')
+        self.assert_hops(msg, [[[0, 'se1'], [1, 'de1']]])
+
+    def test_compact_reads_uncompacted_hops(self):
+        msg, _ = self.mk_msg_rmeta(
+            go_hop_connectors=['sc1'],
+            go_outbound_hops=[[['dc1', 'de1'], ['sc1', 'se1']]])
+        rmeta = RoutingMetadata(msg)
+        self.assertEqual(rmeta.get_outbound_hops(), [
+            [['dc1', 'de1'], ['sc1', 'se1']],
+        ])
+        self.assertEqual(rmeta.get_hops(), [])
+
+    def test_not_compact_by_default(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        rmeta.push_hop(['sc1', 'se1'], ['dc1', 'de1'])
+        self.assert_hops(msg, [[['sc1', 'se1'], ['dc1', 'de1']]])
+        self.assertFalse('go_hop_connectors' in msg['routing_metadata'])
+
 
 class RoutingTableDispatcherTestCase(VumiTestCase):
     """Base class for ``AccountRoutingTableDispatcher`` test cases"""
@@ -443,8 +498,8 @@ class RoutingTableDispatcherTestCase(VumiTestCase):
 
 class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
 
-    def get_dispatcher(self):
-        config = self.vumi_helper.mk_config({
+    def get_dispatcher(self, **extra_config):
+        config_dict = {
             "receive_inbound_connectors": [
                 "sphex", "router_ro"
             ],
@@ -463,7 +518,9 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
                 "router": "router_ri",
             },
             "opt_out_connector": "optout",
-        })
+        }
+        config_dict.update(extra_config)
+        config = self.vumi_helper.mk_config(config_dict)
         return self.vumi_helper.get_worker_helper().get_worker(
             AccountRoutingTableDispatcher, config)
 
@@ -746,6 +803,88 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
             'Outbound message for event has no associated user account:'
             ' <Message payload='))
 
+    @inlineCallbacks
+    def test_event_routing_from_outbound_hop_cache(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        [sent] = self.get_dispatched_outbound('sphex')
+
+        def fail_find_message_for_event(event):
+            self.fail("Unexpected message store lookup for %r" % (event,))
+        self.vumi_helper.monkey_patch(
+            dispatcher, 'find_message_for_event',
+            fail_find_message_for_event)
+
+        ack = self.msg_helper.make_ack(sent)
+        yield self.dispatch_event(ack, 'sphex')
+        self.assert_rkeys_used(
+            'app1.outbound', 'sphex.outbound', 'sphex.event', 'app1.event')
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=sent)
+        self.assertEqual([ack], self.get_dispatched_events('app1'))
+
+    @inlineCallbacks
+    def test_hot_path_metrics(self):
+        dispatcher = yield self.get_dispatcher(hot_path_metrics_sample_rate=1)
+        metric_manager = dispatcher.routing_metrics.metric_manager
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual([msg], self.get_dispatched_inbound('app1'))
+
+        def poll(name):
+            return [value for _, value in metric_manager[name].poll()]
+
+        for stage in ['total', 'get_config', 'tag_lookup', 'set_destination',
+                      'publish']:
+            [_] = poll('%s.time' % (stage,))
+        self.assertEqual(poll('billing.time'), [])
+        self.assertEqual(poll('messages'), [1])
+        self.assertEqual(poll('tag_ownership.hit_ratio'), [1.0])
+
+    @inlineCallbacks
+    def test_event_routing_with_compact_hops(self):
+        yield self.get_dispatcher(compact_hops=True)
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        [sent] = self.get_dispatched_outbound('sphex')
+        self.assertEqual(
+            sent['routing_metadata']['go_hop_connectors'],
+            ['CONVERSATION:app1:conv1', 'TRANSPORT_TAG:pool1:1234'])
+        self.assertEqual(RoutingMetadata(sent).get_hops(), [
+            [['CONVERSATION:app1:conv1', 'default'],
+             ['TRANSPORT_TAG:pool1:1234', 'default']],
+        ])
+
+        ack = self.msg_helper.make_ack(sent)
+        yield self.dispatch_event(ack, 'sphex')
+        [event] = self.get_dispatched_events('app1')
+        event_rmeta = RoutingMetadata(event)
+        self.assertEqual(event_rmeta.get_hops(), [
+            [['TRANSPORT_TAG:pool1:1234', 'default'],
+             ['CONVERSATION:app1:conv1', 'default']],
+        ])
+        self.assertEqual(
+            event_rmeta.get_outbound_hops(), RoutingMetadata(sent).get_hops())
+        self.assertEqual(
+            event['routing_metadata']['go_hop_connectors'],
+            ['CONVERSATION:app1:conv1', 'TRANSPORT_TAG:pool1:1234'])
+
+    @inlineCallbacks
+    def test_outbound_hop_cache_only_for_transports(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield dispatcher.publish_outbound(msg, 'router_ro', 'default')
+        hops = yield dispatcher.outbound_hop_cache.get(msg['message_id'])
+        self.assertEqual(hops, None)
+
     @inlineCallbacks
     def test_outbound_message_gets_transport_fields(self):
         yield self.get_dispatcher()
@@ -767,11 +906,57 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
         ])
         self.assertEqual([msg], self.get_dispatched_outbound('sphex'))
 
+    @inlineCallbacks
+    def test_routing_table_cached(self):
+        dispatcher = yield self.get_dispatcher()
+        for i in range(3):
+            msg = self.with_md(
+                self.msg_helper.make_inbound("foo %d" % (i,)),
+                tag=("pool1", "1234"))
+            yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(3, len(self.get_dispatched_inbound('app1')))
+        cache = dispatcher.routing_table_cache
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    @inlineCallbacks
+    def test_routing_table_update_invalidates_cache(self):
+        yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+
+        user_account = yield self.user_helper.get_user_account()
+        user_account.routing_table = RoutingTable({
+            "TRANSPORT_TAG:pool1:1234": {
+                "default": ["CONVERSATION:app2:conv2", "default"]},
+        })
+        yield user_account.save()
+        yield self.user_helper.user_api.routing_table_updated()
+
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app2')))
+
+    @inlineCallbacks
+    def test_flush_routing_table_cache_command(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertTrue(
+            self.user_account_key in dispatcher.routing_table_cache)
+        yield dispatcher.process_command_flush_routing_table_cache(
+            user_account_key=self.user_account_key)
+        self.assertFalse(
+            self.user_account_key in dispatcher.routing_table_cache)
+
 
 class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
 
-    def get_dispatcher(self):
-        config = self.vumi_helper.mk_config({
+    def get_dispatcher(self, **extra_config):
+        config = self.vumi_helper.mk_config(dict({
             "receive_inbound_connectors": [
                 "sphex", "router_ro", "billing_dispatcher_ro"
             ],
@@ -794,7 +979,7 @@ class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
             },
             "opt_out_connector": "optout",
             "default_unroutable_inbound_reply": "Eep!",
-        })
+        }, **extra_config))
         return self.vumi_helper.get_worker_helper().get_worker(
             AccountRoutingTableDispatcher, config)
 
@@ -923,6 +1108,67 @@ class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
         self.assertEqual(
             [msg], self.get_dispatched_outbound('billing_dispatcher_ro'))
 
+    @inlineCallbacks
+    def get_dispatcher_with_free_messages(self, costs):
+        dispatcher = yield self.get_dispatcher(
+            billing_api_url="http://billing.example.com/")
+        self.vumi_helper.monkey_patch(
+            dispatcher.free_messages.billing_api, 'get_cost_list',
+            lambda: succeed(costs))
+        returnValue(dispatcher)
+
+    def mk_free_cost(self, message_direction):
+        return {
+            'account_number': None,
+            'tag_pool_name': 'pool1',
+            'message_direction': message_direction,
+            'message_cost': 0,
+            'session_cost': 0,
+            'markup_percent': 0,
+        }
+
+    @inlineCallbacks
+    def test_free_inbound_message_from_transport_to_app1(self):
+        yield self.get_dispatcher_with_free_messages(
+            [self.mk_free_cost('Inbound')])
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assert_rkeys_used('sphex.inbound', 'app1.inbound')
+
+        hops = [
+            ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ['CONVERSATION:app1:conv1', 'default'],
+        ]
+        self.with_md(msg, conv=('app1', 'conv1'), is_paid=True, hops=hops)
+        self.assertEqual([msg], self.get_dispatched_inbound('app1'))
+
+    @inlineCallbacks
+    def test_free_outbound_message_from_conversation_to_transport(self):
+        yield self.get_dispatcher_with_free_messages(
+            [self.mk_free_cost('Outbound')])
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        self.assert_rkeys_used('app1.outbound', 'sphex.outbound')
+
+        hops = [
+            ['CONVERSATION:app1:conv1', 'default'],
+            ['TRANSPORT_TAG:pool1:1234', 'default'],
+        ]
+        self.with_md(msg, tag=("pool1", "1234"), is_paid=True, hops=hops)
+        self.assertEqual([msg], self.get_dispatched_outbound('sphex'))
+
+    @inlineCallbacks
+    def test_charged_outbound_message_with_free_messages(self):
+        yield self.get_dispatcher_with_free_messages(
+            [self.mk_free_cost('Inbound')])
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        self.assert_rkeys_used(
+            'app1.outbound', 'billing_dispatcher_ro.outbound')
+
     @inlineCallbacks
     def test_outbound_message_from_billing_to_transport(self):
         yield self.get_dispatcher()
@@ -1008,6 +1254,324 @@ class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
             'billing_dispatcher_ro', msg, "Eep!", tag=("pool1", "unowned-tag"))
 
 
+class TestRoutingTableDispatcherWithEventBatching(
+        RoutingTableDispatcherTestCase):
+
+    def get_dispatcher(self):
+        config = self.vumi_helper.mk_config({
+            "receive_inbound_connectors": [
+                "sphex", "router_ro"
+            ],
+            "receive_outbound_connectors": [
+                "app1", "app2", "router_ri", "optout"
+            ],
+            "metrics_prefix": "foo",
+            "application_connector_mapping": {
+                "app1": "app1",
+                "app2": "app2",
+            },
+            "router_inbound_connector_mapping": {
+                "router": "router_ro",
+            },
+            "router_outbound_connector_mapping": {
+                "router": "router_ri",
+            },
+            "opt_out_connector": "optout",
+            "event_batch_size": 2,
+            "event_batch_delay": 1.0,
+        })
+        return self.vumi_helper.get_worker_helper().get_worker(
+            AccountRoutingTableDispatcher, config)
+
+    def patch_find_message_for_event(self, dispatcher):
+        def fail_find_message_for_event(event):
+            self.fail("Unexpected message store lookup for %r" % (event,))
+        self.vumi_helper.monkey_patch(
+            dispatcher, 'find_message_for_event',
+            fail_find_message_for_event)
+
+    @inlineCallbacks
+    def test_event_batch_routing(self):
+        dispatcher = yield self.get_dispatcher()
+        self.patch_find_message_for_event(dispatcher)
+        msg1, ack1 = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        msg2, ack2 = yield self.mk_msg_ack(
+            tag=('pool1', '9012'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app2:conv2', 'default'],
+                ['TRANSPORT_TAG:pool1:9012', 'default'],
+            ])
+        d = self.dispatch_event(ack1, 'sphex')
+        yield self.dispatch_event(ack2, 'sphex')
+        yield d
+        self.assert_rkeys_used('sphex.event', 'app1.event', 'app2.event')
+        self.with_md(ack1, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=msg1)
+        self.with_md(ack2, tag=('pool1', '9012'), conv=('app2', 'conv2'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:9012', 'default'],
+                         ['CONVERSATION:app2:conv2', 'default'],
+                     ], outbound_hops_from=msg2)
+        self.assertEqual([ack1], self.get_dispatched_events('app1'))
+        self.assertEqual([ack2], self.get_dispatched_events('app2'))
+
+    @inlineCallbacks
+    def test_event_batch_preserves_order(self):
+        yield self.get_dispatcher()
+        acks = []
+        for i in range(2):
+            msg, ack = yield self.mk_msg_ack(
+                tag=('pool1', '1234'), user_account=self.user_account_key,
+                hops=[
+                    ['CONVERSATION:app1:conv1', 'default'],
+                    ['TRANSPORT_TAG:pool1:1234', 'default'],
+                ])
+            acks.append(ack)
+        d = self.dispatch_event(acks[0], 'sphex')
+        yield self.dispatch_event(acks[1], 'sphex')
+        yield d
+        self.assertEqual(
+            [a['event_id'] for a in acks],
+            [e['event_id'] for e in self.get_dispatched_events('app1')])
+
+    @inlineCallbacks
+    def test_event_batch_flushed_after_delay(self):
+        dispatcher = yield self.get_dispatcher()
+        clock = Clock()
+        dispatcher.event_batcher.clock = clock
+        msg, ack = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        config = yield dispatcher.get_config(ack)
+        d = dispatcher.process_event(config, ack, 'sphex')
+        # The event isn't done with until its batch has been routed.
+        self.assertNoResult(d)
+        self.assertEqual(len(dispatcher.event_batcher), 1)
+        clock.advance(1.0)
+        yield d
+        yield self.vumi_helper.get_worker_helper().kick_delivery()
+        self.assertEqual(
+            [ack['event_id']],
+            [e['event_id'] for e in self.get_dispatched_events('app1')])
+
+    def count_unacked(self):
+        broker = self.vumi_helper.get_worker_helper().broker
+        return sum(len(channel.unacked) for channel in broker.channels)
+
+    @inlineCallbacks
+    def test_event_acked_after_batch_routed(self):
+        dispatcher = yield self.get_dispatcher()
+        clock = Clock()
+        dispatcher.event_batcher.clock = clock
+        msg, ack = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        d = self.dispatch_event(ack, 'sphex')
+        while len(dispatcher.event_batcher) == 0:
+            yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(self.count_unacked(), 1)
+        clock.advance(1.0)
+        yield d
+        self.assertEqual(self.count_unacked(), 0)
+        self.assertEqual(
+            [ack['event_id']],
+            [e['event_id'] for e in self.get_dispatched_events('app1')])
+
+    @inlineCallbacks
+    def test_event_batch_with_unroutable_event(self):
+        yield self.get_dispatcher()
+        msg, ack = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        missing_ack = self.msg_helper.make_ack(
+            self.msg_helper.make_outbound("missing"))
+        with LogCatcher() as lc:
+            d = self.dispatch_event(missing_ack, 'sphex')
+            yield self.dispatch_event(ack, 'sphex')
+            yield d
+            [err] = lc.errors
+        [failure] = self.flushLoggedErrors(UnroutableMessageError)
+        self.assertEqual(err['failure'], failure)
+        self.assertEqual(
+            failure.value.args[0],
+            'Could not find transport user message for event')
+        self.assertEqual(
+            [ack['event_id']],
+            [e['event_id'] for e in self.get_dispatched_events('app1')])
+
+
+class TestShardForAccount(VumiTestCase):
+
+    def test_single_shard(self):
+        for i in range(10):
+            self.assertEqual(shard_for_account(u"account-%d" % (i,), 1), 0)
+
+    def test_deterministic(self):
+        self.assertEqual(
+            shard_for_account(u"account-1", 4),
+            shard_for_account(u"account-1", 4))
+
+    def test_spread_across_shards(self):
+        counts = [0] * 4
+        for i in range(400):
+            counts[shard_for_account(u"account-%d" % (i,), 4)] += 1
+        for count in counts:
+            self.assertTrue(50 < count < 150, counts)
+
+
+class TestShardedRoutingTableDispatcher(RoutingTableDispatcherTestCase):
+
+    def get_dispatcher(self, shard_index):
+        config = self.vumi_helper.mk_config({
+            "receive_inbound_connectors": [
+                "sphex", "router_ro"
+            ],
+            "receive_outbound_connectors": [
+                "app1", "app2", "router_ri", "optout"
+            ],
+            "metrics_prefix": "foo",
+            "application_connector_mapping": {
+                "app1": "app1",
+                "app2": "app2",
+            },
+            "router_inbound_connector_mapping": {
+                "router": "router_ro",
+            },
+            "router_outbound_connector_mapping": {
+                "router": "router_ri",
+            },
+            "opt_out_connector": "optout",
+            "shard_count": 2,
+            "shard_index": shard_index,
+        })
+        return self.vumi_helper.get_worker_helper().get_worker(
+            AccountRoutingTableDispatcher, config)
+
+    @inlineCallbacks
+    def get_shards(self):
+        """Return the shard that owns the test account and the other one.
+        """
+        shards = []
+        for shard_index in range(2):
+            shard = yield self.get_dispatcher(shard_index)
+            shards.append(shard)
+        owner_index = shard_for_account(self.user_account_key, 2)
+        returnValue((shards[owner_index], shards[1 - owner_index]))
+
+    def kick_delivery(self):
+        return self.vumi_helper.get_worker_helper().kick_delivery()
+
+    @inlineCallbacks
+    def test_owns_account(self):
+        owner, other = yield self.get_shards()
+        self.assertTrue(owner.owns_account(self.user_account_key))
+        self.assertFalse(other.owns_account(self.user_account_key))
+
+    @inlineCallbacks
+    def test_inbound_forwarded_to_owner(self):
+        owner, other = yield self.get_shards()
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        config = yield other.get_config(msg)
+        self.assertEqual(config.user_account_key, self.user_account_key)
+        self.assertEqual(config.routing_table, {})
+        self.assertFalse(self.user_account_key in other.routing_table_cache)
+        yield other.process_inbound(config, msg, 'sphex')
+        yield self.kick_delivery()
+        self.with_md(msg, conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ])
+        self.assertEqual([msg], self.get_dispatched_inbound('app1'))
+        self.assertTrue(self.user_account_key in owner.routing_table_cache)
+        self.assertFalse(self.user_account_key in other.routing_table_cache)
+
+    @inlineCallbacks
+    def test_inbound_routed_by_either_shard(self):
+        owner, other = yield self.get_shards()
+        for i in range(4):
+            msg = self.with_md(
+                self.msg_helper.make_inbound("foo %d" % (i,)),
+                tag=("pool1", "1234"))
+            yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(4, len(self.get_dispatched_inbound('app1')))
+        self.assertFalse(self.user_account_key in other.routing_table_cache)
+
+    @inlineCallbacks
+    def test_reply_forwarded_to_owner(self):
+        owner, other = yield self.get_shards()
+        msg, reply = yield self.mk_msg_reply(tag=("pool1", "1234"))
+        self.with_md(reply, conv=('app1', 'conv1'))
+        config = yield other.get_config(reply)
+        yield other.process_outbound(config, reply, 'app1')
+        yield self.kick_delivery()
+        self.with_md(reply, tag=("pool1", "1234"),
+                     hops=[
+                         ['CONVERSATION:app1:conv1', 'default'],
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                     ])
+        self.assertEqual([reply], self.get_dispatched_outbound('sphex'))
+        self.assertFalse(self.user_account_key in other.routing_table_cache)
+
+    @inlineCallbacks
+    def test_event_forwarded_to_owner(self):
+        owner, other = yield self.get_shards()
+        msg, ack = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        config = yield other.get_config(ack)
+        yield other.process_event(config, ack, 'sphex')
+        yield self.kick_delivery()
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=msg)
+        self.assertEqual([ack], self.get_dispatched_events('app1'))
+
+    @inlineCallbacks
+    def test_event_for_reply_sent_by_other_shard(self):
+        owner, other = yield self.get_shards()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        config = yield other.get_config(msg)
+        yield other.process_outbound(config, msg, 'app1')
+        yield self.kick_delivery()
+        [sent] = self.get_dispatched_outbound('sphex')
+
+        ack = self.msg_helper.make_ack(sent)
+        config = yield other.get_config(ack)
+        yield other.process_event(config, ack, 'sphex')
+        yield self.kick_delivery()
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=sent)
+        self.assertEqual([ack], self.get_dispatched_events('app1'))
+
+
 class TestUnroutableSessionResponse(RoutingTableDispatcherTestCase):
 
     def get_routing_table(self):
@@ -0,0 +1,131 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.routing_metrics import (
+    PolledDeltaMetric, PolledRatioMetric, RoutingMetrics, timed_stage)
+
+
+class Counters(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+
+class TestPolledMetrics(VumiTestCase):
+
+    def values(self, metric):
+        return [value for _, value in metric.poll()]
+
+    def test_delta(self):
+        counters = Counters()
+        counters.round_trips = 5
+        metric = PolledDeltaMetric("trips", lambda: counters.round_trips)
+        self.assertEqual(self.values(metric), [0])
+        counters.round_trips = 8
+        self.assertEqual(self.values(metric), [3])
+        self.assertEqual(self.values(metric), [0])
+
+    def test_ratio(self):
+        counters = Counters()
+        metric = PolledRatioMetric(
+            "ratio", lambda: counters.hits,
+            lambda: counters.hits + counters.misses)
+        counters.hits, counters.misses = 3, 1
+        self.assertEqual(self.values(metric), [0.75])
+        counters.misses = 2
+        self.assertEqual(self.values(metric), [0.0])
+
+    def test_ratio_without_denominator_increase(self):
+        counters = Counters()
+        metric = PolledRatioMetric(
+            "ratio", lambda: counters.hits, lambda: counters.misses)
+        self.assertEqual(self.values(metric), [])
+
+
+class Stages(object):
+    def __init__(self, routing_metrics):
+        self.routing_metrics = routing_metrics
+
+    @timed_stage('publish')
+    def publish(self, msg, d):
+        return d
+
+    @timed_stage('billing', msg_arg=1)
+    def billing(self, config, msg):
+        return "billed"
+
+
+class TestRoutingMetrics(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metric_manager = MetricManager("go.test.")
+
+    def mk_routing_metrics(self, sample_rate=2):
+        return RoutingMetrics(
+            self.metric_manager, sample_rate, clock=self.clock.seconds)
+
+    def poll(self, name):
+        metric = self.metric_manager[name]
+        return [value for _, value in metric.poll()]
+
+    def test_process_message_samples(self):
+        routing_metrics = self.mk_routing_metrics(sample_rate=2)
+        for msg in ["msg1", "msg2", "msg3"]:
+            d = Deferred()
+            result = routing_metrics.process_message(msg, lambda: d)
+            self.clock.advance(1.5)
+            d.callback(msg)
+            self.assertEqual(self.successResultOf(result), msg)
+        self.assertEqual(self.poll("total.time"), [1.5])
+        self.assertEqual(self.poll("messages"), [3])
+        self.assertFalse(routing_metrics.is_sampled("msg2"))
+
+    def test_timed_stage(self):
+        routing_metrics = self.mk_routing_metrics(sample_rate=1)
+        stages = Stages(routing_metrics)
+        msg = object()
+
+        def process():
+            d = Deferred()
+            result = stages.publish(msg, d)
+            self.clock.advance(0.25)
+            d.callback("published")
+            self.assertEqual(
+                self.successResultOf(stages.billing(None, msg)), "billed")
+            return result
+
+        result = routing_metrics.process_message(msg, process)
+        self.assertEqual(self.successResultOf(result), "published")
+        self.assertEqual(self.poll("publish.time"), [0.25])
+        self.assertEqual(self.poll("billing.time"), [0])
+
+    def test_timed_stage_unsampled(self):
+        stages = Stages(self.mk_routing_metrics())
+        d = succeed("published")
+        self.assertTrue(stages.publish("msg", d) is d)
+        self.assertEqual(self.poll("publish.time"), [])
+
+    def test_timed_stage_disabled(self):
+        stages = Stages(None)
+        d = succeed("published")
+        self.assertTrue(stages.publish("msg", d) is d)
+
+    def test_round_trips(self):
+        routing_metrics = self.mk_routing_metrics()
+        cache, store = Counters(), Counters()
+        routing_metrics.add_cache("cache", cache)
+        routing_metrics.add_round_trip_source(store)
+        self.poll("datastore_round_trips")
+        cache.hits, cache.misses, cache.round_trips = 3, 1, 1
+        store.round_trips = 2
+        for msg in ["msg1", "msg2"]:
+            routing_metrics.process_message(msg, lambda: None)
+        self.assertEqual(self.poll("datastore_round_trips"), [3])
+        self.assertEqual(
+            self.poll("datastore_round_trips_per_message"), [1.5])
+        self.assertEqual(self.poll("cache.hit_ratio"), [0.75])
@@ -1,4 +1,5 @@
 import copy
+from collections import OrderedDict
 
 from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
@@ -122,6 +123,12 @@ class TestRoutingTable(VumiTestCase):
         self.assertEqual(rt.lookup_source(self.CONV_1, "default1.1"),
                          None)
 
+    def test_lookup_source_multiple(self):
+        rt = self.make_rt()
+        rt.add_entry(self.CONV_2, "default", self.CHANNEL_2, "default2")
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "default2"),
+                         [GoConnector.parse(self.CONV_1), "default1.1"])
+
     def test_lookup_targets(self):
         rt = self.make_rt()
         self.assertEqual(sorted(rt.lookup_targets(self.CONV_1)), [
@@ -135,6 +142,41 @@ class TestRoutingTable(VumiTestCase):
             ("default3", [GoConnector.parse(self.CONV_1), "default1.2"]),
         ])
 
+    def test_lookup_sources_multiple(self):
+        rt = self.make_rt(copy.deepcopy(self.COMPLEX_ROUTING))
+        self.assertEqual(sorted(rt.lookup_sources(self.ROUTER_1_OUTBOUND)), [
+            ("keyword1", [GoConnector.parse(self.CONV_1), "default"]),
+            ("keyword2", [GoConnector.parse(self.CONV_2), "default"]),
+        ])
+
+    def test_lookup_sources_after_changes(self):
+        rt = self.make_rt()
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [])
+        rt.add_entry(self.CHANNEL_2, "default", self.CONV_2, "default")
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [
+            ("default", [GoConnector.parse(self.CHANNEL_2), "default"]),
+        ])
+        rt.add_entry(self.CONV_1, "default1.2", self.CHANNEL_2, "other")
+        self.assertEqual(rt.lookup_sources(self.CHANNEL_3), [])
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "other"),
+                         [GoConnector.parse(self.CONV_1), "default1.2"])
+        rt.remove_entry(self.CHANNEL_2, "default")
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [])
+
+    def test_as_dict(self):
+        routing = copy.deepcopy(self.DEFAULT_ROUTING)
+        rt = self.make_rt(routing)
+        self.assertTrue(rt.as_dict() is routing)
+
+    def test_connectors_parsed_once(self):
+        rt = self.make_rt()
+        [target1, _] = rt.lookup_target(self.CONV_1, "default1.1")
+        [target2, _] = rt.lookup_target(self.CONV_1, "default1.1")
+        self.assertTrue(target1 is target2)
+        [(_, [source, _])] = rt.lookup_sources(self.CHANNEL_2)
+        [(entry_source, _, _, _), _] = rt.entries()
+        self.assertTrue(source is entry_source)
+
     def test_entries(self):
         rt = self.make_rt()
         self.assert_routing_entries(rt, [
@@ -230,6 +272,17 @@ class TestRoutingTable(VumiTestCase):
             (self.CONV_1, "default1.2", self.CHANNEL_3, "default3"),
         ])
 
+    def test_remove_connector_source_and_destination(self):
+        rt = self.make_rt(copy.deepcopy(self.COMPLEX_ROUTING))
+        rt.remove_connector(self.ROUTER_1_OUTBOUND)
+        self.assert_routing_entries(rt, [
+            (self.CHANNEL_2, "default", self.ROUTER_1_INBOUND, "default"),
+            (self.ROUTER_1_INBOUND, "default", self.CHANNEL_2, "default"),
+            (self.CONV_2, "sms", self.CHANNEL_3, "default"),
+        ])
+        self.assertEqual(rt.lookup_sources(self.ROUTER_1_OUTBOUND), [])
+        self.assertEqual(rt.lookup_sources(self.CONV_1), [])
+
     def test_remove_conversation(self):
         rt = self.make_rt({})
         conv = FakeConversation("conv_type_1", "12345")
@@ -424,6 +477,50 @@ class TestGoConnector(VumiTestCase):
         self.assertRaises(GoConnectorError, GoConnector.parse,
                           "CONVERSATION:foo:bar:baz")  # three parts
 
+    def test_parse_cached(self):
+        c1 = GoConnector.parse("CONVERSATION:conv_type_1:12345")
+        c2 = GoConnector.parse("CONVERSATION:conv_type_1:12345")
+        self.assertTrue(c1 is c2)
+
+    def test_parse_cache_bounded(self):
+        self.patch(GoConnector, '_parse_cache', OrderedDict())
+        self.patch(GoConnector, 'PARSE_CACHE_SIZE', 2)
+        c1 = GoConnector.parse("CONVERSATION:conv_type_1:1")
+        GoConnector.parse("CONVERSATION:conv_type_1:2")
+        self.assertTrue(GoConnector.parse("CONVERSATION:conv_type_1:1") is c1)
+        c3 = GoConnector.parse("CONVERSATION:conv_type_1:3")
+        self.assertEqual(GoConnector._parse_cache, {
+            "CONVERSATION:conv_type_1:1": c1,
+            "CONVERSATION:conv_type_1:3": c3,
+        })
+
+    def test_immutable(self):
+        c = GoConnector.for_conversation("conv_type_1", "12345")
+        self.assertRaises(AttributeError, setattr, c, "ctype", "FOO")
+        self.assertRaises(AttributeError, setattr, c, "conv_key", "6789")
+        self.assertRaises(AttributeError, delattr, c, "ctype")
+        self.assertEqual(str(c), "CONVERSATION:conv_type_1:12345")
+
+    def test_unknown_attribute(self):
+        c = GoConnector.for_conversation("conv_type_1", "12345")
+        self.assertRaises(AttributeError, getattr, c, "router_key")
+        self.assertFalse(hasattr(c, "router_key"))
+
+    def test_equality(self):
+        c1 = GoConnector.for_conversation("conv_type_1", "12345")
+        c2 = GoConnector.parse("CONVERSATION:conv_type_1:12345")
+        c3 = GoConnector.for_conversation("conv_type_1", "6789")
+        self.assertEqual(c1, c2)
+        self.assertEqual(hash(c1), hash(c2))
+        self.assertNotEqual(c1, c3)
+        self.assertNotEqual(c1, "CONVERSATION:conv_type_1:12345")
+        self.assertEqual(sorted([c3, c1]), [c1, c3])
+
+    def test_copy(self):
+        c = GoConnector.parse("ROUTER:rb_type_1:12345:INBOUND")
+        self.assertTrue(copy.copy(c) is c)
+        self.assertTrue(copy.deepcopy(c) is c)
+
     def test_flip_router_connector(self):
         c1 = GoConnector.for_router(
             "dummy", "1", GoConnector.INBOUND)
@@ -0,0 +1,135 @@
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.routing_table import RoutingTable
+from go.vumitools.routing_table_cache import (
+    RoutingTableVersions, RoutingTableCache)
+
+
+class FakeUserApi(object):
+    def __init__(self, user_account_key, routing_table):
+        self.user_account_key = user_account_key
+        self.routing_table = routing_table
+        self.loads = 0
+
+    def get_routing_table(self):
+        self.loads += 1
+        return succeed(self.routing_table)
+
+
+class TestRoutingTableVersions(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.versions = RoutingTableVersions(
+            self.redis.sub_manager('routing_table_versions'))
+
+    @inlineCallbacks
+    def test_get_version_default(self):
+        version = yield self.versions.get_version(u'user-1')
+        self.assertEqual(version, 0)
+
+    @inlineCallbacks
+    def test_bump_version(self):
+        yield self.versions.bump_version(u'user-1')
+        yield self.versions.bump_version(u'user-1')
+        self.assertEqual((yield self.versions.get_version(u'user-1')), 2)
+        self.assertEqual((yield self.versions.get_version(u'user-2')), 0)
+
+
+class TestRoutingTableCache(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.versions = RoutingTableVersions(
+            self.redis.sub_manager('routing_table_versions'))
+        self.clock = Clock()
+
+    def mk_cache(self, max_size=10, ttl=60):
+        return RoutingTableCache(
+            self.versions, max_size, ttl, clock=self.clock)
+
+    def mk_user_api(self, user_account_key):
+        return FakeUserApi(user_account_key, RoutingTable({
+            "TRANSPORT_TAG:pool1:1234": {
+                "default": ["CONVERSATION:app1:%s" % (user_account_key,),
+                            "default"]},
+        }))
+
+    @inlineCallbacks
+    def test_get_routing_table_cached(self):
+        cache = self.mk_cache()
+        user_api = self.mk_user_api(u'user-1')
+        rt1 = yield cache.get_routing_table(user_api)
+        rt2 = yield cache.get_routing_table(user_api)
+        self.assertEqual(rt1, user_api.routing_table)
+        self.assertTrue(rt2 is rt1)
+        self.assertEqual(user_api.loads, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_get_routing_table_version_bumped(self):
+        cache = self.mk_cache()
+        user_api = self.mk_user_api(u'user-1')
+        yield cache.get_routing_table(user_api)
+        yield self.versions.bump_version(u'user-1')
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 2)
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 2)
+
+    @inlineCallbacks
+    def test_get_routing_table_expired(self):
+        cache = self.mk_cache(ttl=5)
+        user_api = self.mk_user_api(u'user-1')
+        yield cache.get_routing_table(user_api)
+        self.clock.advance(4)
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 1)
+        self.clock.advance(1)
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 2)
+
+    @inlineCallbacks
+    def test_get_routing_table_disabled(self):
+        cache = self.mk_cache(ttl=0)
+        user_api = self.mk_user_api(u'user-1')
+        yield cache.get_routing_table(user_api)
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 2)
+        self.assertEqual(len(cache), 0)
+
+    @inlineCallbacks
+    def test_max_size(self):
+        cache = self.mk_cache(max_size=2)
+        for key in [u'user-1', u'user-2', u'user-3']:
+            yield cache.get_routing_table(self.mk_user_api(key))
+            self.clock.advance(1)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(u'user-1' in cache)
+        self.assertTrue(u'user-2' in cache)
+        self.assertTrue(u'user-3' in cache)
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        cache = self.mk_cache()
+        user_api = self.mk_user_api(u'user-1')
+        yield cache.get_routing_table(user_api)
+        cache.invalidate(u'user-1')
+        self.assertFalse(u'user-1' in cache)
+        yield cache.get_routing_table(user_api)
+        self.assertEqual(user_api.loads, 2)
+
+    @inlineCallbacks
+    def test_clear(self):
+        cache = self.mk_cache()
+        yield cache.get_routing_table(self.mk_user_api(u'user-1'))
+        yield cache.get_routing_table(self.mk_user_api(u'user-2'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,129 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.tag_ownership import TagOwnershipStore, TagOwnershipIndex
+from go.vumitools.tests.helpers import VumiApiHelper
+
+
+class TestTagOwnershipStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = TagOwnershipStore(self.redis.sub_manager('tag_ownership'))
+
+    @inlineCallbacks
+    def test_no_owners(self):
+        self.assertEqual((yield self.store.get_owners()), {})
+        self.assertEqual((yield self.store.get_version()), 0)
+
+    @inlineCallbacks
+    def test_set_owner(self):
+        yield self.store.set_owner((u"pool1", u"1234"), u"user-1")
+        yield self.store.set_owner((u"pool1", u"ta:g"), u"user-2")
+        self.assertEqual((yield self.store.get_owners()), {
+            (u"pool1", u"1234"): u"user-1",
+            (u"pool1", u"ta:g"): u"user-2",
+        })
+        self.assertEqual((yield self.store.get_version()), 2)
+
+    @inlineCallbacks
+    def test_clear_owner(self):
+        yield self.store.set_owner((u"pool1", u"1234"), u"user-1")
+        yield self.store.clear_owner((u"pool1", u"1234"))
+        self.assertEqual((yield self.store.get_owners()), {})
+        self.assertEqual((yield self.store.get_version()), 2)
+
+
+class TestTagOwnershipIndex(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.vumi_helper = yield self.add_helper(VumiApiHelper())
+        self.vumi_api = self.vumi_helper.get_vumi_api()
+        self.user_helper = yield self.vumi_helper.make_user(u'testuser')
+        self.user_api = self.user_helper.user_api
+        self.tag1, self.tag2 = yield self.vumi_helper.setup_tagpool(
+            u"pool1", [u"1234", u"5678"], metadata={
+                "transport_name": "sphex",
+            })
+        yield self.user_helper.add_tagpool_permission(u"pool1")
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def mk_index(self, refresh_interval=5):
+        index = TagOwnershipIndex(
+            self.vumi_api, refresh_interval, clock=self.clock)
+        yield index.load()
+        self.index = index
+
+    def patch_tag_info_lookups(self):
+        def fail_tag_info_lookup(tag):
+            self.fail("Unexpected tag info lookup for %r" % (tag,))
+        return self.vumi_helper.monkey_patch(
+            self.vumi_api.mdb, 'get_tag_info', fail_tag_info_lookup)
+
+    def count_tagpool_lookups(self):
+        lookups = []
+        get_metadata = self.vumi_api.tpm.get_metadata
+
+        def counting_get_metadata(tagpool):
+            lookups.append(tagpool)
+            return get_metadata(tagpool)
+
+        self.vumi_helper.monkey_patch(
+            self.vumi_api.tpm, 'get_metadata', counting_get_metadata)
+        return lookups
+
+    @inlineCallbacks
+    def test_get_owner_preloaded(self):
+        yield self.user_api.acquire_specific_tag(self.tag1)
+        yield self.mk_index()
+        self.patch_tag_info_lookups()
+        owner = yield self.index.get_owner(self.tag1)
+        self.assertEqual(owner, self.user_api.user_account_key)
+
+    @inlineCallbacks
+    def test_get_owner_not_in_index(self):
+        yield self.user_api.acquire_specific_tag(self.tag1)
+        index = TagOwnershipIndex(self.vumi_api, 5, clock=self.clock)
+        # Simulate a tag acquired before ownership was recorded in Redis.
+        yield self.vumi_api.tag_ownership.clear_owner(self.tag1)
+        yield index.load()
+        owner = yield index.get_owner(self.tag1)
+        self.assertEqual(owner, self.user_api.user_account_key)
+
+    @inlineCallbacks
+    def test_get_owner_acquired_after_load(self):
+        yield self.mk_index()
+        yield self.user_api.acquire_specific_tag(self.tag1)
+        self.patch_tag_info_lookups()
+        self.clock.advance(5)
+        owner = yield self.index.get_owner(self.tag1)
+        self.assertEqual(owner, self.user_api.user_account_key)
+
+    @inlineCallbacks
+    def test_get_owner_released_after_load(self):
+        yield self.user_api.acquire_specific_tag(self.tag1)
+        yield self.mk_index()
+        yield self.user_api.release_tag(self.tag1)
+        self.assertEqual(
+            (yield self.index.get_owner(self.tag1)),
+            self.user_api.user_account_key)
+        self.clock.advance(5)
+        self.assertEqual((yield self.index.get_owner(self.tag1)), None)
+
+    @inlineCallbacks
+    def test_get_tagpool_metadata(self):
+        yield self.mk_index()
+        lookups = self.count_tagpool_lookups()
+        metadata = yield self.index.get_tagpool_metadata(u"pool1")
+        self.assertEqual(metadata, {"transport_name": "sphex"})
+        yield self.index.get_tagpool_metadata(u"pool1")
+        self.assertEqual(lookups, [u"pool1"])
+        self.clock.advance(5)
+        yield self.index.get_tagpool_metadata(u"pool1")
+        self.assertEqual(lookups, [u"pool1", u"pool1"])
@@ -103,6 +103,7 @@ class WizardCreateView(BaseWizardView):
         routing_table.add_entry(conv_conn, "default", tag_conn, "default")
         routing_table.add_entry(tag_conn, "default", conv_conn, "default")
         user_account.save()
+        request.user_api.routing_table_updated()
 
 
 @login_required